@@ -1,63 +1,717 @@
-from fastapi import FastAPI, APIRouter
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
+from starlette.datastructures import Headers
 from starlette.middleware.cors import CORSMiddleware
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr, ValidationError
 from typing import List, Optional
+from typing_extensions import NotRequired, TypedDict
 import asyncio
+import base64
+import contextlib
+import copy
+import functools
+import hashlib
+import hmac
+import importlib.util
+import ipaddress
 import json
+import linecache
+import math
+import queue
 import re
 import random
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import urlparse
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 
+IMPORT_STARTED = time.perf_counter()
 ROOT_DIR = Path(__file__).parent
 
 load_dotenv(ROOT_DIR / '.env')
 
-app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
-@app.get("/")
-async def root():
-    return {"message": "Backend is running"}
+# ============== Logging ==============
+# Handlers never write on the event loop: records go into a bounded in-memory
+# queue and a QueueListener thread formats them (JSON by default) and writes them
+# to stderr. Records tagged with extra={"event": ...} are sampled and rate limited
+# per event, so per-call lines cannot flood the log under load. The queue and its
+# thread only exist while an app is serving: create_app()'s lifespan installs them.
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+# sample: fraction of INFO/DEBUG records kept (WARNING and above are never sampled)
+# per_second: token-bucket cap applied to every level
+LOG_EVENT_POLICIES = {
+    "llm_call":          {"sample": 0.1, "per_second": 20},
+    "llm_status":        {"sample": 0.1, "per_second": 20},
+    "chat_request":      {"sample": 1.0, "per_second": 50},
+    "route":             {"sample": 0.2, "per_second": 20},
+    "upstream_error":    {"sample": 1.0, "per_second": 5},
+    "alternation_error": {"sample": 1.0, "per_second": 2},
+}
+try:
+    LOG_EVENT_POLICIES.update(json.loads(os.environ.get('LOG_SAMPLING', '{}')))
+except json.JSONDecodeError:
+    pass
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, event, plus the record's `fields`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        event = getattr(record, "event", None)
+        if event:
+            entry["event"] = event
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        sample_rate = getattr(record, "sample_rate", None)
+        if sample_rate is not None:
+            entry["sample_rate"] = sample_rate
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogSampler(logging.Filter):
+    """Per-event sampling and token-bucket rate limiting; records without an event always pass."""
+
+    def __init__(self, policies: dict):
+        super().__init__()
+        self.policies = policies
+        self._buckets = {}
+        self._dropped = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, "event", None)
+        policy = self.policies.get(event) if event else None
+        if policy is None:
+            return True
+
+        sample = policy.get("sample", 1.0)
+        if sample < 1.0 and record.levelno < logging.WARNING:
+            if random.random() >= sample:
+                self.drop(event, "sampled")
+                return False
+            record.sample_rate = sample
+
+        per_second = policy.get("per_second")
+        if per_second:
+            now = time.monotonic()
+            with self._lock:
+                tokens, last = self._buckets.get(event, (per_second, now))
+                tokens = min(per_second, tokens + (now - last) * per_second)
+                if tokens < 1:
+                    self._buckets[event] = (tokens, now)
+                    self._dropped[(event, "rate_limited")] += 1
+                    return False
+                self._buckets[event] = (tokens - 1, now)
+        return True
+
+    def drop(self, event: Optional[str], reason: str) -> None:
+        with self._lock:
+            self._dropped[(event or "-", reason)] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {f"{event}:{reason}": n for (event, reason), n in self._dropped.items()}
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue: queue.Queue, sampler: LogSampler):
+        super().__init__(log_queue)
+        self.sampler = sampler
+        self.addFilter(sampler)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve args and exception text now (they may not survive the thread hop),
+        # but leave formatting to the listener thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.sampler.drop(getattr(record, "event", None), "queue_full")
+
+
+@contextlib.contextmanager
+def queued_logging():
+    """Routes root and uvicorn logging through the queue while the app is serving, then restores the old handlers."""
+    stream = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE), LOG_SAMPLER)
+    root = logging.getLogger()
+    # uvicorn installs its own synchronous stream handlers; route them through the queue too
+    loggers = [root] + [logging.getLogger(name) for name in ("uvicorn", "uvicorn.error", "uvicorn.access")]
+    saved = [(lg, lg.handlers, lg.level, lg.propagate) for lg in loggers]
+    for lg in loggers:
+        lg.handlers = [handler]
+        lg.propagate = lg is root
+    root.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(handler.queue, stream, respect_handler_level=True)
+    listener.start()
+    try:
+        yield listener
+    finally:
+        for lg, handlers, level, propagate in saved:
+            lg.handlers, lg.propagate = handlers, propagate
+            lg.setLevel(level)
+        # stop() drains whatever is still queued before returning
+        listener.stop()
+
+
+LOG_SAMPLER = LogSampler(LOG_EVENT_POLICIES)
+logger = logging.getLogger(__name__)
 
 # ============== API Keys ==============
 
 SARVAM_API_KEY = os.environ.get('SARVAM_API_KEY')
-print(f"🔑 Sarvam API Key Loaded: {SARVAM_API_KEY is not None}")
-if SARVAM_API_KEY:
-    print(f"🔑 API Key Preview: {SARVAM_API_KEY[:15]}...")
-else:
-    print("❌ WARNING: SARVAM_API_KEY not found in .env file!")
+
+# Extra keys (comma-separated) join SARVAM_API_KEY in the key pool
+SARVAM_API_KEYS = [k.strip() for k in os.environ.get('SARVAM_API_KEYS', '').split(',') if k.strip()]
+if SARVAM_API_KEY and SARVAM_API_KEY not in SARVAM_API_KEYS:
+    SARVAM_API_KEYS.insert(0, SARVAM_API_KEY)
 
 TAVILY_API_KEY = os.environ.get('TAVILY_API_KEY')
 
 # ============== Sarvam AI Configuration ==============
 
 SARVAM_API_URL = "https://api.sarvam.ai/v1/chat/completions"
-SARVAM_HEADERS = {
-    "api-subscription-key": SARVAM_API_KEY if SARVAM_API_KEY else "",
-    "Content-Type": "application/json"
-}
+SARVAM_MODEL = "sarvam-m"
+
+TAVILY_API_URL = "https://api.tavily.com"
+
+# One pooled session for every upstream call so TLS connections are reused
+# instead of being re-established per request. The app's lifespan opens it with
+# the configured pool size; scripts that call providers directly get a default one.
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '20'))
+_upstream_session: Optional[requests.Session] = None
+
+
+def open_upstream_session(pool_size: int = UPSTREAM_POOL_SIZE) -> requests.Session:
+    global _upstream_session
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+    _upstream_session = session
+    return session
+
+
+def upstream_session() -> requests.Session:
+    return _upstream_session or open_upstream_session()
+
+
+def close_upstream_session() -> None:
+    global _upstream_session
+    if _upstream_session is not None:
+        _upstream_session.close()
+        _upstream_session = None
+
+
+# requests is blocking, so every upstream call and every read from an upstream
+# stream runs on this pool instead of the event loop. A slow provider then ties
+# up a worker thread, not the loop (which would also show up as loop lag and
+# trip the brownout). Sized for one thread per concurrent upstream call. Like
+# the session, the lifespan opens and shuts it down; other callers get a default one.
+UPSTREAM_IO_THREADS = int(os.environ.get('UPSTREAM_IO_THREADS', '64'))
+UPSTREAM_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+
+def open_upstream_executor(threads: int = UPSTREAM_IO_THREADS) -> ThreadPoolExecutor:
+    global UPSTREAM_EXECUTOR
+    UPSTREAM_EXECUTOR = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="upstream")
+    return UPSTREAM_EXECUTOR
+
+
+def upstream_executor() -> ThreadPoolExecutor:
+    return UPSTREAM_EXECUTOR or open_upstream_executor()
+
+
+def close_upstream_executor() -> None:
+    global UPSTREAM_EXECUTOR
+    if UPSTREAM_EXECUTOR is not None:
+        # Workers stuck in a blocking read finish on their own; queued calls are dropped
+        UPSTREAM_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        UPSTREAM_EXECUTOR = None
+
+
+async def run_upstream(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(upstream_executor(), functools.partial(func, *args, **kwargs))
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
 
 # ============== Per-Mode Generation Settings ==============
 
 MODE_SETTINGS = {
-    "learn":   {"max_tokens": 4096, "temperature": 0.75},
-    "english": {"max_tokens": 3072, "temperature": 0.75},
-    "startup": {"max_tokens": 3072, "temperature": 0.75},
-    "default": {"max_tokens": 4096, "temperature": 0.75},
+    "learn":   {"max_tokens": 4096, "temperature": 0.75, "deadline_ms": 60000},
+    "english": {"max_tokens": 3072, "temperature": 0.75, "deadline_ms": 45000},
+    "startup": {"max_tokens": 3072, "temperature": 0.75, "deadline_ms": 45000},
+    "default": {"max_tokens": 4096, "temperature": 0.75, "deadline_ms": 45000},
 }
 
 def get_mode_settings(mode: Optional[str]) -> dict:
     return MODE_SETTINGS.get(mode or "default", MODE_SETTINGS["default"])
 
+# ============== Metrics ==============
+
+class Metrics:
+    """Process-local counters and gauges, exposed as JSON on /api/metrics."""
+
+    def __init__(self):
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+    def set_gauge(self, name: str, value, **labels) -> None:
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"counters": dict(self._counters), "gauges": dict(self._gauges)}
+
+
+METRICS = Metrics()
+
+# ============== Deadlines ==============
+# Every request carries one end-to-end budget, taken from its mode's deadline_ms
+# or from the client's X-Request-Deadline-Ms header. Each stage takes its share
+# of what is left and degrades instead of hanging: live search is skipped,
+# failover stops, and a stream whose first token misses it ends early. Once tokens
+# are flowing only the gap between chunks is bounded (STREAM_IDLE_TIMEOUT), so a
+# long answer that is still arriving is not cut off by the end-to-end budget.
+
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+DEADLINE_MIN_MS = 1000
+DEADLINE_MAX_MS = int(os.environ.get('DEADLINE_MAX_MS', '120000'))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '5'))
+# requests applies the read timeout to every socket read, so for streams this
+# bounds both time to first token and idle gaps between chunks.
+FIRST_TOKEN_TIMEOUT = float(os.environ.get('FIRST_TOKEN_TIMEOUT', '20'))
+STREAM_IDLE_TIMEOUT = float(os.environ.get('STREAM_IDLE_TIMEOUT', '20'))
+SEARCH_TIMEOUT = float(os.environ.get('SEARCH_TIMEOUT', '4'))
+SEARCH_DEADLINE_SHARE = 0.2
+CONTINUATION_MIN_REMAINING = float(os.environ.get('CONTINUATION_MIN_REMAINING', '5'))
+MEMORY_EXTRACT_DEADLINE_MS = int(os.environ.get('MEMORY_EXTRACT_DEADLINE_MS', '20000'))
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str):
+        super().__init__(f"Deadline exceeded during {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """Monotonic end-to-end budget for one request."""
+
+    def __init__(self, budget_ms: float):
+        self.budget_ms = budget_ms
+        self.expires_at = time.monotonic() + budget_ms / 1000
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def share(self, fraction: float, cap: float) -> float:
+        """A stage's slice of the remaining budget, never more than `cap` seconds."""
+        return min(cap, self.remaining() * fraction)
+
+    def upstream_timeout(self, stream: bool) -> tuple:
+        """(connect, read) timeouts for one upstream attempt."""
+        remaining = self.remaining()
+        read = min(FIRST_TOKEN_TIMEOUT, remaining) if stream else remaining
+        return (min(UPSTREAM_CONNECT_TIMEOUT, remaining), read)
+
+
+def request_deadline(mode: Optional[str], header_value: Optional[str] = None,
+                     default_ms: Optional[int] = None) -> Deadline:
+    """The mode's deadline, or the client's header value clamped to [DEADLINE_MIN_MS, DEADLINE_MAX_MS]."""
+    budget_ms = default_ms or get_mode_settings(mode)["deadline_ms"]
+    if header_value:
+        try:
+            budget_ms = min(DEADLINE_MAX_MS, max(DEADLINE_MIN_MS, int(header_value)))
+        except ValueError:
+            logger.warning(f"Ignoring invalid {DEADLINE_HEADER}: {header_value!r}")
+    return Deadline(budget_ms)
+
+
+def record_deadline_miss(stage: str) -> None:
+    METRICS.inc("deadline_exceeded_total", stage=stage)
+    logger.warning(f"⏱️ Deadline exceeded during {stage}")
+
+# ============== Brownout ==============
+# Under overload the backend sheds optional work before it sheds requests. A
+# background tick combines three pressure signals: chat requests in flight, event
+# loop lag, and the upstream error rate. It steps the brownout level up as soon
+# as pressure crosses a threshold and back down one level at a time after
+# BROWNOUT_RECOVERY_SECONDS of lower pressure.
+#   1 skip_extraction  /memory/extract returns the current memory without an LLM call
+#   2 no_search        live search is skipped
+#   3 reduced          context limits and max_tokens are scaled by BROWNOUT_SHRINK
+#   4 shed             chat requests get 503 + Retry-After
+
+BROWNOUT_ENABLED = os.environ.get('BROWNOUT_ENABLED', 'true').lower() == 'true'
+BROWNOUT_MAX_IN_FLIGHT = int(os.environ.get('BROWNOUT_MAX_IN_FLIGHT', '64'))
+BROWNOUT_MAX_LAG_MS = float(os.environ.get('BROWNOUT_MAX_LAG_MS', '250'))
+BROWNOUT_MAX_ERROR_RATE = float(os.environ.get('BROWNOUT_MAX_ERROR_RATE', '0.5'))
+BROWNOUT_RECOVERY_SECONDS = float(os.environ.get('BROWNOUT_RECOVERY_SECONDS', '15'))
+BROWNOUT_TICK = float(os.environ.get('BROWNOUT_TICK', '0.5'))
+BROWNOUT_SHRINK = float(os.environ.get('BROWNOUT_SHRINK', '0.5'))
+BROWNOUT_ERROR_WINDOW = 60.0
+BROWNOUT_MIN_ERROR_SAMPLES = 10
+# Pressure (the worst signal as a fraction of its limit) at which each level starts
+BROWNOUT_THRESHOLDS = (0.6, 0.75, 0.9, 1.0)
+BROWNOUT_LEVELS = ("normal", "skip_extraction", "no_search", "reduced", "shed")
+
+LEVEL_SKIP_EXTRACTION = 1
+LEVEL_NO_SEARCH = 2
+LEVEL_REDUCED = 3
+LEVEL_SHED = 4
+
+
+class BrownoutController:
+    def __init__(self):
+        self.level = 0
+        self.in_flight = 0
+        self.loop_lag_ms = 0.0
+        self._outcomes = deque()
+        self._calm_since: Optional[float] = None
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @contextlib.contextmanager
+    def track(self):
+        """Counts one chat request in flight for the duration of the block."""
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def record_upstream(self, ok: bool) -> None:
+        now = time.time()
+        with self._lock:
+            self._outcomes.append((now, ok))
+            while self._outcomes and self._outcomes[0][0] < now - BROWNOUT_ERROR_WINDOW:
+                self._outcomes.popleft()
+
+    def error_rate(self) -> float:
+        with self._lock:
+            cutoff = time.time() - BROWNOUT_ERROR_WINDOW
+            recent = [ok for ts, ok in self._outcomes if ts >= cutoff]
+        if len(recent) < BROWNOUT_MIN_ERROR_SAMPLES:
+            return 0.0
+        return recent.count(False) / len(recent)
+
+    def pressure(self) -> float:
+        return max(
+            self.in_flight / BROWNOUT_MAX_IN_FLIGHT,
+            self.loop_lag_ms / BROWNOUT_MAX_LAG_MS,
+            self.error_rate() / BROWNOUT_MAX_ERROR_RATE,
+        )
+
+    def update(self) -> int:
+        pressure = self.pressure()
+        target = sum(1 for t in BROWNOUT_THRESHOLDS if pressure >= t) if BROWNOUT_ENABLED else 0
+        now = time.time()
+        if target > self.level:
+            logger.warning(f"🟠 Brownout level {self.level} → {target} ({BROWNOUT_LEVELS[target]}) | pressure={pressure:.2f}")
+            self.level = target
+            self._calm_since = None
+        elif target < self.level:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= BROWNOUT_RECOVERY_SECONDS:
+                self.level -= 1
+                self._calm_since = now
+                logger.info(f"🟢 Brownout level recovered to {self.level} ({BROWNOUT_LEVELS[self.level]})")
+        else:
+            self._calm_since = None
+        METRICS.set_gauge("brownout_level", self.level)
+        METRICS.set_gauge("brownout_pressure", round(pressure, 3))
+        METRICS.set_gauge("brownout_in_flight", self.in_flight)
+        METRICS.set_gauge("event_loop_lag_ms", round(self.loop_lag_ms, 1))
+        METRICS.set_gauge("upstream_error_rate", round(self.error_rate(), 3))
+        return self.level
+
+    def active(self, level: int, feature: str) -> bool:
+        """True (and counted) when the current level degrades `feature`."""
+        if self.level >= level:
+            METRICS.inc("brownout_degraded_total", feature=feature)
+            return True
+        return False
+
+    def shed_response(self) -> Optional[JSONResponse]:
+        if not self.active(LEVEL_SHED, "request"):
+            return None
+        retry_after = max(1, int(BROWNOUT_RECOVERY_SECONDS))
+        return JSONResponse(
+            {"error": "Server is overloaded, please retry shortly", "success": False, "brownout": True},
+            status_code=503,
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    def shrink(self, value: int, floor: int) -> int:
+        return max(floor, int(value * BROWNOUT_SHRINK))
+
+    def snapshot(self) -> dict:
+        return {
+            "level": self.level,
+            "state": BROWNOUT_LEVELS[self.level],
+            "in_flight": self.in_flight,
+            "loop_lag_ms": round(self.loop_lag_ms, 1),
+            "upstream_error_rate": round(self.error_rate(), 3),
+            "pressure": round(self.pressure(), 3),
+        }
+
+    async def run(self) -> None:
+        """Measures event-loop lag as sleep overshoot and re-evaluates the level every tick."""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(BROWNOUT_TICK)
+            lag_ms = max(0.0, (loop.time() - started - BROWNOUT_TICK) * 1000)
+            self.loop_lag_ms = 0.7 * self.loop_lag_ms + 0.3 * lag_ms
+            self.update()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+BROWNOUT = BrownoutController()
+
+
+async def start_brownout():
+    BROWNOUT.start()
+
+
+async def stop_brownout():
+    BROWNOUT.stop()
+
+# ============== Shared Cache ==============
+# Search results, game sessions and extraction marks are cached through one small
+# interface so callers never need to know where the data lives. Prompt builders
+# are not cached: rendering an f-string is cheaper than a cache round trip. "memory" keeps a per-process
+# LRU; "sqlite" uses a WAL-mode database file that every uvicorn worker on the
+# host can read and write concurrently.
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory').lower()
+CACHE_PATH = os.environ.get('CACHE_PATH', str(ROOT_DIR / 'data' / 'cache.sqlite3'))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '2048'))
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', '300'))
+
+
+class CacheBackend(ABC):
+    """Key/value store with optional per-entry TTL. Values must be JSON-serialisable."""
+
+    @abstractmethod
+    def get(self, key: str):
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value, ttl: Optional[float] = None) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+
+class LRUCache(CacheBackend):
+    """In-process LRU. Fast, but every worker keeps its own copy."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteCache(CacheBackend):
+    """Host-wide cache in a WAL-mode SQLite file, shared by all worker processes."""
+
+    PRUNE_EVERY = 200
+
+    def __init__(self, path: str = CACHE_PATH, max_entries: int = CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        row = self._conn().execute(
+            "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            self.delete(key)
+            return None
+        return json.loads(value)
+
+    def set(self, key: str, value, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires_at)
+        )
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self._prune(conn)
+
+    def _prune(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM cache WHERE rowid IN ("
+            "SELECT rowid FROM cache ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def delete(self, key: str) -> None:
+        self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        self._conn().execute("DELETE FROM cache")
+
+
+CACHE_BACKENDS = {
+    "memory": LRUCache,
+    "sqlite": SQLiteCache,
+}
+
+_cache: Optional[CacheBackend] = None
+
+
+def get_cache() -> CacheBackend:
+    """Returns the configured cache backend, creating it on first use."""
+    global _cache
+    if _cache is None:
+        backend_cls = CACHE_BACKENDS.get(CACHE_BACKEND)
+        if backend_cls is None:
+            logger.warning(f"Unknown CACHE_BACKEND '{CACHE_BACKEND}', falling back to memory")
+            backend_cls = LRUCache
+        _cache = backend_cls()
+    return _cache
+
+
+def set_cache(backend: CacheBackend) -> None:
+    global _cache
+    _cache = backend
+
+
+def cache_key(namespace: str, *parts) -> str:
+    digest = hashlib.sha1(
+        json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    return f"{namespace}:{digest}"
+
 # ============== Helper Function - Clean Markdown ==============
 
 def clean_markdown(text: str) -> str:
@@ -73,9 +727,12 @@ def clean_markdown(text: str) -> str:
 
 # ============== Models ==============
 
-class ChatMessage(BaseModel):
+# Messages are validated straight into plain dicts (not models): long histories
+# decode in one pass and feed the upstream payload builders without rebuilding.
+class ChatMessage(TypedDict):
     role: str
     content: str
+    id: NotRequired[Optional[str]]
 
 class UserMemory(BaseModel):
     preferred_name: Optional[str] = None
@@ -95,15 +752,78 @@ class ChatRequest(BaseModel):
     conversation_id: Optional[str] = None
     user_memory: Optional[UserMemory] = None
     active_mode: Optional[str] = None
+    user_id: Optional[str] = None
+    persist: bool = False
+    _received_at: float = PrivateAttr(default_factory=time.time)
+
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest]
+    concurrency: Optional[int] = None
+
+class StoredMessage(BaseModel):
+    id: Optional[str] = None
+    role: str
+    content: str
+    timestamp: Optional[float] = None
+
+class SaveConversationRequest(BaseModel):
+    id: Optional[str] = None
+    user_id: Optional[str] = None
+    title: Optional[str] = None
+
+class SaveMessagesRequest(BaseModel):
+    user_id: Optional[str] = None
+    messages: List[StoredMessage]
 
 class ExtractMemoryRequest(BaseModel):
     messages: List[ChatMessage]
     current_memory: Optional[UserMemory] = None
+    conversation_id: Optional[str] = None
+    user_id: Optional[str] = None
 
 class ExtractMemoryResponse(BaseModel):
     updated_memory: UserMemory
     extracted_facts: List[str]
 
+
+def decode_body(model, body: bytes):
+    """
+    Validates a raw JSON request body into `model` in one pass (JSON parsing and
+    validation both happen in pydantic-core). Raises RequestValidationError with
+    the same details FastAPI produces for a body parameter.
+    """
+    try:
+        return model.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(_body_errors(model, body, e), body=body)
+
+
+def _body_errors(model, body: bytes, error: ValidationError) -> list:
+    # Error path only: redo FastAPI's own json.loads + python-mode validation so
+    # clients see identical messages ("valid list", JSON decode positions, ...).
+    if not body:
+        return ValidationError.from_exception_data("body", [{"type": "missing", "loc": ("body",), "input": None}]).errors()
+    try:
+        data = json.loads(body)
+    except json.JSONDecodeError as e:
+        return [{"type": "json_invalid", "loc": ("body", e.pos), "msg": "JSON decode error", "input": {}, "ctx": {"error": e.msg}}]
+    try:
+        # FastAPI validates body parameters with from_attributes, hence model_attributes_type
+        model.model_validate(data, from_attributes=True)
+    except ValidationError as e:
+        error = e
+    return [_as_model_error({**err, "loc": ("body", *err["loc"])}) for err in error.errors()]
+
+
+def _as_model_error(err: dict) -> dict:
+    # Messages used to be models: a non-object message reported model_attributes_type, not dict_type
+    loc = err["loc"]
+    if err["type"] == "dict_type" and len(loc) >= 2 and loc[-2] == "messages" and isinstance(loc[-1], int):
+        return {**err, "type": "model_attributes_type",
+                "msg": "Input should be a valid dictionary or object to extract fields from",
+                "url": err["url"].replace("dict_type", "model_attributes_type")}
+    return err
+
 # ============== Mode Deactivation Detection ==============
 
 DEACTIVATE_PHRASES = [
@@ -214,26 +934,271 @@ def needs_live_search(query: str) -> bool:
     return False
 
 
-async def search_tavily(query: str) -> str:
-    """Calls Tavily and returns a clean summary string for context injection."""
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', '5'))
+SEARCH_CONTEXT_TOKENS = int(os.environ.get('SEARCH_CONTEXT_TOKENS', '300'))
+SEARCH_PACKING = os.environ.get('SEARCH_PACKING', '1') == '1'
+
+
+async def search_tavily(query: str, timeout: Optional[float] = None) -> str:
+    """
+    Calls Tavily and returns a clean summary string for context injection.
+    With a timeout the search is abandoned (returns "") when it runs long; the
+    lookup itself keeps going in the background so its result still lands in the cache.
+    """
+    if timeout is None:
+        results = await fetch_tavily_results(query)
+    else:
+        try:
+            results = await asyncio.wait_for(asyncio.shield(fetch_tavily_results(query)), timeout)
+        except asyncio.TimeoutError:
+            record_deadline_miss("search")
+            return ""
+    if not results:
+        return ""
+    if not SEARCH_PACKING:
+        return format_search_results(results)
+
+    packed = pack_search_context(query, results, SEARCH_CONTEXT_TOKENS)
+    legacy_tokens = estimate_tokens(format_search_results(results))
+    METRICS.inc("search_context_tokens_total", estimate_tokens(packed))
+    METRICS.inc("search_context_tokens_saved_total", max(0, legacy_tokens - estimate_tokens(packed)))
+    return packed
+
+
+async def fetch_tavily_results(query: str) -> List[dict]:
+    """Raw Tavily results ({title, content, url}), cached per query."""
+    key = cache_key("tavily_results", query.lower().strip())
     try:
+        hit = await asyncio.to_thread(get_cache().get, key)
+    except Exception as e:
+        logger.warning(f"Cache read failed for tavily: {e}")
+        hit = None
+    if hit is not None:
+        return hit
+
+    results = await _search_tavily_uncached(query)
+    if results:
+        try:
+            await asyncio.to_thread(get_cache().set, key, results, SEARCH_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Cache write failed for tavily: {e}")
+    return results
+
+
+_tavily_client = None
+
+
+def tavily_client():
+    """One client per process; the import itself is normally done by warm-up before the first query."""
+    global _tavily_client
+    if _tavily_client is None:
         from tavily import TavilyClient
-        client = TavilyClient(api_key=TAVILY_API_KEY)
-        response = client.search(query, max_results=5)
+        _tavily_client = TavilyClient(api_key=TAVILY_API_KEY)
+    return _tavily_client
+
+
+async def _search_tavily_uncached(query: str) -> List[dict]:
+    try:
+        response = await asyncio.to_thread(tavily_client().search, query, max_results=SEARCH_MAX_RESULTS)
 
         if response and "results" in response:
-            results = []
-            for r in response["results"][:5]:
-                title = r.get("title", "")
-                content = r.get("content", "")[:300]
-                url = r.get("url", "")
-                results.append(f"📌 {title}\n   {content}\n   🔗 {url}")
-            return "\n\n".join(results) if results else ""
-        return ""
+            return [
+                {"title": r.get("title", ""), "content": r.get("content", ""), "url": r.get("url", "")}
+                for r in response["results"][:SEARCH_MAX_RESULTS]
+            ]
+        return []
     except Exception as e:
         logger.error(f"Tavily error: {e}")
+        return []
+
+
+def format_search_results(results: List[dict]) -> str:
+    """Original unpacked format: every result, truncated to 300 characters, with full URLs."""
+    formatted = []
+    for r in results:
+        formatted.append(f"📌 {r['title']}\n   {r['content'][:300]}\n   🔗 {r['url']}")
+    return "\n\n".join(formatted)
+
+
+# ---------- Search Context Packing ----------
+# Results are split into sentences, near-duplicates are dropped and the rest are
+# ranked by word overlap with the query. The best sentences are packed into a
+# token budget, grouped by source with short [n] domain attribution.
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?।])\s+|\n+")
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+NEAR_DUPLICATE_THRESHOLD = 0.7
+# Shared with memory selection and turn retrieval, so all three rank by the same words
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do for from have how in is it its me my of on or so that the this to "
+    "was were what when where which who why will with you your about tell please latest today now current "
+    "news hai hain ho kya ka ki ke ko mein main mera meri mujhe se tha thi bhi aur nahi toh yaar".split()
+)
+
+
+def content_words(text: str) -> List[str]:
+    """Lowercased words of `text`, minus stopwords and single characters, in order."""
+    return [w for w in WORD_PATTERN.findall(text.lower()) if w not in STOPWORDS and len(w) > 1]
+
+
+def _source_label(url: str) -> str:
+    host = urlparse(url).hostname or url
+    return host[4:] if host.startswith("www.") else host
+
+
+def pack_search_context(query: str, results: List[dict], token_budget: int = SEARCH_CONTEXT_TOKENS) -> str:
+    query_words = set(content_words(query))
+    candidates = []
+    kept_word_sets = []
+
+    for rank, r in enumerate(results):
+        for position, sentence in enumerate(SENTENCE_SPLIT.split(r.get("content", ""))):
+            sentence = sentence.strip(" -•|")
+            if len(sentence) < 20:
+                continue
+            words = set(content_words(sentence))
+            if not words:
+                continue
+            if any(len(words & seen) / len(words | seen) >= NEAR_DUPLICATE_THRESHOLD for seen in kept_word_sets):
+                continue
+            kept_word_sets.append(words)
+            overlap = len(words & query_words) / (len(query_words) or 1)
+            # earlier results and earlier sentences break ties
+            score = overlap + 0.15 / (rank + 1) + 0.05 / (position + 1)
+            candidates.append((overlap, score, rank, position, sentence))
+
+    candidates.sort(key=lambda c: c[1], reverse=True)
+    relevant = [c for c in candidates if c[0] > 0]
+    # Sentences sharing no words with the query are boilerplate far more often
+    # than answers; fall back to the top few only when nothing matches.
+    candidates = relevant if relevant else candidates[:3]
+    used = 0
+    chosen = []
+    cited = set()
+    for overlap, score, rank, position, sentence in candidates:
+        cost = estimate_tokens(sentence) + 1
+        if rank not in cited:
+            # the title line and the source entry are paid once per cited result
+            cost += estimate_tokens(results[rank].get("title", "")) + estimate_tokens(results[rank].get("url", "")) // 2 + 4
+        if used + cost > token_budget:
+            continue
+        chosen.append((rank, position, sentence))
+        cited.add(rank)
+        used += cost
+
+    if not chosen:
         return ""
 
+    by_source = {}
+    for rank, position, sentence in sorted(chosen):
+        by_source.setdefault(rank, []).append(sentence)
+
+    lines = []
+    sources = []
+    for n, (rank, sentences) in enumerate(by_source.items(), 1):
+        title = results[rank].get("title", "")
+        lines.append(f"[{n}] {title}: {' '.join(sentences)}" if title else f"[{n}] {' '.join(sentences)}")
+        sources.append(f"[{n}] {_source_label(results[rank].get('url', ''))}")
+    return "\n".join(lines) + "\nSources: " + ", ".join(sources)
+
+
+# ============== Memory Selection ==============
+# Long-time users accumulate dozens of interests, goals, facts and favorites;
+# inlining all of them costs prompt tokens on every turn. Instead, each list item
+# gets a hashed keyword vector (cached per item text) and only the items closest
+# to the current message are kept, within a token budget. Short always-on fields
+# (name, language style, skill level, communication style, mood) and the latest
+# topic are always kept. The result is a trimmed UserMemory, so the prompt
+# builders are unchanged.
+
+MEMORY_SELECTION = os.environ.get('MEMORY_SELECTION', 'true').lower() == 'true'
+MEMORY_TOP_K = int(os.environ.get('MEMORY_TOP_K', '6'))
+MEMORY_TOKEN_BUDGET = int(os.environ.get('MEMORY_TOKEN_BUDGET', '120'))
+MEMORY_RECENT_FILL = 2  # most recent items kept when little matches ("hi", "lol")
+MEMORY_VECTOR_DIMS = 1024
+MEMORY_LIST_FIELDS = ("interests", "goals", "personal_facts", "favorite_things", "recent_topics")
+
+
+def _stem(word: str) -> str:
+    for suffix in ("ing", "ers", "ed", "es", "er", "s"):
+        if len(word) > len(suffix) + 3 and word.endswith(suffix):
+            return word[:-len(suffix)]
+    return word
+
+
+def keyword_terms(text: str) -> List[str]:
+    """The search tokenizer's content words, stemmed; memory selection and turn retrieval both use these."""
+    return [_stem(w) for w in content_words(text)]
+
+
+@functools.lru_cache(maxsize=4096)
+def keyword_vector(text: str) -> tuple:
+    """L2-normalised hashed bag of words as a sparse ((index, weight), ...) tuple."""
+    counts = defaultdict(float)
+    for term in keyword_terms(text):
+        counts[zlib.crc32(term.encode("utf-8")) % MEMORY_VECTOR_DIMS] += 1.0
+    norm = math.sqrt(sum(v * v for v in counts.values()))
+    if not norm:
+        return ()
+    return tuple((i, v / norm) for i, v in counts.items())
+
+
+def vector_similarity(query: dict, item: tuple) -> float:
+    return sum(query.get(i, 0.0) * w for i, w in item)
+
+
+def select_memory(memory: Optional[UserMemory], message: str,
+                  top_k: int = MEMORY_TOP_K, budget: int = MEMORY_TOKEN_BUDGET) -> Optional[UserMemory]:
+    """A copy of `memory` with only the list items relevant to `message` (plus always-on fields)."""
+    if not memory or not MEMORY_SELECTION:
+        return memory
+    started = time.perf_counter()
+    items = [
+        (field, position, item)
+        for field in MEMORY_LIST_FIELDS
+        for position, item in enumerate(getattr(memory, field) or [])
+        if item
+    ]
+    if not items:
+        return memory
+
+    query = dict(keyword_vector(message))
+    scored = sorted(
+        ((vector_similarity(query, keyword_vector(item)), field, position, item) for field, position, item in items),
+        key=lambda s: -s[0]
+    )
+    chosen = set()
+    latest_topic = len(memory.recent_topics or []) - 1
+    if latest_topic >= 0:
+        chosen.add(("recent_topics", latest_topic))
+    spent = sum(estimate_tokens(i) for f, p, i in items if (f, p) in chosen)
+    relevant = [s for s in scored if s[0] > 0][:top_k]
+    # Recency fill: the newest interests/goals keep small talk personal when nothing matches
+    recent = [
+        (0.0, field, len(getattr(memory, field)) - 1 - back, getattr(memory, field)[-1 - back])
+        for back in range(MEMORY_RECENT_FILL)
+        for field in ("interests", "goals")
+        if len(getattr(memory, field) or []) > back
+    ][:max(0, MEMORY_RECENT_FILL - len(relevant))]
+    for _, field, position, item in relevant + recent:
+        cost = estimate_tokens(item)
+        if (field, position) in chosen or spent + cost > budget:
+            continue
+        chosen.add((field, position))
+        spent += cost
+
+    selected = memory.model_copy(update={
+        field: [item for position, item in enumerate(getattr(memory, field) or []) if (field, position) in chosen]
+        for field in MEMORY_LIST_FIELDS
+    })
+    total_tokens = sum(estimate_tokens(i) for _, _, i in items)
+    METRICS.inc("memory_items_total", len(items))
+    METRICS.inc("memory_items_selected_total", len(chosen))
+    METRICS.inc("memory_tokens_saved_total", total_tokens - spent)
+    METRICS.inc("memory_selection_seconds_total", time.perf_counter() - started)
+    METRICS.inc("memory_selections_total")
+    return selected
+
 
 # ============== System Prompts ==============
 
@@ -501,6 +1466,39 @@ Think fast, think bold. Sharks are watching."""
 Your goal: Make {user_name} think like a world-class entrepreneur!"""
 
 
+def get_startup_session_prompt(user_name: str, session: dict) -> str:
+    """Compact startup-game prompt: condensed rules plus the server-side game state."""
+    cards = session.get("cards")
+    if not cards:
+        state = "No cards dealt yet — invite them to spin."
+    else:
+        status = {
+            "awaiting_pitch": "waiting for their pitch",
+            "scored": "pitch scored — discuss it or invite a new spin",
+        }.get(session.get("phase"), "in progress")
+        state = (
+            f"Round {session['round']} | Audience: {cards['audience']} | "
+            f"Pain Point: {cards['pain_point']} | Technology: {cards['tech']}\n"
+            f"Status: {status}"
+        )
+    past = [
+        f"R{r['round']} {r.get('verdict') or 'no verdict'} "
+        f"({', '.join(f'{k} {v}' for k, v in r['scores'].items())})"
+        for r in session.get("rounds", [])
+    ]
+    if past:
+        state += "\nPrevious rounds: " + "; ".join(past)
+
+    return f"""You are Nex — a legendary Shark Tank-style startup mentor and investor, running a startup ideation game with {user_name}.
+
+RULES: "spin" / "start" / "play" / "new game" deals 3 cards (Audience, Pain Point, Technology). {user_name} pitches a startup connecting all 3. Score the pitch as Innovation: x/10, Revenue Potential: x/10, Scalability: x/10, Market Fit: x/10, give a thorough, honest 300-500 word analysis with tough questions, and end with a verdict: FUNDED 💰 / NEEDS WORK 🔧 / BRILLIANT IDEA 🌟.
+
+STYLE: exciting and dramatic like a real Shark Tank episode, 3-5 emojis, call {user_name} by name, challenge weak pitches without crushing them, plain text only (no #, *, _).
+
+GAME STATE
+{state}"""
+
+
 # ---------- NORMAL / DEFAULT MODE — Ultra-Personalized All-Rounder ----------
 def get_default_prompt(user_name: str, memory: Optional[UserMemory], live_context: str) -> str:
     display_name = memory.preferred_name if memory and memory.preferred_name else user_name
@@ -635,328 +1633,3107 @@ You are the friend {display_name} didn't know they needed."""
     return prompt
 
 
-# ============== Sarvam AI Helper ==============
-
-def call_sarvam_api(messages: List[dict], stream: bool = False, max_tokens: int = 2048, temperature: float = 0.7):
-    """Call Sarvam AI API with proper error handling and message formatting."""
+# ============== API Key Pool ==============
+# Spreads traffic over several API keys so throughput is not capped by a single
+# key's rate limit. Each request takes the least-loaded key that is not cooling
+# down after a 429. Load is measured as in-flight calls, then requests in the
+# last minute, so traffic rebalances as keys recover.
+
+KEY_COOLDOWN_SECONDS = float(os.environ.get('KEY_COOLDOWN_SECONDS', '30'))
+KEY_USAGE_WINDOW = 60.0
+
+
+class PooledKey:
+    __slots__ = ("value", "id", "in_flight", "requests", "rate_limited", "cooldown_until", "recent")
+
+    def __init__(self, value: str):
+        self.value = value
+        self.id = f"…{value[-4:]}" if len(value) > 4 else "…"
+        self.in_flight = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.cooldown_until = 0.0
+        self.recent = deque()
+
+
+class APIKeyPool:
+    def __init__(self, provider: str, keys: List[str]):
+        self.provider = provider
+        self.keys = [PooledKey(k) for k in keys]
+        self._lock = threading.Lock()
+
+    def acquire(self) -> PooledKey:
+        now = time.time()
+        with self._lock:
+            for key in self.keys:
+                while key.recent and key.recent[0] < now - KEY_USAGE_WINDOW:
+                    key.recent.popleft()
+            healthy = [k for k in self.keys if k.cooldown_until <= now]
+            if healthy:
+                key = min(healthy, key=lambda k: (k.in_flight, len(k.recent)))
+            else:
+                key = min(self.keys, key=lambda k: k.cooldown_until)
+            key.in_flight += 1
+            key.requests += 1
+            key.recent.append(now)
+        METRICS.inc("api_key_requests_total", provider=self.provider, key=key.id)
+        return key
+
+    def release(self, key: PooledKey, status_code: Optional[int], retry_after: Optional[str] = None) -> None:
+        with self._lock:
+            key.in_flight = max(0, key.in_flight - 1)
+            if status_code == 429:
+                key.rate_limited += 1
+                key.cooldown_until = time.time() + _parse_retry_after(retry_after)
+        if status_code == 429:
+            METRICS.inc("api_key_rate_limited_total", provider=self.provider, key=key.id)
+            logger.warning(f"⚠️ {self.provider} key {key.id} rate limited; cooling down")
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {
+                k.id: {
+                    "in_flight": k.in_flight,
+                    "requests": k.requests,
+                    "requests_last_minute": sum(1 for t in k.recent if t >= now - KEY_USAGE_WINDOW),
+                    "rate_limited": k.rate_limited,
+                    "cooling_down": k.cooldown_until > now,
+                }
+                for k in self.keys
+            }
+
+
+def hold_key_until_closed(response, pool: APIKeyPool, key: PooledKey) -> None:
+    """
+    Keeps a streaming response's key in flight until the response is closed, so
+    least-loaded routing sees streams that are still running. Whoever consumes
+    the stream must close it.
+    """
+    close = response.close
+    released = False
 
-    system_content = None
-    user_assistant_messages = []
+    def close_and_release():
+        nonlocal released
+        try:
+            close()
+        finally:
+            if not released:
+                released = True
+                pool.release(key, response.status_code)
 
-    for msg in messages:
-        if msg["role"] == "system":
-            system_content = msg["content"]
-        else:
-            user_assistant_messages.append(msg)
+    response.close = close_and_release
 
-    converted_messages = []
 
-    if user_assistant_messages:
-        first_msg = user_assistant_messages[0]
+def _parse_retry_after(value: Optional[str]) -> float:
+    try:
+        return max(1.0, float(value)) if value else KEY_COOLDOWN_SECONDS
+    except ValueError:
+        return KEY_COOLDOWN_SECONDS
+
+
+def parse_api_keys(value) -> List[str]:
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [k.strip() for k in value.split(",") if k.strip()]
+    return [k for k in value if k]
+
+
+# ============== LLM Providers ==============
+# Every upstream sits behind the same interface: normalize the messages for the
+# provider's quirks, build its payload, send it. ProviderRouter tracks latency
+# and failures per provider, sends each call to the fastest healthy one and
+# fails over to the next on errors, 429s and 5xx responses. Configure extra
+# providers with LLM_PROVIDERS, a JSON list, for example:
+#   [{"type": "sarvam"},
+#    {"type": "openai", "name": "groq", "url": "https://api.groq.com/openai/v1/chat/completions",
+#     "model": "llama-3.1-8b-instant", "api_key_env": "GROQ_API_KEY"}]
+# A model override is either "provider:model" or a bare name for the primary
+# (first) provider. Other providers keep their configured model.
+
+LLM_ROUTING_STRATEGY = os.environ.get('LLM_ROUTING_STRATEGY', 'latency')  # latency | priority
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', '60'))
+PROVIDER_EWMA_ALPHA = 0.2
+PROVIDER_MAX_COOLDOWN = 60.0
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class LLMProvider:
+    """Base provider: OpenAI-style chat completions over the shared upstream session."""
+
+    def __init__(self, name: str, url: str, model: str, api_key=None):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.key_pool = APIKeyPool(name, parse_api_keys(api_key))
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.key_pool.keys)
+
+    def headers(self, api_key: str) -> dict:
+        return {"Content-Type": "application/json"}
+
+    def normalize_messages(self, messages: List[dict]) -> List[dict]:
+        return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+    def resolve_model(self, model: Optional[str], primary: bool) -> str:
+        if not model:
+            return self.model
+        if ":" in model:
+            name, _, qualified = model.partition(":")
+            return qualified if name == self.name else self.model
+        return model if primary else self.model
+
+    def build_payload(self, messages: List[dict], stream: bool, max_tokens: int, temperature: float,
+                      model: Optional[str] = None, primary: bool = True) -> dict:
+        return {
+            "model": self.resolve_model(model, primary),
+            "messages": self.normalize_messages(messages),
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": 0.9,
+            "stream": stream
+        }
 
-        if first_msg["role"] == "user" and system_content:
-            converted_messages.append({
-                "role": "user",
-                "content": f"{system_content}\n\n---\n\n{first_msg['content']}"
-            })
-            converted_messages.extend(user_assistant_messages[1:])
-        else:
-            converted_messages = list(user_assistant_messages)
-    elif system_content:
-        converted_messages.append({
-            "role": "user",
-            "content": system_content
-        })
-
-    fixed_messages = []
-    for i, msg in enumerate(converted_messages):
-        fixed_messages.append(msg)
-        if i < len(converted_messages) - 1:
-            if msg["role"] == "user" and converted_messages[i + 1]["role"] == "user":
-                fixed_messages.append({
-                    "role": "assistant",
-                    "content": "I understand. Please continue."
-                })
-            elif msg["role"] == "assistant" and converted_messages[i + 1]["role"] == "assistant":
-                fixed_messages.append({
-                    "role": "user",
-                    "content": "Continue."
-                })
+    def send(self, payload: dict, stream: bool, timeout=UPSTREAM_TIMEOUT):
+        """Posts with a pooled key; a 429 moves on to the next key before giving up."""
+        response = None
+        for attempt in range(max(1, len(self.key_pool.keys))):
+            key = self.key_pool.acquire()
+            try:
+                response = upstream_session().post(
+                    self.url,
+                    headers=self.headers(key.value),
+                    json=payload,
+                    stream=stream,
+                    timeout=timeout
+                )
+            except Exception:
+                self.key_pool.release(key, None)
+                raise
+            if stream and response.status_code == 200:
+                hold_key_until_closed(response, self.key_pool, key)
+            else:
+                self.key_pool.release(key, response.status_code, response.headers.get("Retry-After"))
+            if response.status_code != 429 or attempt == len(self.key_pool.keys) - 1:
+                break
+            response.close()
+        return response
 
-    converted_messages = fixed_messages
 
-    for i in range(len(converted_messages) - 1):
-        if converted_messages[i]["role"] == converted_messages[i + 1]["role"]:
-            logger.error(f"❌ Messages not alternating at index {i}: {converted_messages[i]['role']} -> {converted_messages[i+1]['role']}")
+class SarvamProvider(LLMProvider):
+    """Sarvam has no system role and needs strictly alternating user/assistant turns."""
 
-    payload = {
-        "model": "sarvam-m",
-        "messages": converted_messages,
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-        "top_p": 0.9,
-        "stream": stream
-    }
+    def __init__(self, name: str = "sarvam", url: str = SARVAM_API_URL, model: str = SARVAM_MODEL,
+                 api_key=None):
+        super().__init__(name, url, model, api_key if api_key is not None else SARVAM_API_KEYS)
 
-    logger.info(f"📡 Calling Sarvam API | Messages: {len(converted_messages)} | Roles: {[m['role'] for m in converted_messages]}")
+    def headers(self, api_key: str) -> dict:
+        return {"Content-Type": "application/json", "api-subscription-key": api_key}
 
-    try:
-        response = requests.post(
-            SARVAM_API_URL,
-            headers=SARVAM_HEADERS,
-            json=payload,
-            stream=stream,
-            timeout=60
-        )
+    def normalize_messages(self, messages: List[dict]) -> List[dict]:
+        system_content = None
+        user_assistant_messages = []
 
-        logger.info(f"✅ API Response Status: {response.status_code}")
+        for msg in messages:
+            if msg["role"] == "system":
+                system_content = msg["content"]
+            else:
+                user_assistant_messages.append(msg)
 
-        if response.status_code != 200:
-            logger.error(f"❌ API Error {response.status_code}: {response.text}")
+        converted_messages = []
 
-        return response
+        if user_assistant_messages:
+            first_msg = user_assistant_messages[0]
 
-    except Exception as e:
-        logger.error(f"❌ API Call Exception: {str(e)}")
-        raise
+            if first_msg["role"] == "user" and system_content:
+                converted_messages.append({
+                    "role": "user",
+                    "content": f"{system_content}\n\n---\n\n{first_msg['content']}"
+                })
+                converted_messages.extend(user_assistant_messages[1:])
+            else:
+                converted_messages = list(user_assistant_messages)
+        elif system_content:
+            converted_messages.append({
+                "role": "user",
+                "content": system_content
+            })
 
+        fixed_messages = []
+        for i, msg in enumerate(converted_messages):
+            fixed_messages.append({"role": msg["role"], "content": msg["content"]})
+            if i < len(converted_messages) - 1:
+                if msg["role"] == "user" and converted_messages[i + 1]["role"] == "user":
+                    fixed_messages.append({
+                        "role": "assistant",
+                        "content": "I understand. Please continue."
+                    })
+                elif msg["role"] == "assistant" and converted_messages[i + 1]["role"] == "assistant":
+                    fixed_messages.append({
+                        "role": "user",
+                        "content": "Continue."
+                    })
+
+        converted_messages = fixed_messages
+
+        for i in range(len(converted_messages) - 1):
+            if converted_messages[i]["role"] == converted_messages[i + 1]["role"]:
+                logger.error(
+                    f"❌ Messages not alternating at index {i}",
+                    extra={"event": "alternation_error", "fields": {
+                        "index": i, "roles": [converted_messages[i]["role"], converted_messages[i + 1]["role"]]
+                    }}
+                )
 
-# ============== Routes ==============
+        return converted_messages
 
-@api_router.get("/")
-async def api_root():
-    return {"message": "Nex.AI API is running"}
 
+class OpenAICompatibleProvider(LLMProvider):
+    """Any endpoint speaking the OpenAI chat completions protocol (system role allowed)."""
 
-@api_router.get("/health")
-async def health():
-    return {
-        "status": "healthy",
-        "sarvam_api_configured": SARVAM_API_KEY is not None,
-        "tavily_api_configured": TAVILY_API_KEY is not None,
-        "sarvam_api_url": SARVAM_API_URL
-    }
+    def headers(self, api_key: str) -> dict:
+        return {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
 
+    def normalize_messages(self, messages: List[dict]) -> List[dict]:
+        # Merge consecutive same-role turns; some OpenAI-compatible servers reject them.
+        merged = []
+        for m in messages:
+            if merged and merged[-1]["role"] == m["role"] and m["role"] != "system":
+                merged[-1] = {"role": m["role"], "content": merged[-1]["content"] + "\n\n" + m["content"]}
+            else:
+                merged.append({"role": m["role"], "content": m["content"]})
+        return merged
 
-# ---------- STREAMING CHAT ----------
-@api_router.post("/chat/stream")
-async def chat_stream(request: ChatRequest):
-    async def generate():
-        try:
-            if not SARVAM_API_KEY:
-                yield f"data: {json.dumps({'error': 'SARVAM_API_KEY not configured'})}\n\n"
-                return
 
-            last_user_msg = request.messages[-1].content if request.messages else ""
-            user_name = request.user_name
+PROVIDER_TYPES = {
+    "sarvam": SarvamProvider,
+    "openai": OpenAICompatibleProvider,
+}
 
-            if request.user_memory and request.user_memory.preferred_name:
-                user_name = request.user_memory.preferred_name
 
-            if request.active_mode and detect_mode_deactivation(last_user_msg):
-                yield f"data: {json.dumps({'mode_action': 'deactivate'})}\n\n"
-                live_context = ""
-                if needs_live_search(last_user_msg) and TAVILY_API_KEY:
-                    live_context = await search_tavily(last_user_msg)
-                system_message = get_default_prompt(user_name, request.user_memory, live_context)
-
-                messages = [{"role": "system", "content": system_message}]
-                for msg in request.messages[-25:]:
-                    messages.append({"role": msg.role, "content": msg.content})
-
-                deactivate_settings = get_mode_settings("default")
-                response = call_sarvam_api(
-                    messages,
-                    stream=True,
-                    max_tokens=deactivate_settings["max_tokens"],
-                    temperature=deactivate_settings["temperature"]
-                )
-                if response.status_code != 200:
-                    yield f"data: {json.dumps({'error': f'API Error {response.status_code}: {response.text}'})}\n\n"
-                    return
+def build_provider(config: dict) -> LLMProvider:
+    config = dict(config)
+    provider_cls = PROVIDER_TYPES[config.pop("type", "openai")]
+    api_key_env = config.pop("api_key_env", None)
+    if api_key_env:
+        # The variable may hold several comma-separated keys for the key pool
+        config["api_key"] = os.environ.get(api_key_env)
+    return provider_cls(**config)
 
-                async for chunk in _stream_response(response):
-                    yield chunk
 
-                yield f"data: {json.dumps({'done': True})}\n\n"
-                return
+class ProviderRouter:
+    """Orders providers by observed latency and health and fails over between them."""
 
-            cards = None
-            if request.active_mode == "startup":
-                spin_keywords = ["spin", "start", "play", "new game"]
-                if any(k in last_user_msg.lower() for k in spin_keywords):
-                    cards = spin_cards()
-
-            if request.active_mode == "learn":
-                system_message = get_learn_mode_prompt(user_name, request.user_memory)
-            elif request.active_mode == "english":
-                system_message = get_english_mode_prompt(user_name, request.user_memory)
-            elif request.active_mode == "startup":
-                system_message = get_startup_game_prompt(user_name, cards)
+    def __init__(self, providers: List[LLMProvider], strategy: str = LLM_ROUTING_STRATEGY):
+        self.providers = providers
+        self.strategy = strategy
+        self.stats = {
+            p.name: {"ewma_latency_ms": None, "consecutive_failures": 0, "cooldown_until": 0.0,
+                     "calls": 0, "errors": 0}
+            for p in providers
+        }
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self) -> LLMProvider:
+        return self.providers[0]
+
+    def configured(self) -> bool:
+        return any(p.configured for p in self.providers)
+
+    def ordered(self) -> List[LLMProvider]:
+        now = time.time()
+        candidates = [p for p in self.providers if p.configured]
+
+        def rank(item):
+            index, provider = item
+            stat = self.stats[provider.name]
+            cooling = stat["cooldown_until"] > now
+            if self.strategy != "latency":
+                return (cooling, False, 0.0, index)
+            # Unmeasured providers keep their configured order behind every measured one
+            unmeasured = stat["ewma_latency_ms"] is None
+            return (cooling, unmeasured, stat["ewma_latency_ms"] or 0.0, index)
+
+        return [p for _, p in sorted(enumerate(candidates), key=rank)]
+
+    def record_success(self, provider: LLMProvider, latency_ms: float) -> None:
+        with self._lock:
+            stat = self.stats[provider.name]
+            stat["calls"] += 1
+            stat["consecutive_failures"] = 0
+            stat["cooldown_until"] = 0.0
+            previous = stat["ewma_latency_ms"]
+            stat["ewma_latency_ms"] = latency_ms if previous is None else (
+                PROVIDER_EWMA_ALPHA * latency_ms + (1 - PROVIDER_EWMA_ALPHA) * previous
+            )
+        METRICS.set_gauge("provider_latency_ewma_ms", round(self.stats[provider.name]["ewma_latency_ms"], 1), provider=provider.name)
+        BROWNOUT.record_upstream(True)
+
+    def record_failure(self, provider: LLMProvider, reason: str) -> None:
+        with self._lock:
+            stat = self.stats[provider.name]
+            stat["calls"] += 1
+            stat["errors"] += 1
+            stat["consecutive_failures"] += 1
+            cooldown = min(PROVIDER_MAX_COOLDOWN, 2 ** stat["consecutive_failures"])
+            stat["cooldown_until"] = time.time() + cooldown
+        METRICS.inc("provider_failures_total", provider=provider.name)
+        BROWNOUT.record_upstream(False)
+        logger.warning(f"⚠️ Provider {provider.name} failed ({reason}); cooling down")
+
+    def call(self, messages: List[dict], stream: bool, max_tokens: int, temperature: float,
+             model: Optional[str] = None, timeout=UPSTREAM_TIMEOUT, deadline: Optional[Deadline] = None):
+        last_response = None
+        last_error = None
+        for provider in self.ordered():
+            if deadline is not None:
+                if deadline.expired():
+                    break
+                timeout = deadline.upstream_timeout(stream)
+            payload = provider.build_payload(
+                messages, stream, max_tokens, temperature, model, primary=provider is self.primary
+            )
+            logger.info(f"📡 Calling {provider.name}", extra={"event": "llm_call", "fields": {
+                "provider": provider.name, "messages": len(payload["messages"]), "stream": stream
+            }})
+            started = time.perf_counter()
+            try:
+                response = provider.send(payload, stream, timeout)
+            except Exception as e:
+                logger.error(f"❌ API Call Exception ({provider.name}): {str(e)}")
+                if deadline is not None and deadline.expired():
+                    # Our budget ran out, not the provider's fault — don't cool it down.
+                    record_deadline_miss("upstream")
+                    raise DeadlineExceeded("upstream") from e
+                self.record_failure(provider, str(e)[:100])
+                last_error = e
+                continue
+
+            logger.info(f"✅ API Response Status ({provider.name}): {response.status_code}", extra={"event": "llm_status", "fields": {
+                "provider": provider.name, "status": response.status_code,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+            }})
+            if response.status_code in RETRYABLE_STATUS:
+                log_upstream_error(provider.name, response)
+                self.record_failure(provider, f"HTTP {response.status_code}")
+                # Only the latest failed response is kept to hand back; the rest go back to the pool
+                if last_response is not None:
+                    last_response.close()
+                last_response = response
+                continue
+
+            if last_response is not None:
+                last_response.close()
+            if response.status_code == 200:
+                self.record_success(provider, (time.perf_counter() - started) * 1000)
             else:
-                live_context = ""
-                if needs_live_search(last_user_msg) and TAVILY_API_KEY:
-                    live_context = await search_tavily(last_user_msg)
-                system_message = get_default_prompt(user_name, request.user_memory, live_context)
-
-            if cards:
-                last_user_msg = (
-                    f"[🎰 GAME SPIN — Audience: {cards['audience']}, "
-                    f"Pain Point: {cards['pain_point']}, "
-                    f"Tech: {cards['tech']}]\n\n{last_user_msg}"
-                )
+                # Not worth failing over (the same request would be rejected again), but a
+                # 400/401 must not count as a healthy, fast answer either
+                log_upstream_error(provider.name, response)
+                self.record_failure(provider, f"HTTP {response.status_code}")
+            METRICS.inc("provider_calls_total", provider=provider.name)
+            response.provider = provider.name
+            return response
 
-            messages = [{"role": "system", "content": system_message}]
+        if last_response is not None:
+            return last_response
+        if last_error is not None:
+            raise last_error
+        if deadline is not None and deadline.expired():
+            record_deadline_miss("upstream")
+            raise DeadlineExceeded("upstream")
+        raise RuntimeError("No LLM provider configured")
 
-            context_limits = {"learn": 40, "startup": 30, "english": 35}
-            context_limit = context_limits.get(request.active_mode, 25)
+    def snapshot(self) -> dict:
+        return {name: dict(stat) for name, stat in self.stats.items()}
 
-            for msg in request.messages[-context_limit:]:
-                messages.append({"role": msg.role, "content": msg.content})
+    def key_usage(self) -> dict:
+        return {p.name: p.key_pool.snapshot() for p in self.providers}
 
-            if cards and messages:
-                messages[-1]["content"] = last_user_msg
 
-            logger.info(f"💬 Stream chat | mode={request.active_mode} | messages={len(messages)} | context_limit={context_limit}")
+UPSTREAM_ERROR_BODY_CHARS = 300
 
-            settings = get_mode_settings(request.active_mode)
 
-            response = call_sarvam_api(
-                messages,
-                stream=True,
-                max_tokens=settings["max_tokens"],
-                temperature=settings["temperature"]
-            )
+def log_upstream_error(provider_name: str, response) -> None:
+    logger.error(f"❌ API Error {response.status_code} ({provider_name})", extra={"event": "upstream_error", "fields": {
+        "provider": provider_name, "status": response.status_code, "body": response.text[:UPSTREAM_ERROR_BODY_CHARS]
+    }})
 
-            if response.status_code != 200:
-                yield f"data: {json.dumps({'error': f'API Error {response.status_code}: {response.text}'})}\n\n"
-                return
 
-            async for chunk in _stream_response(response):
-                yield chunk
+def load_providers() -> List[LLMProvider]:
+    raw = os.environ.get('LLM_PROVIDERS')
+    if raw:
+        try:
+            providers = [build_provider(c) for c in json.loads(raw)]
+            if providers:
+                return providers
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            logger.error(f"Invalid LLM_PROVIDERS, using Sarvam only: {e}")
+    return [SarvamProvider()]
 
-            yield f"data: {json.dumps({'done': True})}\n\n"
 
-        except Exception as e:
-            logger.error(f"❌ Chat stream error: {str(e)}", exc_info=True)
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+# Built (with each provider's key pool) by the app's lifespan, or on first use
+# by scripts and tests; never at import
+LLM_ROUTER: Optional[ProviderRouter] = None
 
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
-    )
 
+def open_llm_router() -> ProviderRouter:
+    global LLM_ROUTER
+    if LLM_ROUTER is None:
+        LLM_ROUTER = ProviderRouter(load_providers())
+    return LLM_ROUTER
 
-async def _stream_response(response):
-    """
-    Shared helper: parses SSE lines from Sarvam's streaming response
-    and yields properly formatted SSE chunks for the client.
-    """
-    buffer = ""
-    for line in response.iter_lines():
-        if line:
-            line_text = line.decode("utf-8")
 
-            if line_text.startswith("data: "):
-                data_str = line_text[6:]
-                if data_str.strip() == "[DONE]":
-                    break
-                try:
-                    chunk_data = json.loads(data_str)
-                    if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
-                        delta = chunk_data["choices"][0].get("delta", {})
-                        content = delta.get("content", "")
-                        if content:
-                            # Clean markdown before sending
-                            content = clean_markdown(content)
-                            yield f"data: {json.dumps({'word': content})}\n\n"
-                            await asyncio.sleep(0.01)
-                except json.JSONDecodeError:
-                    continue
-            else:
-                buffer += line_text
-                try:
-                    chunk_data = json.loads(buffer)
-                    if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
-                        delta = chunk_data["choices"][0].get("delta", {})
-                        content = delta.get("content", "")
-                        if content:
-                            # Clean markdown before sending
-                            content = clean_markdown(content)
-                            yield f"data: {json.dumps({'word': content})}\n\n"
-                            await asyncio.sleep(0.01)
-                    buffer = ""
-                except json.JSONDecodeError:
-                    continue
+def llm_router() -> ProviderRouter:
+    return LLM_ROUTER or open_llm_router()
 
 
-# ---------- SIMPLE (NON-STREAMING) CHAT ----------
-@api_router.post("/chat/simple")
-async def chat_simple(request: ChatRequest):
-    try:
-        if not SARVAM_API_KEY:
-            return {"error": "SARVAM_API_KEY not configured in .env file", "success": False}
-
-        last_user_msg = request.messages[-1].content if request.messages else ""
-        user_name = request.user_name
-
-        if request.user_memory and request.user_memory.preferred_name:
-            user_name = request.user_memory.preferred_name
-
-        mode_action = None
-        if request.active_mode and detect_mode_deactivation(last_user_msg):
-            mode_action = "deactivate"
-
-        if mode_action == "deactivate" or not request.active_mode:
-            live_context = ""
-            if needs_live_search(last_user_msg) and TAVILY_API_KEY:
-                live_context = await search_tavily(last_user_msg)
-            system_message = get_default_prompt(user_name, request.user_memory, live_context)
-        elif request.active_mode == "learn":
-            system_message = get_learn_mode_prompt(user_name, request.user_memory)
-        elif request.active_mode == "english":
-            system_message = get_english_mode_prompt(user_name, request.user_memory)
-        elif request.active_mode == "startup":
-            system_message = get_startup_game_prompt(user_name)
-        else:
-            live_context = ""
-            if needs_live_search(last_user_msg) and TAVILY_API_KEY:
-                live_context = await search_tavily(last_user_msg)
-            system_message = get_default_prompt(user_name, request.user_memory, live_context)
+def close_llm_router() -> None:
+    global LLM_ROUTER
+    LLM_ROUTER = None
 
-        messages = [{"role": "system", "content": system_message}]
 
-        context_limits = {"learn": 40, "startup": 30, "english": 35}
-        context_limit = context_limits.get(request.active_mode, 25)
+def call_llm(messages: List[dict], stream: bool = False, max_tokens: int = 2048, temperature: float = 0.7,
+             model: Optional[str] = None, deadline: Optional[Deadline] = None):
+    """Sends a chat completion through the provider router (fastest healthy provider, with failover)."""
+    return llm_router().call(messages, stream=stream, max_tokens=max_tokens, temperature=temperature, model=model,
+                           deadline=deadline)
 
-        for msg in request.messages[-context_limit:]:
-            messages.append({"role": msg.role, "content": msg.content})
 
-        logger.info(f"💬 Simple chat | mode={request.active_mode} | messages={len(messages)} | context_limit={context_limit}")
+# ============== Token Estimation ==============
 
-        effective_mode = None if mode_action == "deactivate" else request.active_mode
-        settings = get_mode_settings(effective_mode)
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) for when upstream usage is unavailable."""
+    if not text:
+        return 0
+    return max(1, (len(text) + 3) // 4)
 
-        response = call_sarvam_api(
-            messages,
-            stream=False,
-            max_tokens=settings["max_tokens"],
-            temperature=settings["temperature"]
-        )
 
-        if response.status_code != 200:
-            return {"error": f"API Error {response.status_code}: {response.text}", "success": False}
+def estimate_message_tokens(messages: List[dict]) -> int:
+    # ~4 tokens of role/framing overhead per message, as in OpenAI-style chat formats
+    return sum(estimate_tokens(m.get("content", "")) + 4 for m in messages)
+
+
+# ============== Token Ledger ==============
+# Prompt and completion tokens per user, conversation and mode, taken from the
+# upstream `usage` block (the final chunk when streaming) or estimated when it is
+# missing. Each user's tokens sit in one-minute buckets, so a rolling-window quota
+# (overall, and tighter per mode where configured) can be checked before any
+# upstream call. Process-local like METRICS. Routes charge quota_identity(): the
+# uid from a verified ID token, or the client address for signed-out callers.
+
+TOKEN_QUOTA_WINDOW = float(os.environ.get('TOKEN_QUOTA_WINDOW', '3600'))
+TOKEN_QUOTA_PER_USER = int(os.environ.get('TOKEN_QUOTA_PER_USER', '200000'))  # 0 disables
+DEFAULT_MODE_QUOTAS = {"learn": 120000}
+
+
+def parse_mode_quotas(value: Optional[str]) -> dict:
+    """{mode: tokens} from a JSON object; a malformed value is logged and the defaults are kept."""
+    if not value:
+        return dict(DEFAULT_MODE_QUOTAS)
+    try:
+        quotas = json.loads(value)
+        if not isinstance(quotas, dict):
+            raise ValueError("not a JSON object")
+        return {str(mode): int(tokens) for mode, tokens in quotas.items()}
+    except (ValueError, TypeError) as e:
+        logger.warning(f"Ignoring invalid TOKEN_QUOTA_BY_MODE {value!r} ({e}); using {DEFAULT_MODE_QUOTAS}")
+        return dict(DEFAULT_MODE_QUOTAS)
+
+
+TOKEN_QUOTA_BY_MODE = parse_mode_quotas(os.environ.get('TOKEN_QUOTA_BY_MODE'))
+LEDGER_BUCKET_SECONDS = 60
+LEDGER_MAX_CONVERSATIONS = int(os.environ.get('LEDGER_MAX_CONVERSATIONS', '5000'))
+LEDGER_TOP_USERS = 20
+ANONYMOUS_USER = "anonymous"
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, scope: str, limit: int, used: int, retry_after: float):
+        super().__init__(f"Token quota exceeded ({scope}: {used}/{limit} tokens per {int(TOKEN_QUOTA_WINDOW)}s)")
+        self.scope = scope
+        self.limit = limit
+        self.used = used
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+def _usage_totals() -> dict:
+    return {"prompt_tokens": 0, "completion_tokens": 0, "calls": 0, "estimated_calls": 0}
+
+
+def _add_usage(totals: dict, prompt_tokens: int, completion_tokens: int, estimated: bool) -> None:
+    totals["prompt_tokens"] += prompt_tokens
+    totals["completion_tokens"] += completion_tokens
+    totals["calls"] += 1
+    totals["estimated_calls"] += int(estimated)
+
+
+class TokenLedger:
+    def __init__(self, window: float = TOKEN_QUOTA_WINDOW, quota: int = TOKEN_QUOTA_PER_USER,
+                 mode_quotas: Optional[dict] = None, bucket: int = LEDGER_BUCKET_SECONDS):
+        self.window = window
+        self.quota = quota
+        self.mode_quotas = TOKEN_QUOTA_BY_MODE if mode_quotas is None else mode_quotas
+        self.bucket = bucket
+        self._buckets = defaultdict(deque)  # user -> deque of [bucket_start, {mode: tokens}]
+        self._modes = defaultdict(_usage_totals)
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, buckets: deque, now: float) -> None:
+        while buckets and buckets[0][0] + self.bucket <= now - self.window:
+            buckets.popleft()
+
+    def record(self, user_id: Optional[str], conversation_id: Optional[str], mode: Optional[str],
+               prompt_tokens: int, completion_tokens: int, estimated: bool = False) -> None:
+        user = user_id or ANONYMOUS_USER
+        mode = mode or "default"
+        now = time.time()
+        start = now - now % self.bucket
+        with self._lock:
+            buckets = self._buckets[user]
+            if not buckets or buckets[-1][0] != start:
+                buckets.append([start, defaultdict(int)])
+            buckets[-1][1][mode] += prompt_tokens + completion_tokens
+            self._expire(buckets, now)
+            _add_usage(self._modes[mode], prompt_tokens, completion_tokens, estimated)
+            if conversation_id:
+                entry = self._conversations.pop(conversation_id, None) or {"user_id": user, "modes": {}}
+                _add_usage(entry["modes"].setdefault(mode, _usage_totals()), prompt_tokens, completion_tokens, estimated)
+                self._conversations[conversation_id] = entry
+                while len(self._conversations) > LEDGER_MAX_CONVERSATIONS:
+                    self._conversations.popitem(last=False)
+        METRICS.inc("ledger_prompt_tokens_total", prompt_tokens, mode=mode)
+        METRICS.inc("ledger_completion_tokens_total", completion_tokens, mode=mode)
+        if estimated:
+            METRICS.inc("ledger_estimated_usage_total", mode=mode)
+
+    def _window_usage(self, user: str, now: float) -> tuple:
+        """(tokens by mode, buckets oldest first) for the user's current window. Caller holds the lock."""
+        buckets = self._buckets.get(user)
+        if not buckets:
+            return {}, []
+        self._expire(buckets, now)
+        by_mode = defaultdict(int)
+        for _, modes in buckets:
+            for mode, tokens in modes.items():
+                by_mode[mode] += tokens
+        return dict(by_mode), list(buckets)
+
+    def check(self, user_id: Optional[str], mode: Optional[str]) -> None:
+        """Raises QuotaExceeded when the user is at or over a quota that applies to this request."""
+        user = user_id or ANONYMOUS_USER
+        mode = mode or "default"
+        now = time.time()
+        with self._lock:
+            by_mode, buckets = self._window_usage(user, now)
+        for scope, limit in (("user", self.quota), (mode, self.mode_quotas.get(mode))):
+            if not limit:
+                continue
+            in_scope = (lambda modes: sum(modes.values())) if scope == "user" else (lambda modes: modes.get(mode, 0))
+            used = in_scope(by_mode)
+            if used < limit:
+                continue
+            # Retry once enough of the oldest buckets have left the window to get back under the limit
+            freed, retry_after = 0, self.window
+            for start, modes in buckets:
+                freed += in_scope(modes)
+                if used - freed < limit:
+                    retry_after = start + self.bucket + self.window - now
+                    break
+            METRICS.inc("quota_rejections_total", scope="user" if scope == "user" else "mode", mode=mode)
+            raise QuotaExceeded(scope, limit, used, retry_after)
+
+    def user_snapshot(self, user_id: str) -> dict:
+        with self._lock:
+            by_mode, _ = self._window_usage(user_id, time.time())
+            conversations = {
+                cid: entry["modes"] for cid, entry in self._conversations.items() if entry["user_id"] == user_id
+            }
+        used = sum(by_mode.values())
+        return {
+            "user_id": user_id,
+            "window_seconds": self.window,
+            "window_tokens": used,
+            "window_tokens_by_mode": by_mode,
+            "quota": self.quota or None,
+            "remaining": max(0, self.quota - used) if self.quota else None,
+            "mode_quotas": {
+                mode: {"limit": limit, "remaining": max(0, limit - by_mode.get(mode, 0))}
+                for mode, limit in self.mode_quotas.items() if limit
+            },
+            "conversations": conversations,
+        }
+
+    def snapshot(self, top: int = LEDGER_TOP_USERS) -> dict:
+        """Aggregate view for capacity planning: totals per mode and the heaviest users in the window."""
+        now = time.time()
+        with self._lock:
+            users = []
+            for user in list(self._buckets):
+                by_mode, _ = self._window_usage(user, now)
+                if not by_mode:
+                    del self._buckets[user]
+                    continue
+                users.append({"user_id": user, "window_tokens": sum(by_mode.values()), "by_mode": by_mode})
+            modes = {mode: dict(totals) for mode, totals in self._modes.items()}
+            conversations = len(self._conversations)
+        users.sort(key=lambda u: u["window_tokens"], reverse=True)
+        return {
+            "window_seconds": self.window,
+            "quota": self.quota or None,
+            "mode_quotas": self.mode_quotas,
+            "modes": modes,
+            "active_users": len(users),
+            "window_tokens": sum(u["window_tokens"] for u in users),
+            "top_users": users[:top],
+            "conversations_tracked": conversations,
+        }
+
+
+TOKEN_LEDGER = TokenLedger()
+
+
+def record_usage(request, mode: Optional[str], messages: List[dict], result: dict) -> None:
+    """Charges one upstream call to the ledger; `result` holds its text and usage, if any."""
+    usage = result.get("usage") or {}
+    prompt_tokens = usage.get("prompt_tokens")
+    completion = usage.get("completion_tokens")
+    estimated = not (prompt_tokens and completion)
+    TOKEN_LEDGER.record(
+        getattr(request, "user_id", None),
+        getattr(request, "conversation_id", None),
+        mode,
+        prompt_tokens or estimate_message_tokens(messages),
+        completion or estimate_tokens(result.get("text", "")),
+        estimated
+    )
+
+
+def quota_response(user_id: Optional[str], mode: Optional[str]) -> Optional[JSONResponse]:
+    try:
+        TOKEN_LEDGER.check(user_id, mode)
+    except QuotaExceeded as e:
+        return JSONResponse(
+            {"error": str(e), "success": False, "quota_exceeded": True, "retry_after": e.retry_after},
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    return None
+
+
+# ============== Adaptive max_tokens ==============
+# Most replies are far shorter than the per-mode ceiling. Completion lengths are
+# tracked per (mode, message class) and max_tokens is set to p99 plus headroom
+# once enough samples exist. A reply cut off at the adaptive limit is continued
+# up to the original ceiling, so users never see a shorter answer than before.
+
+ADAPTIVE_MAX_TOKENS = os.environ.get('ADAPTIVE_MAX_TOKENS', '1') == '1'
+ADAPTIVE_WINDOW = int(os.environ.get('ADAPTIVE_WINDOW', '500'))
+ADAPTIVE_MIN_SAMPLES = int(os.environ.get('ADAPTIVE_MIN_SAMPLES', '50'))
+ADAPTIVE_PERCENTILE = float(os.environ.get('ADAPTIVE_PERCENTILE', '99'))
+ADAPTIVE_HEADROOM = float(os.environ.get('ADAPTIVE_HEADROOM', '1.25'))
+ADAPTIVE_FLOOR = int(os.environ.get('ADAPTIVE_FLOOR', '256'))
+
+EXPLAIN_HINTS = ["explain", "teach", "how does", "how do", "why", "samjha", "kaise", "difference between", "step by step"]
+
+
+def classify_message(text: str) -> str:
+    """Buckets a user message by the kind of reply it usually gets."""
+    lower = text.lower().strip()
+    words = len(lower.split())
+    if any(hint in lower for hint in EXPLAIN_HINTS) or words > 40:
+        return "explain"
+    if "?" in lower or words > 8:
+        return "question"
+    return "casual"
+
+
+class CompletionStats:
+    """Rolling window of completion lengths per (mode, message class)."""
+
+    def __init__(self, window: int = ADAPTIVE_WINDOW):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, mode: Optional[str], message_class: str, tokens: int) -> None:
+        with self._lock:
+            self._samples[(mode or "default", message_class)].append(tokens)
+
+    def percentile(self, mode: Optional[str], message_class: str, pct: float) -> Optional[int]:
+        with self._lock:
+            samples = sorted(self._samples.get((mode or "default", message_class), ()))
+        if len(samples) < ADAPTIVE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+COMPLETION_STATS = CompletionStats()
+
+
+def adaptive_settings(mode: Optional[str], last_user_msg: str, profile: Optional[dict] = None) -> dict:
+    """
+    Mode settings with max_tokens lowered to the observed p99 (+headroom) and to the
+    routed profile's cap; the mode value stays the ceiling for continuations.
+    """
+    settings = dict(get_mode_settings(mode))
+    settings["model"] = None
+    ceiling = settings["max_tokens"]
+    message_class = classify_message(last_user_msg)
+    settings["ceiling"] = ceiling
+    settings["message_class"] = message_class
+
+    if ADAPTIVE_MAX_TOKENS:
+        observed = COMPLETION_STATS.percentile(mode, message_class, ADAPTIVE_PERCENTILE)
+        if observed is not None:
+            settings["max_tokens"] = min(ceiling, max(ADAPTIVE_FLOOR, int(observed * ADAPTIVE_HEADROOM)))
+            METRICS.set_gauge("adaptive_max_tokens", settings["max_tokens"], mode=mode or "default", message_class=message_class)
+
+    if profile:
+        settings["profile"] = profile["name"]
+        if profile.get("model"):
+            settings["model"] = profile["model"]
+        if profile.get("max_tokens"):
+            settings["max_tokens"] = min(settings["max_tokens"], profile["max_tokens"])
+        if profile.get("temperature") is not None:
+            settings["temperature"] = profile["temperature"]
+    return settings
+
+
+def record_completion(settings: dict, mode: Optional[str], completion_tokens: int, continued: bool) -> None:
+    label_mode = mode or "default"
+    COMPLETION_STATS.record(mode, settings["message_class"], completion_tokens)
+    METRICS.inc("completion_tokens_total", completion_tokens, mode=label_mode)
+    METRICS.inc("completions_total", mode=label_mode)
+    reserved = settings["max_tokens"] + (settings["ceiling"] - settings["max_tokens"] if continued else 0)
+    METRICS.inc("max_tokens_reserved_total", reserved, mode=label_mode)
+    METRICS.inc("max_tokens_reserved_saved_total", settings["ceiling"] - reserved, mode=label_mode)
+    if continued:
+        METRICS.inc("adaptive_continuations_total", mode=label_mode)
+
+
+def needs_continuation(settings: dict, finish_reason: Optional[str]) -> bool:
+    return finish_reason == "length" and settings["max_tokens"] < settings["ceiling"]
+
+
+def continuation_messages(messages: List[dict], partial: str) -> List[dict]:
+    """Asks the model to carry on from a reply that hit the adaptive max_tokens limit."""
+    return messages + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": "Continue exactly where you stopped. Do not repeat anything."},
+    ]
+
+
+# ============== Complexity Routing ==============
+# Each message gets a cheap local complexity score that picks a generation
+# profile. Trivial turns ("hi 👋") take a fast path with a small max_tokens and a
+# short history; real questions keep the full mode settings. Profiles are
+# checked in order and the first whose max_score covers the score wins. Null
+# fields fall back to the mode defaults. Override the table with ROUTING_TABLE
+# (a JSON string) or ROUTING_TABLE_PATH (a JSON file). Short follow-ups that
+# lean on earlier turns ("tell me more", "why?") are only as easy as what they
+# refer to, so they never take a profile that cuts the history down.
+
+ROUTING_ENABLED = os.environ.get('ROUTING_ENABLED', '1') == '1'
+
+DEFAULT_ROUTING_TABLE = [
+    {"name": "fast", "max_score": 1, "model": None, "max_tokens": 512, "temperature": 0.7,
+     "context_limit": 8, "context_tokens": 1500},
+    {"name": "standard", "max_score": 4, "model": None, "max_tokens": 2048, "temperature": None,
+     "context_limit": None, "context_tokens": None},
+    {"name": "full", "max_score": None, "model": None, "max_tokens": None, "temperature": None,
+     "context_limit": None, "context_tokens": None},
+]
+
+QUESTION_WORDS = ["what", "why", "how", "when", "where", "which", "who", "kya", "kyun", "kaise", "kab", "kaun"]
+DEPTH_HINTS = ["explain", "teach", "step by step", "in detail", "difference between", "compare", "samjhao", "samjha do"]
+CODE_PATTERN = re.compile(r"```|\bdef \w+\(|\bfunction\b|\bclass \w+|\bimport \w+|=>|;\s*$|\{\s*$|</?\w+>", re.MULTILINE)
+MODE_COMPLEXITY = {"learn": 2, "english": 1, "startup": 1}
+FOLLOW_UP_HINTS = ["tell me more", "go on", "continue", "keep going", "elaborate", "explain that", "explain this",
+                   "explain it", "what do you mean", "how so", "say that again", "you said", "the above",
+                   "aur batao", "aage batao", "matlab", "iska", "uska"]
+# Messages made only of these words make sense only as a reply to the previous answer
+FOLLOW_UP_WORDS = {"why", "how", "what", "more", "and", "then", "really", "huh", "kyun", "kaise", "kya", "phir", "aur"}
+
+router_logger = logging.getLogger("nex.router")
+
+
+def load_routing_table() -> List[dict]:
+    raw = os.environ.get('ROUTING_TABLE')
+    path = os.environ.get('ROUTING_TABLE_PATH')
+    try:
+        if raw:
+            return json.loads(raw)
+        if path:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"Invalid routing table, using defaults: {e}")
+    return DEFAULT_ROUTING_TABLE
+
+
+ROUTING_TABLE = load_routing_table()
+
+
+def is_follow_up(lower: str) -> bool:
+    """True for a message that refers back to earlier turns instead of standing on its own."""
+    words = re.sub(r"[^\w\s]", "", lower).split()
+    if words and all(w in FOLLOW_UP_WORDS for w in words):
+        return True
+    return any(re.search(rf"\b{re.escape(h)}\b", lower) for h in FOLLOW_UP_HINTS)
+
+
+def score_complexity(text: str, mode: Optional[str]) -> dict:
+    """Scores a message from local features only — no upstream calls."""
+    lower = text.lower().strip()
+    words = len(lower.split())
+    features = {
+        "length": 0 if words <= 6 else 1 if words <= 25 else 2 if words <= 80 else 3,
+        "questions": min(2, lower.count("?") + sum(1 for w in QUESTION_WORDS if re.search(rf"\b{w}\b", lower)) // 2),
+        "depth": 2 if any(h in lower for h in DEPTH_HINTS) else 0,
+        "code": 3 if CODE_PATTERN.search(text) else 0,
+        "mode": MODE_COMPLEXITY.get(mode, 0),
+        "follow_up": 2 if is_follow_up(lower) else 0,
+    }
+    return {"score": sum(features.values()), "features": features}
+
+
+def route_message(text: str, mode: Optional[str], conversation_id: Optional[str] = None) -> Optional[dict]:
+    """Picks a generation profile for the message and logs the decision for tuning."""
+    if not ROUTING_ENABLED or not ROUTING_TABLE:
+        return None
+    scored = score_complexity(text, mode)
+    follow_up = scored["features"]["follow_up"] > 0
+    profile = ROUTING_TABLE[-1]
+    for candidate in ROUTING_TABLE:
+        if follow_up and (candidate.get("context_limit") or candidate.get("context_tokens")):
+            continue
+        if candidate.get("max_score") is None or scored["score"] <= candidate["max_score"]:
+            profile = candidate
+            break
+    METRICS.inc("route_decisions_total", profile=profile["name"], mode=mode or "default")
+    router_logger.info(f"🧭 Routed to {profile['name']}", extra={"event": "route", "fields": {
+        "conversation_id": conversation_id,
+        "mode": mode or "default",
+        "profile": profile["name"],
+        "score": scored["score"],
+        "features": scored["features"],
+        "chars": len(text),
+    }})
+    return profile
+
+
+def trim_to_token_budget(history: List[dict], budget: int) -> List[dict]:
+    """Drops the oldest messages until the history fits the budget; the latest message always stays."""
+    kept = []
+    used = 0
+    for msg in reversed(history):
+        cost = estimate_tokens(msg["content"]) + 4
+        if kept and used + cost > budget:
+            break
+        kept.append(msg)
+        used += cost
+    return list(reversed(kept))
+
+
+# ============== Startup Game Sessions ==============
+# With a conversation_id, startup mode keeps its game server-side in the shared
+# cache: current cards, round number and past scores. The prompt carries that
+# compact state, so only the current round's messages go upstream instead of up
+# to 30 turns of history, and the stream and simple endpoints play the same game.
+
+GAME_SESSION_TTL = float(os.environ.get('GAME_SESSION_TTL', str(6 * 3600)))
+GAME_CONTEXT_MESSAGES = int(os.environ.get('GAME_CONTEXT_MESSAGES', '4'))
+GAME_HISTORY_ROUNDS = 5
+SPIN_PATTERN = re.compile(r"\b(spin|start|play|new game)\b", re.IGNORECASE)
+SCORE_PATTERN = re.compile(
+    r"(innovation|revenue potential|scalability|market fit)\W{0,4}(\d{1,2})\s*(?:/|out of)\s*10",
+    re.IGNORECASE
+)
+VERDICT_PATTERN = re.compile(r"BRILLIANT IDEA|NEEDS WORK|FUNDED")
+
+
+def wants_spin(text: str) -> bool:
+    # Whole words only: "start" must not fire on every pitch that mentions a "startup"
+    return bool(SPIN_PATTERN.search(text))
+
+
+def _game_key(conversation_id: str) -> str:
+    return cache_key("startup_game", conversation_id)
+
+
+def load_game_session(conversation_id: str) -> dict:
+    """A private copy of the stored session: the memory cache hands out its own object, and
+    a turn's changes must only reach the cache through save_game_session()."""
+    try:
+        session = get_cache().get(_game_key(conversation_id))
+    except Exception as e:
+        logger.warning(f"Game session read failed for {conversation_id}: {e}")
+        session = None
+    return copy.deepcopy(session) if session else {"round": 0, "cards": None, "phase": "idle", "rounds": []}
+
+
+def save_game_session(conversation_id: str, session: dict) -> None:
+    try:
+        get_cache().set(_game_key(conversation_id), session, GAME_SESSION_TTL)
+    except Exception as e:
+        logger.warning(f"Game session write failed for {conversation_id}: {e}")
+
+
+def parse_pitch_scores(reply: str) -> Optional[dict]:
+    """Scores ({category: n}) and the verdict from an evaluation reply, or None if it isn't one."""
+    scores = {}
+    for category, value in SCORE_PATTERN.findall(reply):
+        scores.setdefault(category.lower(), min(10, int(value)))
+    if len(scores) < 2:
+        return None
+    verdicts = VERDICT_PATTERN.findall(reply)
+    return {"scores": scores, "verdict": verdicts[-1] if verdicts else None}
+
+
+def start_game_turn(request: ChatRequest, last_user_msg: str) -> dict:
+    """Loads the session and deals new cards when the user asks for a spin. Nothing is saved
+    here: a turn whose upstream call fails leaves the stored round untouched."""
+    session = load_game_session(request.conversation_id)
+    spun = wants_spin(last_user_msg)
+    if spun:
+        session["round"] += 1
+        session["cards"] = spin_cards()
+        session["phase"] = "awaiting_pitch"
+    return {"conversation_id": request.conversation_id, "session": session, "spun": spun}
+
+
+def record_game_reply(game: Optional[dict], reply: str) -> None:
+    """Stores the turn's outcome: a scored pitch closes the round. Saved once the reply exists."""
+    if not game:
+        return
+    session = game["session"]
+    if session["phase"] == "awaiting_pitch" and not game["spun"]:
+        result = parse_pitch_scores(reply)
+        if result:
+            session["rounds"] = (session["rounds"] + [{"round": session["round"], **result}])[-GAME_HISTORY_ROUNDS:]
+            session["phase"] = "scored"
+            METRICS.inc("startup_rounds_scored_total")
+    save_game_session(game["conversation_id"], session)
+
+
+# ============== Turn Retrieval ==============
+# Messages older than the context window are not sent, so "that book you
+# mentioned earlier" 60 messages back used to be lost. Each conversation keeps a
+# TurnIndex: one row per older user/assistant exchange, holding a hashed,
+# L2-normalised unigram+bigram vector in a NumPy matrix. Rows are appended as
+# turns fall out of the window (tracked with the same fingerprint tail as memory
+# extraction), and each turn scores every row with one matrix-vector product.
+# The best few exchanges go into the system prompt within a token budget.
+# Indexing a long history is CPU work, so it runs in a worker thread; the
+# indexes share one row budget (a row is RETRIEVAL_DIMS float32s, 2KB) and the
+# least recently used conversations are dropped to stay under it.
+
+RETRIEVAL_ENABLED = os.environ.get('RETRIEVAL_ENABLED', 'true').lower() == 'true'
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', '3'))
+RETRIEVAL_MIN_SCORE = float(os.environ.get('RETRIEVAL_MIN_SCORE', '0.15'))
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get('RETRIEVAL_TOKEN_BUDGET', '400'))
+RETRIEVAL_MESSAGE_CHARS = 400
+RETRIEVAL_DIMS = 512
+RETRIEVAL_MAX_EXCHANGES = 2000
+RETRIEVAL_MAX_ROWS = int(os.environ.get('RETRIEVAL_MAX_ROWS', '50000'))
+
+
+def turn_vector(text: str) -> np.ndarray:
+    terms = keyword_terms(text)
+    features = terms + [f"{a} {b}" for a, b in zip(terms, terms[1:])]
+    vector = np.zeros(RETRIEVAL_DIMS, dtype=np.float32)
+    if not features:
+        return vector
+    indices = np.fromiter((zlib.crc32(f.encode("utf-8")) % RETRIEVAL_DIMS for f in features), dtype=np.int64)
+    vector += np.log1p(np.bincount(indices, minlength=RETRIEVAL_DIMS)).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def group_exchanges(messages: List[ChatMessage], offset: int = 0) -> List[tuple]:
+    """(text, end) per exchange: a user message with the replies that follow it; `end` is exclusive."""
+    exchanges = []
+    for position, m in enumerate(messages, offset + 1):
+        label = "USER" if m["role"] == "user" else "NEX"
+        line = f"{label}: {m['content'][:RETRIEVAL_MESSAGE_CHARS]}"
+        if m["role"] == "user" or not exchanges:
+            exchanges.append([line, position])
+        else:
+            exchanges[-1] = [exchanges[-1][0] + "\n" + line, position]
+    return [tuple(e) for e in exchanges]
+
+
+class TurnIndex:
+    """
+    Vectors for one conversation's older exchanges. Each row remembers where its
+    exchange ends in the history, so rows that are back inside a (wider) window
+    are skipped at search time, and the whole index shifts if the client starts
+    sending a shorter history.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._matrix = np.zeros((16, RETRIEVAL_DIMS), dtype=np.float32)
+        self._ends = np.zeros(16, dtype=np.int64)
+        self.exchanges: List[str] = []
+        self.indexed_until = 0
+        self.tail: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.exchanges)
+
+    @property
+    def rows(self) -> int:
+        """Allocated rows, which is what the index costs in memory."""
+        return len(self._matrix)
+
+    def _locate(self, messages: List[ChatMessage]) -> int:
+        """Where indexing stopped in this request's history (re-anchored on the fingerprint tail)."""
+        if not self.tail:
+            return 0
+        stored = messages[max(0, self.indexed_until - len(self.tail)):self.indexed_until]
+        if [message_fingerprint(m) for m in stored] == self.tail:
+            return self.indexed_until
+        position = unseen_messages(messages, self.tail)
+        if position == 0:
+            # Tail not found: history was edited or replaced client-side, so rebuild
+            self._reset()
+            METRICS.inc("retrieval_rebuilds_total")
+            return 0
+        if position != self.indexed_until:
+            self._ends[:len(self.exchanges)] += position - self.indexed_until
+            self.indexed_until = position
+        return position
+
+    def update(self, messages: List[ChatMessage], cutoff: int) -> int:
+        """Indexes complete exchanges before `cutoff` that are not indexed yet; returns how many were added."""
+        start = self._locate(messages)
+        end = cutoff
+        if end > start and messages[end - 1]["role"] == "user":
+            end -= 1  # its reply is still in the window; index the exchange once it's complete
+        if end <= start:
+            return 0
+        new = group_exchanges(messages[start:end], start)[-RETRIEVAL_MAX_EXCHANGES:]
+        size = len(self.exchanges)
+        if size + len(new) > RETRIEVAL_MAX_EXCHANGES:
+            # Full: the oldest exchanges make room
+            drop = size + len(new) - RETRIEVAL_MAX_EXCHANGES
+            self._matrix[:size - drop] = self._matrix[drop:size]
+            self._ends[:size - drop] = self._ends[drop:size]
+            self.exchanges = self.exchanges[drop:]
+            size -= drop
+        if size + len(new) > len(self._matrix):
+            capacity = min(max(size + len(new), 2 * len(self._matrix)), RETRIEVAL_MAX_EXCHANGES)
+            matrix = np.zeros((capacity, RETRIEVAL_DIMS), dtype=np.float32)
+            matrix[:size] = self._matrix[:size]
+            ends = np.zeros(capacity, dtype=np.int64)
+            ends[:size] = self._ends[:size]
+            self._matrix, self._ends = matrix, ends
+        self._matrix[size:size + len(new)] = np.vstack([turn_vector(text) for text, _ in new])
+        self._ends[size:size + len(new)] = [e for _, e in new]
+        self.exchanges.extend(text for text, _ in new)
+        self.indexed_until = end
+        self.tail = [message_fingerprint(m) for m in messages[max(0, end - MEMORY_HWM_TAIL):end]]
+        METRICS.inc("retrieval_exchanges_indexed_total", len(new))
+        return len(new)
+
+    def search(self, query: str, cutoff: int, top_k: int = RETRIEVAL_TOP_K,
+               min_score: float = RETRIEVAL_MIN_SCORE) -> List[tuple]:
+        """(score, exchange) for the best matches that end before `cutoff`, in conversation order."""
+        size = len(self.exchanges)
+        if not size:
+            return []
+        scores = self._matrix[:size] @ turn_vector(query)
+        scores[self._ends[:size] > cutoff] = -1.0
+        k = min(top_k, size)
+        best = np.argpartition(-scores, k - 1)[:k]
+        return [(float(scores[i]), self.exchanges[i]) for i in sorted(int(i) for i in best if scores[i] >= min_score)]
+
+
+TURN_INDEXES: "OrderedDict[str, TurnIndex]" = OrderedDict()
+TURN_INDEXES_LOCK = threading.Lock()
+
+
+def turn_index(conversation_id: Optional[str]) -> TurnIndex:
+    """The conversation's index (most recently used last); requests without an id get a throwaway one."""
+    if not conversation_id:
+        return TurnIndex()
+    with TURN_INDEXES_LOCK:
+        index = TURN_INDEXES.pop(conversation_id, None) or TurnIndex()
+        TURN_INDEXES[conversation_id] = index
+    return index
+
+
+def trim_turn_indexes(limit: int = RETRIEVAL_MAX_ROWS) -> int:
+    """Drops least recently used indexes until all of them fit in `limit` rows; returns how many were dropped."""
+    dropped = 0
+    with TURN_INDEXES_LOCK:
+        rows = sum(index.rows for index in TURN_INDEXES.values())
+        # The most recent index always stays, even if it alone is over the budget
+        while rows > limit and len(TURN_INDEXES) > 1:
+            _, index = TURN_INDEXES.popitem(last=False)
+            rows -= index.rows
+            dropped += 1
+        METRICS.set_gauge("retrieval_index_rows", rows)
+    if dropped:
+        METRICS.inc("retrieval_evictions_total", dropped)
+    return dropped
+
+
+def retrieve_older_turns(conversation_id: Optional[str], messages: List[ChatMessage], cutoff: int, query: str,
+                         budget: int = RETRIEVAL_TOKEN_BUDGET) -> str:
+    """
+    A prompt block with the exchanges before `cutoff` (the start of the recent
+    window) most relevant to `query`, or "" when none qualify. Blocking: call it
+    through asyncio.to_thread from the request path.
+    """
+    if not RETRIEVAL_ENABLED or cutoff <= 0 or not query.strip():
+        return ""
+    started = time.perf_counter()
+    index = turn_index(conversation_id)
+    with index.lock:
+        if index.update(messages, cutoff):
+            trim_turn_indexes()
+        results = index.search(query, cutoff)
+    picked, spent = [], 0
+    for score, exchange in results:
+        cost = estimate_tokens(exchange)
+        if spent + cost > budget:
+            continue
+        picked.append(exchange)
+        spent += cost
+    METRICS.inc("retrieval_seconds_total", time.perf_counter() - started)
+    METRICS.inc("retrievals_total")
+    if not picked:
+        return ""
+    METRICS.inc("retrieval_hits_total", len(picked))
+    METRICS.inc("retrieval_tokens_total", spent)
+    return (
+        "\n\nEARLIER IN THIS CONVERSATION (older messages that relate to the latest one — "
+        "use them if the user refers back):\n" + "\n---\n".join(picked)
+    )
+
+
+# ============== Chat Pipeline ==============
+
+CONTEXT_LIMITS = {"learn": 40, "startup": 30, "english": 35}
+DEFAULT_CONTEXT_LIMIT = 25
+
+
+async def prepare_chat(request: ChatRequest, allow_spin: bool = True, deadline: Optional[Deadline] = None) -> dict:
+    """
+    Builds everything needed for one upstream call: the system prompt for the
+    effective mode, the trimmed history and the generation settings.
+    Shared by the chat endpoints and the replay harness so both send identical payloads.
+    """
+    last_user_msg = request.messages[-1]["content"] if request.messages else ""
+    user_name = request.user_name
+
+    if request.user_memory and request.user_memory.preferred_name:
+        user_name = request.user_memory.preferred_name
+
+    mode_action = None
+    if request.active_mode and detect_mode_deactivation(last_user_msg):
+        mode_action = "deactivate"
+    mode = None if mode_action == "deactivate" else request.active_mode
+
+    cards = None
+    game = None
+    if allow_spin and mode == "startup":
+        if request.conversation_id:
+            game = start_game_turn(request, last_user_msg)
+            if game["spun"]:
+                cards = game["session"]["cards"]
+        elif wants_spin(last_user_msg):
+            cards = spin_cards()
+
+    # The startup game prompts don't use memory; every other prompt gets the relevant slice
+    memory = None if mode == "startup" else select_memory(request.user_memory, last_user_msg)
+    if mode == "learn":
+        system_message = get_learn_mode_prompt(user_name, memory)
+    elif mode == "english":
+        system_message = get_english_mode_prompt(user_name, memory)
+    elif mode == "startup" and game:
+        system_message = get_startup_session_prompt(user_name, game["session"])
+    elif mode == "startup":
+        system_message = get_startup_game_prompt(user_name, cards)
+    else:
+        live_context = ""
+        if needs_live_search(last_user_msg) and TAVILY_API_KEY and not BROWNOUT.active(LEVEL_NO_SEARCH, "search"):
+            timeout = deadline.share(SEARCH_DEADLINE_SHARE, SEARCH_TIMEOUT) if deadline else None
+            live_context = await search_tavily(last_user_msg, timeout)
+        system_message = get_default_prompt(user_name, memory, live_context)
+
+    profile = route_message(last_user_msg, mode, request.conversation_id)
+
+    context_limit = CONTEXT_LIMITS.get(mode, DEFAULT_CONTEXT_LIMIT)
+    if profile and profile.get("context_limit"):
+        context_limit = min(context_limit, profile["context_limit"])
+    if game:
+        context_limit = min(context_limit, GAME_CONTEXT_MESSAGES)
+    reduced = BROWNOUT.active(LEVEL_REDUCED, "context")
+    if reduced:
+        context_limit = BROWNOUT.shrink(context_limit, floor=4)
+
+    history = request.messages[-context_limit:]
+    if profile and profile.get("context_tokens"):
+        history = trim_to_token_budget(history, profile["context_tokens"])
+
+    if mode != "startup":
+        cutoff = len(request.messages) - len(history)
+        system_message += await asyncio.to_thread(
+            retrieve_older_turns, request.conversation_id, request.messages, cutoff, last_user_msg
+        )
+
+    messages = [{"role": "system", "content": system_message}] + history
+
+    if cards and len(messages) > 1:
+        # New dict: the request's own message is still persisted as the user typed it
+        messages[-1] = {
+            "role": messages[-1]["role"],
+            "content": (
+                f"[🎰 GAME SPIN — Audience: {cards['audience']}, "
+                f"Pain Point: {cards['pain_point']}, "
+                f"Tech: {cards['tech']}]\n\n{last_user_msg}"
+            ),
+        }
+
+    settings = adaptive_settings(mode, last_user_msg, profile)
+    if reduced:
+        settings["max_tokens"] = BROWNOUT.shrink(settings["max_tokens"], floor=ADAPTIVE_FLOOR)
+        settings["ceiling"] = settings["max_tokens"]
+
+    return {
+        "messages": messages,
+        "settings": settings,
+        "mode": mode,
+        "mode_action": mode_action,
+        "context_limit": context_limit,
+        "cards": cards,
+        "game": game,
+    }
+
+
+# ============== Upstream Health & Warm-up ==============
+# Probes run in the background and their results are cached, so liveness and
+# readiness checks never touch the network themselves.
+
+HEALTH_REFRESH_INTERVAL = float(os.environ.get('HEALTH_REFRESH_INTERVAL', '30'))
+HEALTH_PROBE_TIMEOUT = float(os.environ.get('HEALTH_PROBE_TIMEOUT', '5'))
+HEALTH_STALE_AFTER = HEALTH_REFRESH_INTERVAL * 3
+WARMUP_MODULES = ["tavily"]
+
+# Provider URLs are added by register_upstreams once the router is built
+UPSTREAMS = {"tavily": TAVILY_API_URL}
+UPSTREAM_HEALTH = {}
+WARMUP_STATE = {"done": False, "started_at": None, "finished_at": None, "modules": {}}
+_health_task: Optional[asyncio.Task] = None
+
+
+def probe_upstream(name: str, url: str) -> dict:
+    """Opens (or reuses) a pooled connection to the upstream and times a HEAD request.
+    Any HTTP response counts as reachable — auth and method errors still prove the path works."""
+    started = time.perf_counter()
+    try:
+        upstream_session().head(url, timeout=HEALTH_PROBE_TIMEOUT, allow_redirects=False)
+        result = {"reachable": True, "error": None}
+    except Exception as e:
+        result = {"reachable": False, "error": str(e)[:200]}
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    result["checked_at"] = time.time()
+    UPSTREAM_HEALTH[name] = result
+    return result
+
+
+def resolve_upstream_dns() -> None:
+    for url in UPSTREAMS.values():
+        host = urlparse(url).hostname
+        try:
+            socket.getaddrinfo(host, 443)
+        except OSError as e:
+            logger.warning(f"DNS warm-up failed for {host}: {e}")
+
+
+def preload_modules(modules: List[str]) -> None:
+    for module in modules:
+        try:
+            importlib.import_module(module)
+            WARMUP_STATE["modules"][module] = True
+        except ImportError:
+            WARMUP_STATE["modules"][module] = False
+            logger.warning(f"Optional module '{module}' is not installed")
+
+
+async def refresh_upstream_health() -> None:
+    await asyncio.gather(*[
+        asyncio.to_thread(probe_upstream, name, url) for name, url in UPSTREAMS.items()
+    ])
+
+
+async def warm_up(modules: List[str]) -> None:
+    """Preloads lazily imported modules while resolving DNS, then opens pooled upstream connections."""
+    WARMUP_STATE["started_at"] = time.time()
+    await asyncio.gather(asyncio.to_thread(resolve_upstream_dns), asyncio.to_thread(preload_modules, modules))
+    await refresh_upstream_health()
+    WARMUP_STATE["done"] = True
+    WARMUP_STATE["finished_at"] = time.time()
+    logger.info(f"🔥 Warm-up finished in {WARMUP_STATE['finished_at'] - WARMUP_STATE['started_at']:.2f}s | upstreams={UPSTREAM_HEALTH}")
+
+
+async def upstream_health_loop(modules: List[str]) -> None:
+    try:
+        await warm_up(modules)
+    except Exception as e:
+        logger.error(f"Warm-up failed: {e}", exc_info=True)
+    while True:
+        await asyncio.sleep(HEALTH_REFRESH_INTERVAL)
+        try:
+            await refresh_upstream_health()
+        except Exception as e:
+            logger.error(f"Upstream health refresh failed: {e}")
+
+
+def readiness_report() -> dict:
+    now = time.time()
+    router = llm_router()
+    llm_health = [
+        UPSTREAM_HEALTH[p.name] for p in router.providers if p.configured and p.name in UPSTREAM_HEALTH
+    ]
+    mock_only = all(p.name not in UPSTREAM_HEALTH for p in router.providers if p.configured)
+    checks = {
+        "warmed_up": WARMUP_STATE["done"],
+        "llm_configured": router.configured(),
+        "llm_reachable": mock_only or any(h["reachable"] for h in llm_health),
+        "llm_health_fresh": mock_only or any(
+            h["checked_at"] is not None and now - h["checked_at"] < HEALTH_STALE_AFTER for h in llm_health
+        ),
+    }
+    return {
+        "ready": all(checks.values()),
+        "checks": checks,
+        "upstreams": UPSTREAM_HEALTH,
+    }
+
+
+def register_upstreams(router: ProviderRouter) -> None:
+    for provider in router.providers:
+        if provider.url.startswith("http"):
+            UPSTREAMS[provider.name] = provider.url
+    for name in UPSTREAMS:
+        UPSTREAM_HEALTH.setdefault(name, {"reachable": None, "latency_ms": None, "checked_at": None, "error": None})
+
+
+async def start_upstream_health(modules: List[str]):
+    global _health_task
+    register_upstreams(llm_router())
+    _health_task = asyncio.create_task(upstream_health_loop(modules))
+
+
+async def stop_upstream_health():
+    if _health_task:
+        _health_task.cancel()
+
+
+# ============== Auth ==============
+# Routes that read or write a user's stored data take the caller's identity from
+# a Firebase ID token (Authorization: Bearer <token>), never from the request
+# body, and then apply the same ownership rules as firestore.rules. Verified
+# tokens are cached until they expire, so a user pays for verification once;
+# rejected tokens are remembered briefly so a bad token cannot force a Firebase
+# round trip per request. Signed-out callers are identified by address: the peer,
+# or behind a TRUSTED_PROXIES hop, the client it forwarded for.
+
+FIREBASE_CREDENTIALS = os.environ.get('FIREBASE_CREDENTIALS')
+AUTH_CACHE_MAX = int(os.environ.get('AUTH_CACHE_MAX', '4096'))
+AUTH_REJECTED_TTL = float(os.environ.get('AUTH_REJECTED_TTL', '60'))
+VERIFIED_TOKENS = LRUCache(max_entries=AUTH_CACHE_MAX)
+REJECTED_TOKENS = LRUCache(max_entries=AUTH_CACHE_MAX)
+
+
+def parse_trusted_proxies(value: str) -> list:
+    """Networks from a comma-separated list of addresses/CIDRs; bad entries are logged and skipped."""
+    networks = []
+    for entry in filter(None, (e.strip() for e in value.split(','))):
+        try:
+            networks.append(ipaddress.ip_network(entry, strict=False))
+        except ValueError:
+            logger.warning(f"⚠️ Ignoring invalid TRUSTED_PROXIES entry '{entry}'")
+    return networks
+
+
+TRUSTED_PROXIES = parse_trusted_proxies(os.environ.get('TRUSTED_PROXIES', ''))
+
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def client_address(http_request: Request) -> str:
+    """
+    The caller's IP address. X-Forwarded-For is only believed when the peer is a
+    trusted proxy, and then read right to left up to the first untrusted hop, so
+    a client cannot pick its own address by sending the header itself.
+    """
+    peer = http_request.client.host if http_request.client else "unknown"
+    if not _is_trusted_proxy(peer):
+        return peer
+    hops = [h.strip() for h in ",".join(http_request.headers.getlist("x-forwarded-for")).split(",") if h.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+
+class AccessDenied(Exception):
+    def __init__(self, message: str, status_code: int = 403):
+        super().__init__(message)
+        self.status_code = status_code
+
+    def response(self) -> JSONResponse:
+        return JSONResponse({"error": str(self), "success": False}, status_code=self.status_code)
+
+
+def firebase_app():
+    """Initialises firebase-admin once, from FIREBASE_CREDENTIALS or application default credentials."""
+    import firebase_admin
+    from firebase_admin import credentials
+
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(FIREBASE_CREDENTIALS) if FIREBASE_CREDENTIALS else credentials.ApplicationDefault()
+        firebase_admin.initialize_app(cred)
+    return firebase_admin.get_app()
+
+
+def verify_firebase_token(token: str) -> dict:
+    """The claims of a valid Firebase ID token; raises on invalid, expired or foreign tokens."""
+    from firebase_admin import auth
+
+    return auth.verify_id_token(token, app=firebase_app())
+
+
+_token_verifier = verify_firebase_token
+
+
+def set_token_verifier(verifier) -> None:
+    global _token_verifier
+    _token_verifier = verifier
+
+
+def check_auth_config() -> None:
+    """
+    Refuses to start when token quotas are on but ID tokens cannot be verified:
+    every caller would then be charged by address, which is not what the quotas
+    are configured for.
+    """
+    if not (TOKEN_LEDGER.quota or any(TOKEN_LEDGER.mode_quotas.values())):
+        return
+    if _token_verifier is not verify_firebase_token:
+        return
+    if importlib.util.find_spec("firebase_admin") is None:
+        problem = "firebase-admin is not installed"
+    elif not (FIREBASE_CREDENTIALS or os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')):
+        problem = "FIREBASE_CREDENTIALS is not set"
+    else:
+        return
+    raise RuntimeError(
+        f"Token quotas are enabled but {problem}, so ID tokens cannot be verified. "
+        f"Configure Firebase, or disable quotas with TOKEN_QUOTA_PER_USER=0 and TOKEN_QUOTA_BY_MODE={{}}."
+    )
+
+
+async def authenticated_user(http_request: Request) -> Optional[str]:
+    """The uid behind the request's bearer token, or None when there is no valid token."""
+    scheme, _, token = http_request.headers.get("authorization", "").partition(" ")
+    token = token.strip()
+    if scheme.lower() != "bearer" or not token:
+        return None
+    key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    uid = VERIFIED_TOKENS.get(key)
+    if uid:
+        return uid
+    if REJECTED_TOKENS.get(key):
+        METRICS.inc("auth_rejected_cached_total")
+        return None
+    try:
+        claims = await asyncio.to_thread(_token_verifier, token)
+    except ImportError:
+        logger.error("❌ firebase-admin is not installed; ID tokens cannot be verified")
+        return None
+    except Exception as e:
+        METRICS.inc("auth_rejected_total")
+        logger.warning(f"🔒 Rejected ID token: {type(e).__name__}")
+        REJECTED_TOKENS.set(key, True, ttl=AUTH_REJECTED_TTL)
+        return None
+    uid = claims.get("uid") or claims.get("sub")
+    if not uid:
+        REJECTED_TOKENS.set(key, True, ttl=AUTH_REJECTED_TTL)
+        return None
+    ttl = float(claims.get("exp", 0)) - time.time()
+    if ttl > 0:
+        VERIFIED_TOKENS.set(key, uid, ttl=ttl)
+    return uid
+
+
+async def require_user(http_request: Request, claimed_user_id: Optional[str] = None) -> str:
+    """The caller's uid; a user_id the client sent must match it."""
+    uid = await authenticated_user(http_request)
+    if uid is None:
+        raise AccessDenied("Sign-in required: send a Firebase ID token as 'Authorization: Bearer <token>'", 401)
+    if claimed_user_id and claimed_user_id != uid:
+        raise AccessDenied("user_id does not match the signed-in user")
+    return uid
+
+
+async def quota_identity(http_request: Request, claimed_user_id: Optional[str] = None) -> str:
+    """
+    Who the token ledger charges for a request: the signed-in uid, otherwise the
+    client's address. An unauthenticated user_id is ignored, so a client cannot
+    pick a fresh identity (or none at all) to get a fresh quota.
+    """
+    uid = await authenticated_user(http_request)
+    if uid is None:
+        return f"ip:{client_address(http_request)}"
+    if claimed_user_id and claimed_user_id != uid:
+        raise AccessDenied("user_id does not match the signed-in user")
+    return uid
+
+
+# ============== Persistence ==============
+# Messages and conversations are saved by the backend as part of the chat request
+# instead of one Firestore round trip per message from the browser. Writes go into
+# a write-behind buffer that a background task flushes in batches, so the chat hot
+# path never waits on storage. "sqlite" (default) keeps everything in a local WAL
+# database; "firestore" writes the same documents the frontend uses.
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite').lower()
+STORAGE_PATH = os.environ.get('STORAGE_PATH', str(ROOT_DIR / 'data' / 'nex.sqlite3'))
+STORAGE_FLUSH_INTERVAL = float(os.environ.get('STORAGE_FLUSH_INTERVAL', '0.5'))
+STORAGE_FLUSH_BATCH = int(os.environ.get('STORAGE_FLUSH_BATCH', '200'))
+STORAGE_MAX_PENDING = int(os.environ.get('STORAGE_MAX_PENDING', '20000'))
+
+
+class StorageBackend(ABC):
+    """Durable store for conversations and messages. Writes always arrive in batches."""
+
+    @abstractmethod
+    def write_batch(self, conversations: List[dict], messages: List[dict]) -> None:
+        ...
+
+    @abstractmethod
+    def get_conversation(self, conversation_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def list_conversations(self, user_id: str, limit: int, before: Optional[tuple] = None) -> List[dict]:
+        """A user's conversations, most recently active first, older than the (last_message_at, id) cursor."""
+
+    @abstractmethod
+    def list_messages(self, conversation_id: str, limit: int, before: Optional[tuple] = None) -> List[dict]:
+        """A conversation's messages, newest first, older than the (timestamp, id) cursor."""
+
+    @abstractmethod
+    def delete_conversation(self, conversation_id: str) -> None:
+        """Removes the conversation and all of its messages."""
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteStorage(StorageBackend):
+    """Conversations and messages in a local WAL-mode SQLite file; each batch is one transaction."""
+
+    def __init__(self, path: str = STORAGE_PATH):
+        self.path = path
+        self._local = threading.local()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "id TEXT PRIMARY KEY, user_id TEXT, title TEXT, created_at REAL, last_message_at REAL);"
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id TEXT PRIMARY KEY, conversation_id TEXT NOT NULL, user_id TEXT, "
+            "role TEXT NOT NULL, content TEXT NOT NULL, timestamp REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, timestamp, id);"
+            "CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations (user_id, last_message_at);"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def write_batch(self, conversations: List[dict], messages: List[dict]) -> None:
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT INTO conversations (id, user_id, title, created_at, last_message_at) "
+                "VALUES (:id, :user_id, :title, COALESCE(:created_at, :last_message_at), :last_message_at) "
+                "ON CONFLICT(id) DO UPDATE SET "
+                "user_id = COALESCE(excluded.user_id, conversations.user_id), "
+                "title = COALESCE(excluded.title, conversations.title), "
+                "last_message_at = MAX(COALESCE(conversations.last_message_at, 0), COALESCE(excluded.last_message_at, 0))",
+                conversations
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO messages (id, conversation_id, user_id, role, content, timestamp) "
+                "VALUES (:id, :conversation_id, :user_id, :role, :content, :timestamp)",
+                messages
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_conversation(self, conversation_id: str) -> Optional[dict]:
+        row = self._conn().execute(
+            "SELECT id, user_id, title, created_at, last_message_at FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "user_id": row[1], "title": row[2], "created_at": row[3], "last_message_at": row[4]}
+
+    # Keyset pagination: every page is a range scan on the composite index, so
+    # page 40 of a long chat costs the same as page 1 (no OFFSET).
+    def list_conversations(self, user_id: str, limit: int, before: Optional[tuple] = None) -> List[dict]:
+        sql = "SELECT id, user_id, title, created_at, last_message_at FROM conversations WHERE user_id = ?"
+        params = [user_id]
+        if before:
+            sql += " AND (last_message_at, id) < (?, ?)"
+            params.extend(before)
+        sql += " ORDER BY last_message_at DESC, id DESC LIMIT ?"
+        params.append(limit)
+        rows = self._conn().execute(sql, params).fetchall()
+        return [
+            {"id": r[0], "user_id": r[1], "title": r[2], "created_at": r[3], "last_message_at": r[4]}
+            for r in rows
+        ]
+
+    def list_messages(self, conversation_id: str, limit: int, before: Optional[tuple] = None) -> List[dict]:
+        sql = "SELECT id, conversation_id, user_id, role, content, timestamp FROM messages WHERE conversation_id = ?"
+        params = [conversation_id]
+        if before:
+            sql += " AND (timestamp, id) < (?, ?)"
+            params.extend(before)
+        sql += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        params.append(limit)
+        rows = self._conn().execute(sql, params).fetchall()
+        return [
+            {"id": r[0], "conversation_id": r[1], "user_id": r[2], "role": r[3], "content": r[4], "timestamp": r[5]}
+            for r in rows
+        ]
+
+    def delete_conversation(self, conversation_id: str) -> None:
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class FirestoreStorage(StorageBackend):
+    """Writes the frontend's `conversations` / `messages` documents with batched commits (needs firebase-admin)."""
+
+    MAX_BATCH_WRITES = 500
+
+    def __init__(self):
+        from firebase_admin import firestore
+
+        self.db = firestore.client(firebase_app())
+
+    def write_batch(self, conversations: List[dict], messages: List[dict]) -> None:
+        writes = []
+        for c in conversations:
+            data = {"lastMessageAt": _to_datetime(c["last_message_at"])}
+            if c.get("user_id"):
+                data["userId"] = c["user_id"]
+            if c.get("title") is not None:
+                data["title"] = c["title"]
+            if c.get("created_at") is not None:
+                data["createdAt"] = _to_datetime(c["created_at"])
+            writes.append((self.db.collection("conversations").document(c["id"]), data))
+        for m in messages:
+            writes.append((self.db.collection("messages").document(m["id"]), {
+                "conversationId": m["conversation_id"],
+                "userId": m["user_id"],
+                "role": m["role"],
+                "content": m["content"],
+                "timestamp": _to_datetime(m["timestamp"]),
+            }))
+        for start in range(0, len(writes), self.MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for ref, data in writes[start:start + self.MAX_BATCH_WRITES]:
+                batch.set(ref, data, merge=True)
+            batch.commit()
+
+    def get_conversation(self, conversation_id: str) -> Optional[dict]:
+        doc = self.db.collection("conversations").document(conversation_id).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        return {
+            "id": doc.id,
+            "user_id": data.get("userId"),
+            "title": data.get("title"),
+            "created_at": _to_timestamp(data.get("createdAt")),
+            "last_message_at": _to_timestamp(data.get("lastMessageAt")),
+        }
+
+    # These queries need the same composite indexes the frontend's ordered queries use.
+    def list_conversations(self, user_id: str, limit: int, before: Optional[tuple] = None) -> List[dict]:
+        from firebase_admin import firestore
+
+        collection = self.db.collection("conversations")
+        q = (collection
+             .where("userId", "==", user_id)
+             .order_by("lastMessageAt", direction=firestore.Query.DESCENDING)
+             .order_by(firestore.FieldPath.document_id(), direction=firestore.Query.DESCENDING))
+        if before:
+            # The document id breaks ties, so rows sharing a timestamp are not skipped
+            q = q.start_after({"lastMessageAt": _to_datetime(before[0]), "__name__": collection.document(before[1])})
+        docs = q.limit(limit).stream()
+        return [
+            {
+                "id": d.id,
+                "user_id": data.get("userId"),
+                "title": data.get("title"),
+                "created_at": _to_timestamp(data.get("createdAt")),
+                "last_message_at": _to_timestamp(data.get("lastMessageAt")),
+            }
+            for d in docs for data in [d.to_dict()]
+        ]
+
+    def list_messages(self, conversation_id: str, limit: int, before: Optional[tuple] = None) -> List[dict]:
+        from firebase_admin import firestore
+
+        collection = self.db.collection("messages")
+        q = (collection
+             .where("conversationId", "==", conversation_id)
+             .order_by("timestamp", direction=firestore.Query.DESCENDING)
+             .order_by(firestore.FieldPath.document_id(), direction=firestore.Query.DESCENDING))
+        if before:
+            q = q.start_after({"timestamp": _to_datetime(before[0]), "__name__": collection.document(before[1])})
+        docs = q.limit(limit).stream()
+        return [
+            {
+                "id": d.id,
+                "conversation_id": conversation_id,
+                "user_id": data.get("userId"),
+                "role": data.get("role"),
+                "content": data.get("content"),
+                "timestamp": _to_timestamp(data.get("timestamp")),
+            }
+            for d in docs for data in [d.to_dict()]
+        ]
+
+    def delete_conversation(self, conversation_id: str) -> None:
+        refs = [d.reference for d in self.db.collection("messages").where("conversationId", "==", conversation_id).stream()]
+        refs.append(self.db.collection("conversations").document(conversation_id))
+        for start in range(0, len(refs), self.MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for ref in refs[start:start + self.MAX_BATCH_WRITES]:
+                batch.delete(ref)
+            batch.commit()
+
+
+def _to_datetime(ts: Optional[float]):
+    return datetime.fromtimestamp(ts, tz=timezone.utc) if ts is not None else None
+
+
+def _to_timestamp(value) -> Optional[float]:
+    return value.timestamp() if value is not None else None
+
+
+STORAGE_BACKENDS = {
+    "sqlite": SQLiteStorage,
+    "firestore": FirestoreStorage,
+}
+
+_storage: Optional[StorageBackend] = None
+
+
+def get_storage() -> StorageBackend:
+    """Returns the configured storage backend, creating it on first use."""
+    global _storage
+    if _storage is None:
+        backend_cls = STORAGE_BACKENDS.get(STORAGE_BACKEND)
+        if backend_cls is None:
+            logger.warning(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', falling back to sqlite")
+            backend_cls = SQLiteStorage
+        try:
+            _storage = backend_cls()
+        except ImportError:
+            logger.warning(f"STORAGE_BACKEND '{STORAGE_BACKEND}' needs a package that is not installed, falling back to sqlite")
+            _storage = SQLiteStorage()
+    return _storage
+
+
+def set_storage(backend: StorageBackend) -> None:
+    global _storage
+    _storage = backend
+
+
+class WriteBehindBuffer:
+    """
+    Collects conversation and message writes in memory and flushes them to storage
+    every STORAGE_FLUSH_INTERVAL seconds, or sooner once STORAGE_FLUSH_BATCH writes
+    are pending. A failed flush puts its writes back for the next attempt; beyond
+    STORAGE_MAX_PENDING the oldest messages are dropped rather than growing forever.
+    """
+
+    def __init__(self):
+        self._conversations = {}
+        self._messages = []
+        self._lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._conversations) + len(self._messages)
+
+    def pending_conversation(self, conversation_id: str) -> Optional[dict]:
+        with self._lock:
+            record = self._conversations.get(conversation_id)
+            return dict(record) if record else None
+
+    def add_conversation(self, conversation_id: str, user_id: Optional[str] = None, title: Optional[str] = None) -> None:
+        now = time.time()
+        with self._lock:
+            _merge_conversation(self._conversations, {
+                "id": conversation_id,
+                "user_id": user_id,
+                "title": title,
+                "created_at": now,
+                "last_message_at": now,
+            })
+        self._after_write()
+
+    def add_messages(self, conversation_id: str, user_id: Optional[str], messages: List[dict]) -> List[str]:
+        """Queues messages ({role, content, id?, timestamp?}) and touches their conversation. Returns the message ids."""
+        now = time.time()
+        rows = [
+            {
+                "id": m.get("id") or uuid.uuid4().hex,
+                "conversation_id": conversation_id,
+                "user_id": user_id,
+                "role": m["role"],
+                "content": m["content"],
+                "timestamp": m.get("timestamp") or now,
+            }
+            for m in messages
+        ]
+        if not rows:
+            return []
+        with self._lock:
+            self._messages.extend(rows)
+            _merge_conversation(self._conversations, {
+                "id": conversation_id,
+                "user_id": user_id,
+                "title": None,
+                "created_at": None,
+                "last_message_at": max(r["timestamp"] for r in rows),
+            })
+        remember_messages(conversation_id, rows)
+        self._after_write()
+        return [r["id"] for r in rows]
+
+    def _after_write(self) -> None:
+        pending = self.pending()
+        METRICS.set_gauge("storage_pending_writes", pending)
+        if self._wakeup is not None and pending >= STORAGE_FLUSH_BATCH:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """Writes everything pending in one batch. Returns the number of messages written."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            with self._lock:
+                conversations = list(self._conversations.values())
+                messages = self._messages
+                self._conversations = {}
+                self._messages = []
+            if not conversations and not messages:
+                return 0
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(get_storage().write_batch, conversations, messages)
+            except Exception as e:
+                logger.error(f"❌ Storage flush failed ({len(messages)} messages), will retry: {e}")
+                METRICS.inc("storage_flush_failures")
+                self._requeue(conversations, messages)
+                return 0
+            METRICS.inc("storage_flushes")
+            METRICS.inc("storage_messages_written", len(messages))
+            METRICS.set_gauge("storage_last_flush_ms", round((time.perf_counter() - started) * 1000, 2))
+            METRICS.set_gauge("storage_pending_writes", self.pending())
+            return len(messages)
+
+    def _requeue(self, conversations: List[dict], messages: List[dict]) -> None:
+        with self._lock:
+            for c in conversations:
+                _merge_conversation(self._conversations, c)
+            self._messages = messages + self._messages
+            overflow = len(self._messages) - STORAGE_MAX_PENDING
+            if overflow > 0:
+                del self._messages[:overflow]
+                METRICS.inc("storage_dropped_messages", overflow)
+                logger.warning(f"⚠️ Storage buffer full, dropped {overflow} oldest messages")
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=STORAGE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+def _merge_conversation(pending: dict, record: dict) -> None:
+    """Folds a conversation write into the pending map so each conversation is written once per flush."""
+    current = pending.get(record["id"])
+    if current is None:
+        pending[record["id"]] = dict(record)
+        return
+    for field in ("user_id", "title", "created_at"):
+        if record.get(field) is not None:
+            current[field] = record[field]
+    current["last_message_at"] = max(current["last_message_at"] or 0, record["last_message_at"] or 0)
+
+
+STORAGE_BUFFER = WriteBehindBuffer()
+
+
+def persist_turn(request: ChatRequest, reply: Optional[str]) -> Optional[dict]:
+    """
+    Queues the turn's user message and assistant reply when the request asked for
+    persistence (just the user message when there is no reply, e.g. it was stopped
+    before the first word). The user message keeps the time the request arrived,
+    so turns that overlap still sort in the order they were sent.
+    """
+    if not (request.persist and request.conversation_id and request.messages):
+        return None
+    received_at = request._received_at
+    messages = [{"role": "user", "content": request.messages[-1]["content"], "timestamp": received_at}]
+    if reply:
+        messages.append({"role": "assistant", "content": reply, "timestamp": max(time.time(), received_at + 0.001)})
+    ids = STORAGE_BUFFER.add_messages(request.conversation_id, request.user_id, messages)
+    return {"user_message_id": ids[0], "assistant_message_id": ids[1] if reply else None}
+
+
+CONVERSATION_OWNERS = LRUCache(max_entries=AUTH_CACHE_MAX)
+
+
+async def conversation_owner(conversation_id: str) -> tuple:
+    """(exists, owner uid) for a conversation, from pending writes or storage. Owners never change, so they are cached."""
+    owner = CONVERSATION_OWNERS.get(conversation_id)
+    if owner:
+        return True, owner
+    record = STORAGE_BUFFER.pending_conversation(conversation_id)
+    if record is None or not record.get("user_id"):
+        record = await asyncio.to_thread(get_storage().get_conversation, conversation_id) or record
+    if record is None:
+        return False, None
+    if record.get("user_id"):
+        CONVERSATION_OWNERS.set(conversation_id, record["user_id"])
+    return True, record.get("user_id")
+
+
+async def check_conversation_owner(conversation_id: str, user_id: str, create: bool = False) -> None:
+    """Raises AccessDenied unless `user_id` owns the conversation (or, with create, it does not exist yet)."""
+    exists, owner = await conversation_owner(conversation_id)
+    if not exists:
+        if create:
+            return
+        raise AccessDenied("Conversation not found", 404)
+    if owner != user_id:
+        raise AccessDenied("Conversation belongs to another user")
+
+
+async def authorize_persistence(http_request: Request, request: ChatRequest) -> None:
+    """For persist=True chats: the caller must be signed in and own (or be creating) the conversation."""
+    if not (request.persist and request.conversation_id):
+        return
+    request.user_id = await require_user(http_request, request.user_id)
+    await check_conversation_owner(request.conversation_id, request.user_id, create=True)
+
+
+async def start_storage():
+    STORAGE_BUFFER.start()
+
+
+async def stop_storage():
+    await STORAGE_BUFFER.stop()
+    if _storage is not None:
+        _storage.close()
+
+
+# ============== History ==============
+# Conversation history is paged with opaque keyset cursors: the client asks for
+# the latest page and follows `next_cursor` to load older messages. The latest
+# window of each recently active conversation stays in an in-process LRU. New
+# turns are written into it as they are queued, so reopening a chat needs no
+# storage read at all. Writes handled by other workers never reach this copy,
+# so a window is only trusted for HISTORY_CACHE_TTL seconds after it was read.
+
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', '50'))
+HISTORY_MAX_PAGE = int(os.environ.get('HISTORY_MAX_PAGE', '200'))
+HISTORY_WINDOW = int(os.environ.get('HISTORY_WINDOW', '100'))
+HISTORY_CACHE_CONVERSATIONS = int(os.environ.get('HISTORY_CACHE_CONVERSATIONS', '256'))
+HISTORY_CACHE_TTL = float(os.environ.get('HISTORY_CACHE_TTL', '15'))
+
+HISTORY_CACHE = LRUCache(max_entries=HISTORY_CACHE_CONVERSATIONS)
+
+
+def encode_cursor(timestamp: float, item_id: str) -> str:
+    raw = json.dumps([timestamp, item_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Raises ValueError for anything that is not a cursor this server issued."""
+    try:
+        timestamp, item_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(timestamp), str(item_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def remember_messages(conversation_id: str, rows: List[dict]) -> None:
+    """Appends freshly queued messages to the conversation's cached window, if it is cached."""
+    entry = HISTORY_CACHE.get(conversation_id)
+    if entry is None:
+        return
+    by_id = {m["id"]: m for m in entry["messages"]}
+    by_id.update({r["id"]: r for r in rows})
+    messages = sorted(by_id.values(), key=lambda m: (m["timestamp"], m["id"]))
+    complete = entry["complete"]
+    if len(messages) > HISTORY_WINDOW:
+        messages = messages[-HISTORY_WINDOW:]
+        complete = False
+    # Local writes don't extend the window's lifetime: it still expires when the storage read does
+    ttl = entry["expires_at"] - time.time()
+    if ttl > 0:
+        HISTORY_CACHE.set(conversation_id, {**entry, "messages": messages, "complete": complete}, ttl=ttl)
+
+
+def _page(items: List[dict], has_more: bool, sort_field: str) -> dict:
+    next_cursor = None
+    if has_more and items:
+        oldest = items[0] if sort_field == "timestamp" else items[-1]
+        next_cursor = encode_cursor(oldest[sort_field], oldest["id"])
+    return {"next_cursor": next_cursor}
+
+
+async def load_messages_page(conversation_id: str, limit: int, before: Optional[tuple] = None) -> dict:
+    """One page of messages in chronological order, plus the cursor for the page before it."""
+    if before is None:
+        entry = HISTORY_CACHE.get(conversation_id)
+        if entry and (len(entry["messages"]) >= limit or entry["complete"]):
+            METRICS.inc("history_cache_hits")
+            page = entry["messages"][-limit:]
+            has_more = len(entry["messages"]) > limit or not entry["complete"]
+            return {"messages": page, **_page(page, has_more, "timestamp")}
+        METRICS.inc("history_cache_misses")
+
+    if STORAGE_BUFFER.pending():
+        await STORAGE_BUFFER.flush()
+    rows = await asyncio.to_thread(get_storage().list_messages, conversation_id, limit + 1, before)
+    has_more = len(rows) > limit
+    page = list(reversed(rows[:limit]))
+    if before is None:
+        window = page[-HISTORY_WINDOW:]
+        HISTORY_CACHE.set(conversation_id, {
+            "messages": window,
+            "complete": not has_more and len(window) == len(page),
+            "expires_at": time.time() + HISTORY_CACHE_TTL,
+        }, ttl=HISTORY_CACHE_TTL)
+    return {"messages": page, **_page(page, has_more, "timestamp")}
+
+
+async def load_conversations_page(user_id: str, limit: int, before: Optional[tuple] = None) -> dict:
+    """One page of a user's conversations, most recently active first."""
+    if STORAGE_BUFFER.pending():
+        await STORAGE_BUFFER.flush()
+    rows = await asyncio.to_thread(get_storage().list_conversations, user_id, limit + 1, before)
+    page = rows[:limit]
+    return {"conversations": page, **_page(page, len(rows) > limit, "last_message_at")}
+
+
+# ============== Compression ==============
+# Request bodies may arrive gzip-, deflate- or brotli-encoded (Content-Encoding);
+# RequestDecompressionMiddleware inflates them before routing, with a cap on the
+# inflated size. SSE responses are compressed when the client's Accept-Encoding
+# allows it: events that are ready together are coalesced into one frame and
+# every frame ends with a sync flush, so the client can decode it immediately.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAX_REQUEST_BODY_BYTES = int(os.environ.get('MAX_REQUEST_BODY_BYTES', str(4 * 1024 * 1024)))
+SSE_COMPRESSION = [e.strip() for e in os.environ.get('SSE_COMPRESSION', 'br,gzip').split(',') if e.strip()]
+SSE_COALESCE_MS = float(os.environ.get('SSE_COALESCE_MS', '15'))
+SSE_FRAME_MAX_EVENTS = 32
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+class BodyDecodeError(Exception):
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def supported_encodings() -> List[str]:
+    return ["gzip", "deflate"] + (["br"] if brotli is not None else [])
+
+
+def decompress_body(body: bytes, encoding: str, limit: int = MAX_REQUEST_BODY_BYTES) -> bytes:
+    """Inflates a request body, refusing anything that would grow past `limit` bytes."""
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        inflater = zlib.decompressobj(wbits=31 if encoding != "deflate" else 15)
+        try:
+            data = inflater.decompress(body, limit + 1)
+        except zlib.error as e:
+            raise BodyDecodeError(f"Invalid {encoding} body: {e}")
+        if len(data) > limit or inflater.unconsumed_tail:
+            raise BodyDecodeError(f"Request body exceeds {limit} bytes once decompressed", 413)
+        if not inflater.eof:
+            raise BodyDecodeError(f"Truncated {encoding} body")
+        return data
+    if encoding == "br" and brotli is not None:
+        inflater = brotli.Decompressor()
+        parts, size = [], 0
+        try:
+            # Small input slices keep a decompression bomb from blowing past the limit in one call
+            for start in range(0, len(body), 4096):
+                part = inflater.process(body[start:start + 4096])
+                size += len(part)
+                if size > limit:
+                    raise BodyDecodeError(f"Request body exceeds {limit} bytes once decompressed", 413)
+                parts.append(part)
+        except brotli.error as e:
+            raise BodyDecodeError(f"Invalid br body: {e}")
+        if not inflater.is_finished():
+            raise BodyDecodeError("Truncated br body")
+        return b"".join(parts)
+    raise BodyDecodeError(f"Unsupported Content-Encoding '{encoding}' (supported: {', '.join(supported_encodings())})", 415)
+
+
+class RequestDecompressionMiddleware:
+    """Inflates compressed request bodies so every route reads plain bytes as before."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = Headers(scope=scope).get("content-encoding", "").strip().lower()
+        if encoding in ("", "identity"):
+            return await self.app(scope, receive, send)
+
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            if size > MAX_REQUEST_BODY_BYTES:
+                return await self._reject(scope, receive, send, BodyDecodeError("Request body too large", 413))
+            if not message.get("more_body"):
+                break
+        compressed = b"".join(chunks)
+        try:
+            body = decompress_body(compressed, encoding, MAX_REQUEST_BODY_BYTES)
+        except BodyDecodeError as e:
+            return await self._reject(scope, receive, send, e)
+        METRICS.inc("request_bytes_compressed_total", len(compressed), encoding=encoding)
+        METRICS.inc("request_bytes_inflated_total", len(body), encoding=encoding)
+
+        headers = [
+            (name, value) for name, value in scope["headers"]
+            if name not in (b"content-encoding", b"content-length")
+        ]
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        delivered = False
+
+        async def inflated_receive():
+            nonlocal delivered
+            if not delivered:
+                delivered = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        await self.app({**scope, "headers": headers}, inflated_receive, send)
+
+    @staticmethod
+    async def _reject(scope, receive, send, error: BodyDecodeError):
+        METRICS.inc("request_decode_errors_total", status=error.status_code)
+        response = JSONResponse({"error": str(error), "success": False}, status_code=error.status_code)
+        await response(scope, receive, send)
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """The first SSE_COMPRESSION encoding the client accepts (q > 0), or None for identity."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in SSE_COMPRESSION:
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+class StreamCompressor:
+    """One compression context per response; compress() returns a frame that is decodable on its own."""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+        else:
+            self._deflate = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._deflate.compress(data) + self._deflate.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.finish()
+        return self._deflate.flush(zlib.Z_FINISH)
+
+
+async def compress_events(events, encoding: str):
+    """
+    Coalesces SSE events that are ready within SSE_COALESCE_MS into one frame and
+    yields each frame compressed and flushed. A pump task feeds a queue so a
+    pending frame is never held back waiting for the next token.
+    """
+    compressor = StreamCompressor(encoding)
+    frames: asyncio.Queue = asyncio.Queue()
+    end = object()
+
+    async def pump():
+        try:
+            async for event in events:
+                await frames.put(event)
+        finally:
+            await frames.put(end)
+
+    task = asyncio.create_task(pump())
+    raw = sent = 0
+    try:
+        finished = False
+        while not finished:
+            batch = [await frames.get()]
+            window_end = time.monotonic() + SSE_COALESCE_MS / 1000
+            while batch[-1] is not end and len(batch) < SSE_FRAME_MAX_EVENTS:
+                remaining = window_end - time.monotonic()
+                try:
+                    batch.append(frames.get_nowait() if remaining <= 0 else await asyncio.wait_for(frames.get(), remaining))
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+            if batch[-1] is end:
+                batch.pop()
+                finished = True
+            data = "".join(batch).encode("utf-8")
+            frame = compressor.compress(data) if data else b""
+            if finished:
+                frame += compressor.finish()
+            raw += len(data)
+            sent += len(frame)
+            if frame:
+                yield frame
+    finally:
+        task.cancel()
+        METRICS.inc("sse_bytes_raw_total", raw, encoding=encoding)
+        METRICS.inc("sse_bytes_sent_total", sent, encoding=encoding)
+
+
+# ============== Resumable Streams ==============
+# A /chat/stream request sent with an Idempotency-Key runs its generation in a
+# background task that writes every SSE event into a short-lived buffer. The
+# client reads from that buffer, so a dropped connection does not stop the
+# upstream call. A reconnect with the same key and Last-Event-ID picks up after
+# the last event it saw (attaching to the generation if it is still running),
+# and a retried POST replays the finished answer instead of paying for it twice.
+# A generation nobody is listening to is stopped after STREAM_ORPHAN_GRACE.
+#
+# Buffers live in this worker's memory only. Resuming needs the reconnect to reach
+# the worker that started the stream: run one worker, or put the workers behind a
+# load balancer with sticky sessions (hashing the Idempotency-Key header works). A
+# resume (Last-Event-ID set) that finds no buffer, because it landed elsewhere or
+# the buffer expired, gets a 409 instead of a silent restart that would stream
+# the whole answer again after the part the client already has.
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+LAST_EVENT_ID_HEADER = "Last-Event-ID"
+STREAM_REPLAY_TTL = float(os.environ.get('STREAM_REPLAY_TTL', '120'))
+STREAM_ORPHAN_GRACE = float(os.environ.get('STREAM_ORPHAN_GRACE', '10'))
+STREAM_REPLAY_MAX = int(os.environ.get('STREAM_REPLAY_MAX', '1000'))
+
+
+def sse_event(event_id: int, chunk: str) -> str:
+    """Prefixes an already formatted `data: ...` chunk with its SSE id line."""
+    return f"id: {event_id}\n{chunk}"
+
+
+def parse_last_event_id(value: Optional[str]) -> int:
+    try:
+        return max(0, int(value)) if value else 0
+    except ValueError:
+        return 0
+
+
+async def number_events(chunks):
+    event_id = 0
+    async for chunk in chunks:
+        event_id += 1
+        yield sse_event(event_id, chunk)
+
+
+class StreamBuffer:
+    """The SSE events of one generation, with the running task that produces them."""
+
+    def __init__(self, key: str, fingerprint: str, owner: str):
+        self.key = key
+        self.fingerprint = fingerprint
+        # quota_identity of the caller that started it; only they may resume or cancel it
+        self.owner = owner
+        self.events: List[str] = []
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self.listeners = 0
+        self.detached_at = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def append(self, chunk: str) -> None:
+        self.events.append(chunk)
+        self._wake()
+
+    def finish(self) -> None:
+        self.done = True
+        self.finished_at = time.time()
+        self._wake()
+
+    def _wake(self) -> None:
+        # Waiters hold the old event; a fresh one is armed for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def orphaned(self) -> bool:
+        return self.listeners == 0 and time.monotonic() - self.detached_at > STREAM_ORPHAN_GRACE
+
+    async def follow(self, offset: int = 0):
+        """Replays events after `offset`, then tails the generation until it finishes."""
+        self.listeners += 1
+        try:
+            while True:
+                while offset < len(self.events):
+                    yield sse_event(offset + 1, self.events[offset])
+                    offset += 1
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self.listeners -= 1
+            if not self.listeners:
+                self.detached_at = time.monotonic()
+
+
+class StreamRegistry:
+    def __init__(self, ttl: float = STREAM_REPLAY_TTL, max_entries: int = STREAM_REPLAY_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._streams: "OrderedDict[str, StreamBuffer]" = OrderedDict()
+
+    def _prune(self) -> None:
+        now = time.time()
+        expired = [k for k, b in self._streams.items() if b.done and now - b.finished_at > self.ttl]
+        for key in expired:
+            del self._streams[key]
+        # Over capacity: drop the oldest finished buffers, never a running one
+        for key in [k for k, b in self._streams.items() if b.done][:max(0, len(self._streams) - self.max_entries)]:
+            del self._streams[key]
+
+    def get(self, key: str) -> Optional[StreamBuffer]:
+        self._prune()
+        return self._streams.get(key)
+
+    def start(self, key: str, fingerprint: str, owner: str, producer) -> StreamBuffer:
+        buffer = StreamBuffer(key, fingerprint, owner)
+        self._streams[key] = buffer
+        buffer.task = asyncio.create_task(self._pump(buffer, producer))
+        METRICS.set_gauge("streams_buffered", len(self._streams))
+        return buffer
+
+    async def _pump(self, buffer: StreamBuffer, producer) -> None:
+        try:
+            async for chunk in producer:
+                buffer.append(chunk)
+                if buffer.orphaned():
+                    METRICS.inc("streams_orphaned_total")
+                    logger.info(f"🔌 Stream {buffer.key} abandoned, stopping generation")
+                    buffer.append(f"data: {json.dumps({'done': True, 'partial': True})}\n\n")
+                    break
+        except asyncio.CancelledError:
+            buffer.append(f"data: {json.dumps({'done': True, 'cancelled': True})}\n\n")
+        except Exception as e:
+            logger.error(f"❌ Stream {buffer.key} failed: {e}", exc_info=True)
+        finally:
+            await producer.aclose()
+            buffer.finish()
+
+    def cancel(self, key: str, owner: str) -> bool:
+        buffer = self._streams.get(key)
+        if not buffer or buffer.done or buffer.owner != owner:
+            return False
+        buffer.task.cancel()
+        METRICS.inc("streams_cancelled_total")
+        return True
+
+
+STREAMS = StreamRegistry()
+
+
+# ============== Profiling ==============
+# Admin-only, on-demand diagnostics for a live worker. The sampling profiler runs
+# in its own thread, reads every thread's stack through sys._current_frames() at
+# a fixed interval and returns collapsed stacks (one "root;...;leaf count" line
+# per distinct stack), the input format of flamegraph.pl and speedscope. The
+# memory mode diffs two tracemalloc snapshots taken N seconds apart. Both are
+# disabled unless ADMIN_TOKEN is set, and only one profile runs at a time.
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+ADMIN_HEADER = "X-Admin-Token"
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', '60'))
+PROFILE_MIN_INTERVAL_MS = 1.0
+PROFILE_MAX_DEPTH = 128
+TRACEMALLOC_FRAMES = 25
+APP_FILE = os.path.abspath(__file__)
+# Leaf frames of threads that are parked, not working; left out unless idle=true
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("socket.py", "accept"),
+}
+PROFILE_LOCK = asyncio.Lock()
+
+
+def admin_denied(http_request: Request) -> Optional[JSONResponse]:
+    if not ADMIN_TOKEN:
+        return JSONResponse({"error": "Admin endpoints are disabled (set ADMIN_TOKEN)", "success": False}, status_code=404)
+    token = http_request.headers.get(ADMIN_HEADER, "")
+    if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        return JSONResponse({"error": "Forbidden", "success": False}, status_code=403)
+    return None
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float, loop_thread: Optional[int] = None,
+                  include_idle: bool = False) -> tuple:
+    """
+    Samples all threads but this one every `interval` seconds for `seconds`.
+    Returns (Counter of collapsed stacks, number of sampling rounds). Runs on a
+    worker thread so the event loop is sampled while it keeps serving requests.
+    """
+    me = threading.get_ident()
+    stacks = defaultdict(int)
+    rounds = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            code = frame.f_code
+            if not include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            labels = []
+            while frame is not None and len(labels) < PROFILE_MAX_DEPTH:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            thread = "event-loop" if ident == loop_thread else names.get(ident, f"thread-{ident}")
+            stacks[";".join([thread] + labels[::-1])] += 1
+        rounds += 1
+        time.sleep(interval)
+    return stacks, rounds
+
+
+def collapsed_stacks(stacks: dict) -> str:
+    return "\n".join(f"{stack} {count}" for stack, count in sorted(stacks.items(), key=lambda s: -s[1])) + "\n"
+
+
+def _frame_source(frame) -> str:
+    line = linecache.getline(frame.filename, frame.lineno).strip()
+    return f"{os.path.basename(frame.filename)}:{frame.lineno} {line}"
+
+
+async def allocation_hot_spots(seconds: float, top: int, app_only: bool = True) -> dict:
+    """Allocations that grew over `seconds`, grouped by traceback, largest growth first."""
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    try:
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+    if app_only:
+        # Keep allocations with server.py anywhere on the stack: prompt building, streaming, storage
+        only_app = [tracemalloc.Filter(True, APP_FILE, all_frames=True)]
+        before, after = before.filter_traces(only_app), after.filter_traces(only_app)
+    diffs = [d for d in after.compare_to(before, "traceback") if d.size_diff > 0][:top]
+    return {
+        "seconds": seconds,
+        "traced_frames": TRACEMALLOC_FRAMES,
+        "was_tracing": not started_here,
+        "total_growth_kb": round(sum(d.size_diff for d in diffs) / 1024, 1),
+        "hot_spots": [
+            {
+                "size_diff_kb": round(d.size_diff / 1024, 1),
+                "count_diff": d.count_diff,
+                "size_kb": round(d.size / 1024, 1),
+                # Innermost app frame first, then the allocation site itself
+                "app_frames": [_frame_source(f) for f in reversed(d.traceback) if f.filename == APP_FILE][:5],
+                "allocated_at": _frame_source(d.traceback[-1]),
+            }
+            for d in diffs
+        ],
+    }
+
+
+# ============== Routes ==============
+
+async def root():
+    return {"message": "Backend is running"}
+
+
+@api_router.get("/")
+async def api_root():
+    return {"message": "Nex.AI API is running"}
+
+
+@api_router.get("/health")
+async def health():
+    return {
+        "status": "healthy",
+        "sarvam_api_configured": SARVAM_API_KEY is not None,
+        "tavily_api_configured": TAVILY_API_KEY is not None,
+        "sarvam_api_url": SARVAM_API_URL,
+        "upstreams": UPSTREAM_HEALTH,
+        "providers": llm_router().snapshot(),
+        "brownout": BROWNOUT.snapshot(),
+        "startup": STARTUP_STATE
+    }
+
+
+@api_router.get("/health/live")
+async def health_live():
+    return {"status": "alive"}
+
+
+@api_router.get("/health/ready")
+async def health_ready():
+    report = readiness_report()
+    if report["ready"] and STARTUP_STATE["ready_seconds"] is None and _started_at is not None:
+        STARTUP_STATE["ready_seconds"] = round(time.perf_counter() - _started_at, 3)
+        METRICS.set_gauge("startup_ready_seconds", STARTUP_STATE["ready_seconds"])
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+
+@api_router.get("/metrics")
+async def metrics():
+    return {
+        **METRICS.snapshot(),
+        "providers": llm_router().snapshot(),
+        "api_keys": llm_router().key_usage(),
+        "logs_dropped": LOG_SAMPLER.snapshot(),
+    }
+
+
+@api_router.get("/usage")
+async def usage(http_request: Request, user_id: Optional[str] = None):
+    """
+    The signed-in caller's own window, quotas and conversations. With the admin
+    token: the aggregate view for capacity planning, or any user's with user_id.
+    """
+    if http_request.headers.get(ADMIN_HEADER):
+        denied = admin_denied(http_request)
+        if denied:
+            return denied
+        return TOKEN_LEDGER.user_snapshot(user_id) if user_id else TOKEN_LEDGER.snapshot()
+    try:
+        user_id = await require_user(http_request, user_id)
+    except AccessDenied as e:
+        return e.response()
+    return TOKEN_LEDGER.user_snapshot(user_id)
+
+
+# ---------- ADMIN: PROFILING ----------
+@api_router.get("/admin/profile")
+async def profile_cpu(http_request: Request, seconds: float = 10, interval_ms: float = 10, idle: bool = False):
+    """Samples every thread for `seconds` and returns collapsed stacks (text/plain, flamegraph-ready)."""
+    denied = admin_denied(http_request)
+    if denied:
+        return denied
+    if PROFILE_LOCK.locked():
+        return JSONResponse({"error": "A profile is already running", "success": False}, status_code=409)
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    interval = max(PROFILE_MIN_INTERVAL_MS, interval_ms) / 1000
+    async with PROFILE_LOCK:
+        logger.info(f"🔬 CPU profile started | seconds={seconds} | interval_ms={interval * 1000:.0f}")
+        stacks, rounds = await asyncio.to_thread(sample_stacks, seconds, interval, threading.get_ident(), idle)
+    return PlainTextResponse(
+        collapsed_stacks(stacks),
+        headers={"X-Profile-Rounds": str(rounds), "X-Profile-Samples": str(sum(stacks.values()))}
+    )
+
+
+@api_router.get("/admin/profile/memory")
+async def profile_memory(http_request: Request, seconds: float = 10, top: int = 25, app_only: bool = True):
+    """Allocation growth over `seconds` from two tracemalloc snapshots, biggest first."""
+    denied = admin_denied(http_request)
+    if denied:
+        return denied
+    if PROFILE_LOCK.locked():
+        return JSONResponse({"error": "A profile is already running", "success": False}, status_code=409)
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    async with PROFILE_LOCK:
+        logger.info(f"🔬 Memory profile started | seconds={seconds}")
+        return await allocation_hot_spots(seconds, max(1, min(top, 200)), app_only)
+
+
+# ---------- STREAMING CHAT ----------
+@api_router.post("/chat/stream")
+async def chat_stream(http_request: Request):
+    shed = BROWNOUT.shed_response()
+    if shed:
+        return shed
+    body = await http_request.body()
+    idempotency_key = http_request.headers.get(IDEMPOTENCY_HEADER)
+    fingerprint = hashlib.sha1(body).hexdigest()
+    owner = await quota_identity(http_request)
+
+    def attach(existing: StreamBuffer):
+        # Someone else's key looks like any other clash, so it reveals nothing about their stream
+        if existing.fingerprint != fingerprint or existing.owner != owner:
+            return JSONResponse(
+                {"error": f"{IDEMPOTENCY_HEADER} was already used for a different request", "success": False},
+                status_code=422
+            )
+        offset = parse_last_event_id(http_request.headers.get(LAST_EVENT_ID_HEADER))
+        METRICS.inc("streams_resumed_total" if offset else "streams_replayed_total")
+        return _event_stream(http_request, existing.follow(offset), idempotency_key)
+
+    if idempotency_key:
+        existing = STREAMS.get(idempotency_key)
+        if existing:
+            return attach(existing)
+        if parse_last_event_id(http_request.headers.get(LAST_EVENT_ID_HEADER)):
+            METRICS.inc("streams_resume_missed_total")
+            return JSONResponse(
+                {"error": "This stream is not buffered on this worker (expired, or served by another worker); "
+                          f"retry without {LAST_EVENT_ID_HEADER} to start a new answer",
+                 "success": False, "stream_missing": True},
+                status_code=409
+            )
+
+    request = decode_body(ChatRequest, body)
+    try:
+        await authorize_persistence(http_request, request)
+        request.user_id = await quota_identity(http_request, request.user_id)
+    except AccessDenied as e:
+        return e.response()
+    limited = quota_response(request.user_id, request.active_mode)
+    if limited:
+        return limited
+    deadline = request_deadline(request.active_mode, http_request.headers.get(DEADLINE_HEADER))
+
+    async def generate():
+        with BROWNOUT.track():
+            async for chunk in _generate():
+                yield chunk
+
+    async def _generate():
+        parts, persisted = [], False
+        try:
+            if not llm_router().configured():
+                yield f"data: {json.dumps({'error': 'No LLM provider configured (set SARVAM_API_KEY)'})}\n\n"
+                return
+
+            last_user_msg = request.messages[-1]["content"] if request.messages else ""
+
+            if request.active_mode and detect_mode_deactivation(last_user_msg):
+                yield f"data: {json.dumps({'mode_action': 'deactivate'})}\n\n"
+
+            chat = await prepare_chat(request, deadline=deadline)
+            messages = chat["messages"]
+            settings = chat["settings"]
+
+            logger.info("💬 Stream chat", extra={"event": "chat_request", "fields": {
+                "endpoint": "stream", "mode": chat["mode"], "messages": len(messages), "context_limit": chat["context_limit"]
+            }})
+
+            response = await run_upstream(
+                call_llm,
+                messages,
+                stream=True,
+                max_tokens=settings["max_tokens"],
+                temperature=settings["temperature"],
+                model=settings["model"],
+                deadline=deadline
+            )
+
+            if response.status_code != 200:
+                error = f"API Error {response.status_code}: {await run_upstream(getattr, response, 'text')}"
+                response.close()
+                yield f"data: {json.dumps({'error': error})}\n\n"
+                return
+
+            result = {}
+            parts.append(result)
+            async for chunk in _stream_response(response, result, deadline):
+                yield chunk
+            record_usage(request, chat["mode"], messages, result)
+
+            continued = (
+                needs_continuation(settings, result.get("finish_reason"))
+                and deadline.remaining() >= CONTINUATION_MIN_REMAINING
+            )
+            if continued:
+                first_part = result
+                follow_up = continuation_messages(messages, first_part["text"])
+                result = {}
+                parts.append(result)
+                try:
+                    response = await run_upstream(
+                        call_llm,
+                        follow_up,
+                        stream=True,
+                        max_tokens=settings["ceiling"] - settings["max_tokens"],
+                        temperature=settings["temperature"],
+                        model=settings["model"],
+                        deadline=deadline
+                    )
+                except DeadlineExceeded:
+                    # Keep the first part rather than failing the whole reply
+                    response = None
+                    result["finish_reason"] = "deadline"
+                if response is not None and response.status_code != 200:
+                    logger.warning(f"⚠️ Continuation failed: API Error {response.status_code}: "
+                                   f"{await run_upstream(getattr, response, 'text')}")
+                    response.close()
+                elif response is not None:
+                    async for chunk in _stream_response(response, result, deadline):
+                        yield chunk
+                    record_usage(request, chat["mode"], follow_up, result)
+                result["text"] = first_part["text"] + result.get("text", "")
+                result["completion_tokens"] = completion_tokens(first_part) + completion_tokens(result)
+            record_completion(settings, chat["mode"], result.get("completion_tokens") or completion_tokens(result), continued)
+
+            done = {'done': True}
+            if result.get("finish_reason") in PARTIAL_FINISH_REASONS:
+                done['partial'] = True
+            reply = clean_markdown(result.get("text", ""))
+            record_game_reply(chat["game"], reply)
+            saved = persist_turn(request, reply)
+            persisted = True
+            if saved:
+                done['message_ids'] = saved
+            yield f"data: {json.dumps(done)}\n\n"
+
+        except (GeneratorExit, asyncio.CancelledError):
+            # Stopped by the user or abandoned: keep the turn as far as it got
+            if not persisted:
+                text = clean_markdown("".join(part.get("text", "") for part in parts)).rstrip()
+                persist_turn(request, f"{text} [stopped]" if text else None)
+            raise
+        except DeadlineExceeded as e:
+            yield f"data: {json.dumps({'error': str(e), 'deadline_exceeded': True})}\n\n"
+        except Exception as e:
+            logger.error(f"❌ Chat stream error: {str(e)}", exc_info=True)
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+    if not idempotency_key:
+        return _event_stream(http_request, number_events(generate()))
+    # A concurrent retry may have started it during the awaits above; no await from here
+    # on, so only one generation starts
+    existing = STREAMS.get(idempotency_key)
+    if existing:
+        return attach(existing)
+    buffer = STREAMS.start(idempotency_key, fingerprint, owner, generate())
+    return _event_stream(http_request, buffer.follow(), idempotency_key)
+
+
+def _event_stream(http_request: Request, events, idempotency_key: Optional[str] = None) -> StreamingResponse:
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+        "Vary": "Accept-Encoding"
+    }
+    if idempotency_key:
+        headers[IDEMPOTENCY_HEADER] = idempotency_key
+    encoding = negotiate_encoding(http_request.headers.get("accept-encoding"))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        events = compress_events(events, encoding)
+    return StreamingResponse(events, media_type="text/event-stream", headers=headers)
+
+
+@api_router.delete("/chat/stream/{idempotency_key}")
+async def cancel_stream(idempotency_key: str, http_request: Request):
+    """Stops a keyed generation the user no longer wants (the client's stop button). Only its owner can."""
+    return {"cancelled": STREAMS.cancel(idempotency_key, await quota_identity(http_request))}
+
+
+PARTIAL_FINISH_REASONS = ("deadline", "timeout")
+
+
+async def _stream_response(response, result: Optional[dict] = None, deadline: Optional[Deadline] = None):
+    """
+    Shared helper: parses SSE lines from Sarvam's streaming response
+    and yields properly formatted SSE chunks for the client.
+    If `result` is given it is filled with the raw text, finish_reason and usage.
+    The stream stops early with finish_reason "deadline" when the deadline passes
+    before the first token, or "timeout" when the upstream goes quiet for longer
+    than STREAM_IDLE_TIMEOUT (or the socket read timeout).
+    """
+    if result is None:
+        result = {}
+    result.setdefault("text", "")
+    try:
+        async for chunk in _relay_stream(response, result, deadline):
+            yield chunk
+    except requests.exceptions.RequestException as e:
+        result["finish_reason"] = "timeout"
+        record_deadline_miss("stream_idle")
+        logger.warning(f"⏱️ Upstream stream stalled: {e}")
+    finally:
+        # Also releases the provider key held for the stream
+        response.close()
+
+
+async def _relay_stream(response, result: dict, deadline: Optional[Deadline]):
+    # Until the first token the request deadline applies; after it, only the gap between chunks
+    chunks = _iter_stream_chunks(response)
+    done = object()
+    flowing = False
+    while True:
+        wait = STREAM_IDLE_TIMEOUT if flowing or deadline is None else deadline.remaining()
+        try:
+            chunk_data = await asyncio.wait_for(run_upstream(next, chunks, done), wait)
+        except asyncio.TimeoutError:
+            result["finish_reason"] = "timeout" if flowing else "deadline"
+            record_deadline_miss("stream_idle" if flowing else "stream")
+            break
+        if chunk_data is done:
+            break
+        content = _read_stream_chunk(chunk_data, result)
+        if content:
+            flowing = True
+            # Clean markdown before sending
+            content = clean_markdown(content)
+            yield f"data: {json.dumps({'word': content})}\n\n"
+            await asyncio.sleep(0.01)
+
+
+def _iter_stream_chunks(response):
+    """Decoded JSON chunks from an upstream SSE stream, until [DONE]."""
+    buffer = ""
+    for line in response.iter_lines():
+        if not line:
+            continue
+        line_text = line.decode("utf-8")
+
+        if line_text.startswith("data: "):
+            data_str = line_text[6:]
+            if data_str.strip() == "[DONE]":
+                return
+            try:
+                yield json.loads(data_str)
+            except json.JSONDecodeError:
+                continue
+        else:
+            buffer += line_text
+            try:
+                chunk_data = json.loads(buffer)
+            except json.JSONDecodeError:
+                continue
+            buffer = ""
+            yield chunk_data
+
+
+def _read_stream_chunk(chunk_data: dict, result: dict) -> str:
+    if chunk_data.get("usage"):
+        result["usage"] = chunk_data["usage"]
+    if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
+        choice = chunk_data["choices"][0]
+        if choice.get("finish_reason"):
+            result["finish_reason"] = choice["finish_reason"]
+        content = (choice.get("delta") or {}).get("content") or ""
+        result["text"] += content
+        return content
+    return ""
+
+
+def completion_tokens(result: dict) -> int:
+    """Completion tokens from upstream usage when present, otherwise estimated from the text."""
+    usage = result.get("usage") or {}
+    return usage.get("completion_tokens") or estimate_tokens(result.get("text", ""))
+
+
+# ---------- SIMPLE (NON-STREAMING) CHAT ----------
+@api_router.post("/chat/simple")
+async def chat_simple(http_request: Request):
+    shed = BROWNOUT.shed_response()
+    if shed:
+        return shed
+    request = decode_body(ChatRequest, await http_request.body())
+    try:
+        await authorize_persistence(http_request, request)
+        request.user_id = await quota_identity(http_request, request.user_id)
+    except AccessDenied as e:
+        return e.response()
+    limited = quota_response(request.user_id, request.active_mode)
+    if limited:
+        return limited
+    deadline = request_deadline(request.active_mode, http_request.headers.get(DEADLINE_HEADER))
+    with BROWNOUT.track():
+        return await run_simple_chat(request, deadline)
+
+
+async def run_simple_chat(request: ChatRequest, deadline: Optional[Deadline] = None) -> dict:
+    """Builds the prompt for one ChatRequest and returns the non-streamed reply (or an error dict)."""
+    if deadline is None:
+        deadline = request_deadline(request.active_mode)
+    try:
+        if not llm_router().configured():
+            return {"error": "No LLM provider configured (set SARVAM_API_KEY in .env file)", "success": False}
+
+        chat = await prepare_chat(request, deadline=deadline)
+        messages = chat["messages"]
+        settings = chat["settings"]
+        mode_action = chat["mode_action"]
+
+        logger.info("💬 Simple chat", extra={"event": "chat_request", "fields": {
+            "endpoint": "simple", "mode": chat["mode"], "messages": len(messages), "context_limit": chat["context_limit"]
+        }})
+
+        response = await run_upstream(
+            call_llm,
+            messages,
+            stream=False,
+            max_tokens=settings["max_tokens"],
+            temperature=settings["temperature"],
+            model=settings["model"],
+            deadline=deadline
+        )
+
+        if response.status_code != 200:
+            return {"error": f"API Error {response.status_code}: {response.text}", "success": False}
 
         response_data = response.json()
         response_text = response_data["choices"][0]["message"]["content"]
-        
+        first_part = {"text": response_text, "usage": response_data.get("usage")}
+        used_tokens = completion_tokens(first_part)
+        record_usage(request, chat["mode"], messages, first_part)
+
+        partial = False
+        continued = (
+            needs_continuation(settings, response_data["choices"][0].get("finish_reason"))
+            and deadline.remaining() >= CONTINUATION_MIN_REMAINING
+        )
+        if continued:
+            follow_up = continuation_messages(messages, response_text)
+            try:
+                more = await run_upstream(
+                    call_llm,
+                    follow_up,
+                    stream=False,
+                    max_tokens=settings["ceiling"] - settings["max_tokens"],
+                    temperature=settings["temperature"],
+                    model=settings["model"],
+                    deadline=deadline
+                )
+            except DeadlineExceeded:
+                # Keep the first part rather than failing the whole reply
+                more = None
+                partial = True
+            if more is not None and more.status_code != 200:
+                logger.warning(f"⚠️ Continuation failed: API Error {more.status_code}: {more.text}")
+            elif more is not None:
+                more_data = more.json()
+                more_part = {"text": more_data["choices"][0]["message"]["content"], "usage": more_data.get("usage")}
+                response_text += more_part["text"]
+                used_tokens += completion_tokens(more_part)
+                record_usage(request, chat["mode"], follow_up, more_part)
+        record_completion(settings, chat["mode"], used_tokens, continued)
+
         # Clean markdown from response
         response_text = clean_markdown(response_text)
+        record_game_reply(chat["game"], response_text)
 
         result = {
             "response": response_text,
@@ -966,29 +4743,498 @@ async def chat_simple(request: ChatRequest):
 
         if mode_action:
             result["mode_action"] = mode_action
+        if partial:
+            result["partial"] = True
+
+        saved = persist_turn(request, response_text)
+        if saved:
+            result["message_ids"] = saved
 
         return result
 
+    except DeadlineExceeded as e:
+        return {"error": str(e), "success": False, "deadline_exceeded": True}
     except Exception as e:
         logger.error(f"❌ Chat simple error: {str(e)}", exc_info=True)
         return {"error": str(e), "success": False}
 
 
+# ---------- BATCH CHAT ----------
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', '8'))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '500'))
+
+
+@api_router.post("/chat/batch")
+async def chat_batch(http_request: Request):
+    """
+    Runs many ChatRequests through the same pipeline as /chat/simple.
+    Accepts either a JSON BatchChatRequest or an NDJSON body (one ChatRequest per line),
+    and streams one NDJSON result per item in completion order.
+    """
+    shed = BROWNOUT.shed_response()
+    if shed:
+        return shed
+    content_type = http_request.headers.get("content-type", "")
+    concurrency = BATCH_MAX_CONCURRENCY
+
+    if "ndjson" in content_type:
+        items = _iter_ndjson_items(http_request)
+    else:
+        batch = decode_body(BatchChatRequest, await http_request.body())
+        if len(batch.items) > BATCH_MAX_ITEMS:
+            return JSONResponse(
+                {"error": f"Batch too large: {len(batch.items)} items (max {BATCH_MAX_ITEMS})", "success": False},
+                status_code=413
+            )
+        if batch.concurrency:
+            concurrency = max(1, min(batch.concurrency, BATCH_MAX_CONCURRENCY))
+        items = _iter_list_items(batch.items)
+
+    # Items start running while the body is still being read. For NDJSON the response
+    # can only begin once the body is consumed, because Starlette listens for
+    # disconnects on the same receive channel while streaming; a JSON body is already
+    # read, so its response starts straight away.
+    runner = BatchRunner(concurrency)
+    try:
+        async for index, item, error in items:
+            if item is not None:
+                try:
+                    await authorize_persistence(http_request, item)
+                    item.user_id = await quota_identity(http_request, item.user_id)
+                except AccessDenied as e:
+                    item, error = None, str(e)
+            runner.submit(index, item, error)
+    except Exception:
+        runner.cancel()
+        raise
+
+    return StreamingResponse(
+        runner.results(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def _iter_list_items(items: List[ChatRequest]):
+    for index, item in enumerate(items):
+        yield index, item, None
+
+
+async def _iter_ndjson_items(http_request: Request):
+    index = 0
+    pending = b""
+    async for chunk in http_request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            if index >= BATCH_MAX_ITEMS:
+                return
+            yield _parse_ndjson_item(index, line)
+            index += 1
+    if pending.strip() and index < BATCH_MAX_ITEMS:
+        yield _parse_ndjson_item(index, pending)
+
+
+def _parse_ndjson_item(index: int, line: bytes):
+    try:
+        return index, ChatRequest.model_validate_json(line), None
+    except ValidationError as e:
+        details = "; ".join(f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors())
+        return index, None, f"Invalid item: {details}"
+
+
+class BatchRunner:
+    """
+    Runs submitted items with bounded concurrency and hands results back in completion order.
+    Submitting never waits: every item gets a task at once and the tasks queue on the
+    semaphore, so the response can start as soon as the body has been read.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._results: asyncio.Queue = asyncio.Queue()
+        self._tasks = []
+        self.submitted = 0
+
+    def submit(self, index: int, item: Optional[ChatRequest], error: Optional[str] = None) -> None:
+        self.submitted += 1
+        if error:
+            self._results.put_nowait({"index": index, "error": error, "success": False})
+            return
+        self._tasks.append(asyncio.create_task(self._run(index, item)))
+
+    async def _run(self, index: int, item: ChatRequest) -> None:
+        async with self._semaphore:
+            try:
+                TOKEN_LEDGER.check(item.user_id, item.active_mode)
+                with BROWNOUT.track():
+                    result = await run_simple_chat(item)
+            except QuotaExceeded as e:
+                result = {"error": str(e), "success": False, "quota_exceeded": True, "retry_after": e.retry_after}
+            except Exception as e:
+                result = {"error": str(e), "success": False}
+        self._results.put_nowait({"index": index, **result})
+
+    async def results(self):
+        completed = 0
+        try:
+            while completed < self.submitted:
+                result = await self._results.get()
+                completed += 1
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            self.cancel()
+            logger.info(f"📦 Batch chat finished | completed={completed}/{self.submitted} | concurrency={self.concurrency}")
+
+    def cancel(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+
+# ---------- CONVERSATIONS ----------
+@api_router.get("/conversations")
+async def get_conversations(http_request: Request, user_id: Optional[str] = None, limit: int = HISTORY_PAGE_SIZE,
+                            cursor: Optional[str] = None):
+    """The signed-in user's conversations; `user_id`, if given, must be the caller's own."""
+    try:
+        user_id = await require_user(http_request, user_id)
+    except AccessDenied as e:
+        return e.response()
+    try:
+        before = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return JSONResponse({"error": str(e), "success": False}, status_code=400)
+    return await load_conversations_page(user_id, max(1, min(limit, HISTORY_MAX_PAGE)), before)
+
+
+@api_router.get("/conversations/{conversation_id}/messages")
+async def get_messages(http_request: Request, conversation_id: str, limit: int = HISTORY_PAGE_SIZE,
+                       cursor: Optional[str] = None):
+    try:
+        user_id = await require_user(http_request)
+        await check_conversation_owner(conversation_id, user_id)
+    except AccessDenied as e:
+        return e.response()
+    try:
+        before = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return JSONResponse({"error": str(e), "success": False}, status_code=400)
+    page = await load_messages_page(conversation_id, max(1, min(limit, HISTORY_MAX_PAGE)), before)
+    return {"conversation_id": conversation_id, **page}
+
+
+@api_router.post("/conversations")
+async def save_conversation(request: SaveConversationRequest, http_request: Request):
+    conversation_id = request.id or uuid.uuid4().hex
+    try:
+        user_id = await require_user(http_request, request.user_id)
+        if request.id:
+            await check_conversation_owner(conversation_id, user_id, create=True)
+    except AccessDenied as e:
+        return e.response()
+    STORAGE_BUFFER.add_conversation(conversation_id, user_id, request.title)
+    return {"id": conversation_id, "success": True}
+
+
+@api_router.post("/conversations/{conversation_id}/messages")
+async def save_messages(conversation_id: str, request: SaveMessagesRequest, http_request: Request):
+    try:
+        user_id = await require_user(http_request, request.user_id)
+        await check_conversation_owner(conversation_id, user_id, create=True)
+    except AccessDenied as e:
+        return e.response()
+    ids = STORAGE_BUFFER.add_messages(
+        conversation_id,
+        user_id,
+        [m.model_dump() for m in request.messages]
+    )
+    return {"conversation_id": conversation_id, "message_ids": ids, "success": True}
+
+
+@api_router.delete("/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str, http_request: Request):
+    try:
+        user_id = await require_user(http_request)
+        await check_conversation_owner(conversation_id, user_id)
+    except AccessDenied as e:
+        return e.response()
+    # Pending writes go first, so a later flush cannot bring the conversation back
+    if STORAGE_BUFFER.pending():
+        await STORAGE_BUFFER.flush()
+    await asyncio.to_thread(get_storage().delete_conversation, conversation_id)
+    HISTORY_CACHE.delete(conversation_id)
+    CONVERSATION_OWNERS.delete(conversation_id)
+    return {"conversation_id": conversation_id, "deleted": True, "success": True}
+
+
 # ---------- MEMORY EXTRACTION ----------
+# With a conversation_id, extraction is incremental: the shared cache keeps a
+# high-water mark (fingerprints of the last processed messages) per conversation
+# and only turns after it, plus a little overlap for context, go to the LLM.
+MEMORY_EXTRACT_WINDOW = 20
+MEMORY_EXTRACT_OVERLAP = int(os.environ.get('MEMORY_EXTRACT_OVERLAP', '2'))
+MEMORY_HWM_TTL = float(os.environ.get('MEMORY_HWM_TTL', str(7 * 24 * 3600)))
+MEMORY_HWM_TAIL = 3
+
+
+def message_fingerprint(message: ChatMessage) -> str:
+    """The client's message id when it sent one, otherwise a hash of role and content."""
+    if message.get("id"):
+        return f"id:{message['id']}"
+    return "sha1:" + hashlib.sha1(f"{message['role']}\n{message['content']}".encode("utf-8")).hexdigest()[:16]
+
+
+def unseen_messages(messages: List[ChatMessage], tail: Optional[List[str]]) -> int:
+    """
+    Index of the first message after the high-water mark. The mark is the tail of
+    fingerprints from the last run, matched as a sequence (latest match wins) so a
+    repeated "ok" cannot be mistaken for it. Returns 0 when the mark is not found.
+    """
+    if not tail:
+        return 0
+    prints = [message_fingerprint(m) for m in messages]
+    n = len(tail)
+    for end in range(len(prints), 0, -1):
+        start = max(0, end - n)
+        if prints[start:end] == tail[n - (end - start):]:
+            return end
+    return 0
+
+
+def _hwm_key(user_id: str, conversation_id: str) -> str:
+    # Per caller too: conversation ids come from the client, so another user
+    # sending the same id must not move (or read) this user's mark
+    return cache_key("memory_hwm", user_id, conversation_id)
+
+
+def load_high_water_mark(user_id: str, conversation_id: str) -> Optional[List[str]]:
+    try:
+        return get_cache().get(_hwm_key(user_id, conversation_id))
+    except Exception as e:
+        logger.warning(f"High-water mark read failed for {conversation_id}: {e}")
+        return None
+
+
+def save_high_water_mark(user_id: str, conversation_id: str, messages: List[ChatMessage]) -> None:
+    tail = [message_fingerprint(m) for m in messages[-MEMORY_HWM_TAIL:]]
+    try:
+        get_cache().set(_hwm_key(user_id, conversation_id), tail, MEMORY_HWM_TTL)
+    except Exception as e:
+        logger.warning(f"High-water mark write failed for {conversation_id}: {e}")
+
+
+def format_extraction_window(messages: List[ChatMessage], conversation_id: Optional[str],
+                             user_id: str) -> Optional[str]:
+    """
+    Renders the turns the extractor should read, or None when nothing new needs
+    extracting (no unseen user message since the high-water mark).
+    """
+    window = messages[-MEMORY_EXTRACT_WINDOW:]
+    if not conversation_id:
+        return "\n".join(f"{m['role'].upper()}: {m['content']}" for m in window)
+
+    start = unseen_messages(window, load_high_water_mark(user_id, conversation_id))
+    new = window[start:]
+    if not any(m["role"] == "user" for m in new):
+        return None
+    overlap = window[max(0, start - MEMORY_EXTRACT_OVERLAP):start]
+    lines = [f"{m['role'].upper()}: {m['content']}" for m in new]
+    if overlap:
+        lines = (
+            ["(earlier, already processed — context only)"]
+            + [f"{m['role'].upper()}: {m['content']}" for m in overlap]
+            + ["(new)"]
+            + lines
+        )
+    METRICS.inc("memory_extract_messages_total", len(new))
+    return "\n".join(lines)
+
+
+# The extractor streams its answer. An incremental parser skips any fences or
+# preamble, validates each top-level field against MEMORY_EXTRACT_SCHEMA as soon
+# as its value is complete, and the upstream stream is closed the moment the
+# object's closing brace arrives, so trailing chatter is never generated.
+MEMORY_EXTRACT_MAX_TOKENS = 600
+MEMORY_EXTRACT_LIST_ITEMS = 10
+MEMORY_EXTRACT_TEXT_CHARS = 200
+MEMORY_EXTRACT_SCHEMA = {
+    "preferred_name": ("text", None),
+    "language_style": ("choice", ("hindi", "english", "hinglish")),
+    "new_interests": ("list", None),
+    "skill_level": ("choice", ("beginner", "intermediate", "advanced")),
+    "new_goals": ("list", None),
+    "new_facts": ("list", None),
+    "communication_preferences": ("choice", ("casual", "formal", "funny")),
+    "new_favorite_things": ("list", None),
+    "current_topic": ("text", None),
+    "emotional_state": ("choice", ("happy", "stressed", "excited", "sad", "confused", "neutral")),
+}
+NULL_STRINGS = {"", "null", "none", "n/a", "unknown"}
+
+
+def _is_blank(value) -> bool:
+    return value is None or (isinstance(value, str) and value.strip().lower() in NULL_STRINGS)
+
+
+def _clean_text(value) -> Optional[str]:
+    if not isinstance(value, str) or _is_blank(value):
+        return None
+    return value.strip()[:MEMORY_EXTRACT_TEXT_CHARS]
+
+
+def validate_memory_field(key: str, value):
+    """The value coerced to its schema type, or None when it doesn't fit (or the key is unknown)."""
+    kind, choices = MEMORY_EXTRACT_SCHEMA.get(key, (None, None))
+    if kind == "list":
+        if not isinstance(value, list):
+            return None
+        items = [item for item in (_clean_text(v) for v in value) if item]
+        return items[:MEMORY_EXTRACT_LIST_ITEMS]
+    text = _clean_text(value)
+    if kind == "text":
+        return text
+    if kind == "choice" and text and text.lower() in choices:
+        return text.lower()
+    return None
+
+
+class MemoryJSONParser:
+    """
+    Incremental parser for the extractor's top-level JSON object. feed() takes
+    text deltas and returns True once the object is closed; `fields` holds every
+    member validated so far, so a truncated answer still yields what arrived.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.rejected = []
+        self.complete = False
+        self._member = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if self.complete:
+                break
+            if self._depth == 0:
+                # Outside the object: fences, "Here is the JSON:" and the like
+                if ch == "{":
+                    self._depth = 1
+                continue
+            if self._in_string:
+                self._member.append(ch)
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._close_member()
+                    self.complete = True
+                    break
+            elif ch == "," and self._depth == 1:
+                self._close_member()
+                continue
+            self._member.append(ch)
+        return self.complete
+
+    def _close_member(self):
+        member = "".join(self._member).strip()
+        self._member = []
+        if not member:
+            return
+        try:
+            pair = json.loads("{" + member + "}")
+        except json.JSONDecodeError:
+            self.rejected.append(member[:40])
+            return
+        for key, value in pair.items():
+            if key not in MEMORY_EXTRACT_SCHEMA:
+                continue
+            cleaned = validate_memory_field(key, value)
+            if cleaned is None and not _is_blank(value):
+                self.rejected.append(key)
+            self.fields[key] = cleaned
+
+
+def read_memory_extraction(response, deadline: Optional[Deadline] = None) -> tuple:
+    """
+    Consumes a streaming extraction response through MemoryJSONParser and closes
+    it as soon as the object is complete. Returns (fields or None, stream result).
+    """
+    parser = MemoryJSONParser()
+    result = {"text": ""}
+    try:
+        for chunk_data in _iter_stream_chunks(response):
+            if deadline is not None and deadline.expired():
+                result["finish_reason"] = "deadline"
+                record_deadline_miss("memory_extract")
+                break
+            content = _read_stream_chunk(chunk_data, result)
+            if content and parser.feed(content):
+                if not result.get("finish_reason"):
+                    result["finish_reason"] = "parsed"
+                    METRICS.inc("memory_extract_early_close")
+                break
+    except requests.exceptions.RequestException as e:
+        result["finish_reason"] = "timeout"
+        logger.warning(f"⏱️ Memory extraction stream stalled: {e}")
+    finally:
+        response.close()
+
+    if parser.rejected:
+        logger.warning(f"Memory extraction dropped invalid fields: {parser.rejected}")
+    METRICS.inc("memory_extract_completion_tokens_total", completion_tokens(result))
+    if not parser.fields:
+        return None, result
+    if not parser.complete:
+        METRICS.inc("memory_extract_partial")
+    return parser.fields, result
+
+
 @api_router.post("/memory/extract", response_model=ExtractMemoryResponse)
-async def extract_memory(request: ExtractMemoryRequest):
+async def extract_memory(request: ExtractMemoryRequest, http_request: Request):
+    try:
+        request.user_id = await quota_identity(http_request, request.user_id)
+    except AccessDenied as e:
+        return e.response()
+    deadline = request_deadline(None, http_request.headers.get(DEADLINE_HEADER), MEMORY_EXTRACT_DEADLINE_MS)
     try:
-        if not SARVAM_API_KEY:
-            logger.error("SARVAM_API_KEY not configured")
+        if not llm_router().configured():
+            logger.error("No LLM provider configured")
             return ExtractMemoryResponse(
                 updated_memory=request.current_memory or UserMemory(),
                 extracted_facts=[]
             )
 
-        conversation_text = "\n".join(
-            [f"{m.role.upper()}: {m.content}" for m in request.messages[-20:]]
-        )
         current = request.current_memory or UserMemory()
+        if BROWNOUT.active(LEVEL_SKIP_EXTRACTION, "extraction"):
+            # High-water mark is left alone so these turns are picked up once load drops
+            return ExtractMemoryResponse(updated_memory=current, extracted_facts=[])
+        try:
+            TOKEN_LEDGER.check(request.user_id, "memory")
+        except QuotaExceeded:
+            # Same here: the turns stay unprocessed until the user's window frees up
+            return ExtractMemoryResponse(updated_memory=current, extracted_facts=[])
+        conversation_text = format_extraction_window(request.messages, request.conversation_id, request.user_id)
+        if conversation_text is None:
+            METRICS.inc("memory_extract_skipped")
+            if request.conversation_id:
+                save_high_water_mark(request.user_id, request.conversation_id, request.messages)
+            return ExtractMemoryResponse(updated_memory=current, extracted_facts=[])
 
         prompt = f"""You are a smart personal memory assistant. Your job: read this conversation and extract EVERY useful personal detail about the USER (not the AI).
 
@@ -1042,38 +5288,25 @@ Return ONLY this JSON (no markdown, no explanation):
             {"role": "user", "content": prompt}
         ]
 
-        response = call_sarvam_api(messages, stream=False, max_tokens=600, temperature=0.1)
+        response = await run_upstream(
+            call_llm, messages, stream=True, max_tokens=MEMORY_EXTRACT_MAX_TOKENS, temperature=0.1, deadline=deadline
+        )
 
         if response.status_code != 200:
             logger.error(f"Memory extraction API error: {response.status_code}")
+            response.close()
             return ExtractMemoryResponse(updated_memory=current, extracted_facts=[])
 
-        response_data = response.json()
-        response_text = response_data["choices"][0]["message"]["content"]
-
-        try:
-            clean = response_text.strip()
-            if clean.startswith("```"):
-                clean = re.sub(r'^```(?:json)?\n?', '', clean)
-                clean = re.sub(r'\n?```$', '', clean)
-            brace_count = 0
-            end_idx = 0
-            for i, ch in enumerate(clean):
-                if ch == '{':
-                    brace_count += 1
-                elif ch == '}':
-                    brace_count -= 1
-                    if brace_count == 0:
-                        end_idx = i + 1
-                        break
-            if end_idx:
-                clean = clean[:end_idx]
-
-            extracted = json.loads(clean)
-        except Exception:
-            logger.error(f"JSON parse failed: {response_text}")
+        extracted, result = await run_upstream(read_memory_extraction, response, deadline)
+        record_usage(request, "memory", messages, result)
+        if extracted is None:
+            logger.error(f"JSON parse failed: {result['text'][:300]}")
             return ExtractMemoryResponse(updated_memory=current, extracted_facts=[])
 
+        if request.conversation_id:
+            save_high_water_mark(request.user_id, request.conversation_id, request.messages)
+        METRICS.inc("memory_extract_prompt_tokens_total", estimate_message_tokens(messages))
+
         current_topics = list(current.recent_topics or [])
         new_topic = extracted.get("current_topic")
         if new_topic and new_topic.strip():
@@ -1112,13 +5345,79 @@ Return ONLY this JSON (no markdown, no explanation):
         )
 
 
-# ============== Mount Router & Middleware ==============
+# ============== App Factory ==============
+# Importing this module only defines things. Upstream sessions, background tasks
+# and optional-module imports are created by create_app()'s lifespan, so a worker
+# pays for them once it starts serving, and scripts that import the module
+# (benchmark.py, replay_harness.py) don't pay for them at all.
+
+class AppConfig(BaseModel):
+    cors_origins: List[str] = os.environ.get('CORS_ORIGINS', '*').split(',')
+    upstream_pool_size: int = UPSTREAM_POOL_SIZE
+    upstream_io_threads: int = UPSTREAM_IO_THREADS
+    # Imported in the background right after startup instead of on first use
+    warmup_modules: List[str] = WARMUP_MODULES
+
+
+# Seconds spent running this module's body, in the lifespan's startup, and from
+# startup until the first passing readiness check
+STARTUP_STATE = {"module_seconds": None, "startup_seconds": None, "ready_seconds": None}
+_started_at: Optional[float] = None
+
+
+def log_configuration() -> None:
+    if not SARVAM_API_KEYS:
+        logger.warning("❌ SARVAM_API_KEY not found in .env file!")
+    logger.info(
+        f"🔑 Sarvam API keys in pool: {len(SARVAM_API_KEYS)} | providers={[p.name for p in llm_router().providers]} "
+        f"| tavily={'on' if TAVILY_API_KEY else 'off'} | storage={STORAGE_BACKEND}"
+    )
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _started_at
+    config: AppConfig = app.state.config
+    check_auth_config()
+    with queued_logging():
+        _started_at = time.perf_counter()
+        open_llm_router()
+        log_configuration()
+        open_upstream_session(config.upstream_pool_size)
+        open_upstream_executor(config.upstream_io_threads)
+        await start_brownout()
+        await start_storage()
+        await start_upstream_health(config.warmup_modules)
+        STARTUP_STATE["startup_seconds"] = round(time.perf_counter() - _started_at, 3)
+        METRICS.set_gauge("startup_seconds", STARTUP_STATE["startup_seconds"])
+        logger.info(f"🚀 Started in {STARTUP_STATE['startup_seconds']:.3f}s (module load {STARTUP_STATE['module_seconds']:.3f}s)")
+        try:
+            yield
+        finally:
+            await stop_upstream_health()
+            await stop_storage()
+            await stop_brownout()
+            close_upstream_executor()
+            close_upstream_session()
+            close_llm_router()
+
+
+def create_app(config: Optional[AppConfig] = None) -> FastAPI:
+    """Builds the ASGI app. `uvicorn server:app` serves the default one; `uvicorn --factory server:create_app` works too."""
+    app = FastAPI(lifespan=lifespan)
+    app.state.config = config or AppConfig()
+    app.add_api_route("/", root, methods=["GET"])
+    app.include_router(api_router)
+    app.add_middleware(RequestDecompressionMiddleware)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=app.state.config.cors_origins,
+        allow_methods=["*"],
+        allow_headers=["*"]
+    )
+    return app
+
 
-app.include_router(api_router)
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"]
-)
\ No newline at end of file
+app = create_app()
+STARTUP_STATE["module_seconds"] = round(time.perf_counter() - IMPORT_STARTED, 3)
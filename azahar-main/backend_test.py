@@ -1,3 +1,4 @@
+import os
 import requests
 import sys
 import json
@@ -54,6 +55,26 @@ class NexAIBackendTester:
         )
         return success
 
+    def test_liveness_endpoint(self):
+        """Test the liveness probe"""
+        success, response = self.run_test(
+            "Liveness Probe",
+            "GET",
+            "api/health/live",
+            200
+        )
+        return success
+
+    def test_readiness_endpoint(self):
+        """Test the readiness probe (requires warmed, reachable upstreams)"""
+        success, response = self.run_test(
+            "Readiness Probe",
+            "GET",
+            "api/health/ready",
+            200
+        )
+        return success
+
     def test_root_endpoint(self):
         """Test the root API endpoint"""
         success, response = self.run_test(
@@ -184,6 +205,89 @@ class NexAIBackendTester:
         
         return success
 
+    def test_chat_batch_endpoint(self):
+        """Test the batch chat endpoint returns one NDJSON line per item"""
+        test_data = {
+            "items": [
+                {"messages": [{"role": "user", "content": "What is gravity?"}], "active_mode": "learn"},
+                {"messages": [{"role": "user", "content": "Hello!"}]}
+            ],
+            "concurrency": 2
+        }
+
+        success, response = self.run_test(
+            "Chat Batch Endpoint",
+            "POST",
+            "api/chat/batch",
+            200,
+            data=test_data
+        )
+
+        if success and response:
+            lines = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+            indexes = sorted(line.get("index") for line in lines)
+            if indexes == [0, 1]:
+                print(f"   ✅ Received a result for every batch item")
+                return True
+            else:
+                print(f"   ❌ Expected results for items [0, 1], got: {indexes}")
+                return False
+
+        return success
+
+    def test_save_messages_endpoint(self):
+        """Test conversations and messages can be queued for persistence (needs NEX_TEST_ID_TOKEN)"""
+        success, response = self.run_test(
+            "Save Conversation Without Token",
+            "POST",
+            "api/conversations",
+            401,
+            data={"title": "Backend test"}
+        )
+        token = os.environ.get("NEX_TEST_ID_TOKEN")
+        if not token:
+            print("   ⏭️  Set NEX_TEST_ID_TOKEN to a Firebase ID token to test authenticated writes")
+            return success
+        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {token}'}
+
+        success, response = self.run_test(
+            "Save Conversation Endpoint",
+            "POST",
+            "api/conversations",
+            200,
+            data={"title": "Backend test"},
+            headers=headers
+        )
+        if not (success and response):
+            return False
+
+        conversation_id = response.json().get("id")
+        test_data = {
+            "messages": [
+                {"role": "user", "content": "Hello!"},
+                {"role": "assistant", "content": "Hi there!"}
+            ]
+        }
+        success, response = self.run_test(
+            "Save Messages Endpoint",
+            "POST",
+            f"api/conversations/{conversation_id}/messages",
+            200,
+            data=test_data,
+            headers=headers
+        )
+
+        if success and response:
+            ids = response.json().get("message_ids", [])
+            if len(ids) == 2:
+                print(f"   ✅ Queued 2 messages for conversation {conversation_id}")
+                return True
+            else:
+                print(f"   ❌ Expected 2 message ids, got: {ids}")
+                return False
+
+        return success
+
     def test_memory_extract_endpoint(self):
         """Test the memory extract endpoint"""
         test_data = {
@@ -230,10 +334,14 @@ def main():
     # Run all tests
     tests = [
         tester.test_health_endpoint,
+        tester.test_liveness_endpoint,
+        tester.test_readiness_endpoint,
         tester.test_root_endpoint,
         tester.test_chat_stream_endpoint,
         tester.test_chat_stream_with_startup_mode,
         tester.test_memory_extract_endpoint,
+        tester.test_chat_batch_endpoint,
+        tester.test_save_messages_endpoint,
         tester.test_chat_stream_with_learn_mode,
         tester.test_chat_stream_with_english_mode
     ]
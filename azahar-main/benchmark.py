@@ -0,0 +1,520 @@
+"""
+Micro-benchmarks for the Nex.AI backend's hot paths.
+
+Each benchmark imports the backend module directly (no server needed) and
+prints size and timing comparisons between the current and previous code paths.
+
+Usage:
+    python benchmark.py search-packing
+    python benchmark.py search-packing --results recorded_tavily.json --budget 250
+    python benchmark.py request-decoding --messages 10 40 100
+    python benchmark.py compression --coalesce 1 4 8
+    python benchmark.py memory-selection --items 10 40 120
+    python benchmark.py turn-retrieval --messages 60 200 1000
+    python benchmark.py cold-start --runs 5 --mock-upstream
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Optional
+
+import requests
+from pydantic import BaseModel
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server  # noqa: E402
+
+
+def timed(func, *args, repeat=200, **kwargs):
+    """Runs func `repeat` times; returns (last result, median microseconds)."""
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        samples.append((time.perf_counter() - started) * 1_000_000)
+    return result, statistics.median(samples)
+
+
+def print_row(label, *values):
+    print(f"   {label:<28}" + "".join(f"{v:>14}" for v in values))
+
+
+# ---------- search-packing ----------
+
+SAMPLE_SEARCHES = [
+    {
+        "query": "latest news on India's Chandrayaan mission",
+        "results": [
+            {"title": "Chandrayaan-4 gets cabinet approval - The Hindu",
+             "url": "https://www.thehindu.com/sci-tech/science/chandrayaan-4-approval/article1.ece",
+             "content": "The Union Cabinet approved the Chandrayaan-4 mission on Wednesday. The mission aims to bring lunar samples back to Earth. ISRO chairman said the launch is planned for 2027. The mission will use two separate launches and dock modules in orbit. Subscribe to our newsletter for more science updates."},
+            {"title": "Cabinet approves Chandrayaan-4 lunar sample return mission",
+             "url": "https://indianexpress.com/article/technology/science/chandrayaan-4-cabinet/",
+             "content": "The Union Cabinet approved the Chandrayaan-4 mission on Wednesday, officials said. The mission aims to bring lunar samples back to Earth for analysis. Read more: Gaganyaan timeline explained. Follow us on social media for the latest updates."},
+            {"title": "ISRO plans 2027 launch for Chandrayaan-4",
+             "url": "https://www.ndtv.com/india-news/isro-chandrayaan-4-2027",
+             "content": "ISRO is targeting 2027 for the Chandrayaan-4 launch. The sample-return mission will involve docking of modules in lunar orbit, a first for India. Cost estimates place the mission at around Rs 2,104 crore. Chandrayaan-3 landed near the lunar south pole in August 2023."},
+            {"title": "What is Chandrayaan? Everything you need to know",
+             "url": "https://www.jagranjosh.com/general-knowledge/chandrayaan",
+             "content": "Chandrayaan is India's lunar exploration programme. Chandrayaan-1 launched in 2008 and discovered water molecules on the Moon. Chandrayaan-2 launched in 2019. Chandrayaan-3 landed near the lunar south pole in August 2023. Click here to download the GK PDF."},
+            {"title": "Space stocks rally after ISRO announcements",
+             "url": "https://www.moneycontrol.com/news/business/markets/space-stocks-rally",
+             "content": "Shares of space-tech companies rose after ISRO's announcements this week. Analysts expect increased private participation in upcoming missions. Disclaimer: investment in securities is subject to market risks."},
+        ],
+    },
+    {
+        "query": "weather in Delhi today",
+        "results": [
+            {"title": "Delhi Weather Today - IMD forecast",
+             "url": "https://mausam.imd.gov.in/delhi",
+             "content": "Delhi will see a maximum temperature of 34 degrees Celsius today with clear skies. Minimum temperature is expected around 21 degrees. Air quality remains in the poor category. Humidity will range between 40 and 75 percent."},
+            {"title": "Delhi weather: clear skies, AQI poor",
+             "url": "https://www.hindustantimes.com/cities/delhi-news/delhi-weather-today",
+             "content": "Delhi will see a maximum temperature of 34 degrees Celsius today with clear skies, the IMD said. Air quality in Delhi remains in the poor category with an AQI of 245. Download the HT app for live updates."},
+            {"title": "Delhi 10-day forecast",
+             "url": "https://www.accuweather.com/en/in/delhi/202396/daily-weather-forecast/202396",
+             "content": "Tomorrow: sunny, high 35, low 22. Thursday: partly cloudy, high 33. Friday: chance of light rain in the evening. Weekend temperatures stay near 32 degrees."},
+        ],
+    },
+]
+
+
+def bench_search_packing(args):
+    searches = SAMPLE_SEARCHES
+    if args.results:
+        with open(args.results, encoding="utf-8") as f:
+            searches = json.load(f)
+
+    print(f"🔎 Search context packing (budget={args.budget} tokens)")
+    print("=" * 50)
+    print_row("query", "legacy tok", "packed tok", "reduction", "pack µs")
+    legacy_total = packed_total = 0
+    for search in searches:
+        legacy = server.format_search_results(search["results"])
+        packed, micros = timed(server.pack_search_context, search["query"], search["results"], args.budget)
+        legacy_tokens = server.estimate_tokens(legacy)
+        packed_tokens = server.estimate_tokens(packed)
+        legacy_total += legacy_tokens
+        packed_total += packed_tokens
+        reduction = (1 - packed_tokens / legacy_tokens) * 100 if legacy_tokens else 0
+        print_row(search["query"][:28], legacy_tokens, packed_tokens, f"{reduction:.1f}%", f"{micros:.0f}")
+        if args.verbose:
+            print("\n" + packed + "\n")
+    if legacy_total:
+        print_row("TOTAL", legacy_total, packed_total, f"{(1 - packed_total / legacy_total) * 100:.1f}%", "")
+    return 0
+
+
+# ---------- request-decoding ----------
+
+class LegacyChatMessage(BaseModel):
+    role: str
+    content: str
+
+
+class LegacyChatRequest(BaseModel):
+    """ChatRequest as it was before messages became TypedDicts."""
+    messages: List[LegacyChatMessage]
+    user_name: str = "friend"
+    conversation_id: Optional[str] = None
+    user_memory: Optional[server.UserMemory] = None
+    active_mode: Optional[str] = None
+
+
+def sample_chat_body(n_messages, chars):
+    sentence = "Can you explain how photosynthesis turns sunlight into sugar? "
+    content = (sentence * (chars // len(sentence) + 1))[:chars]
+    return json.dumps({
+        "messages": [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": content}
+            for i in range(n_messages)
+        ],
+        "user_name": "Priya",
+        "conversation_id": "bench",
+        "active_mode": "learn",
+        "user_memory": {"preferred_name": "Priya", "interests": ["space", "biology"], "goals": ["pass NEET"]},
+    }).encode("utf-8")
+
+
+def bench_request_decoding(args):
+    provider = server.llm_router().primary
+
+    def legacy(body):
+        # FastAPI body parameter: json.loads, model validation, then dicts rebuilt for the payload
+        request = LegacyChatRequest.model_validate(json.loads(body))
+        history = [{"role": m.role, "content": m.content} for m in request.messages]
+        return provider.normalize_messages(history)
+
+    def fast(body):
+        request = server.decode_body(server.ChatRequest, body)
+        return provider.normalize_messages(request.messages)
+
+    print(f"📥 Chat request decoding + payload messages ({provider.name}, {args.chars} chars/message)")
+    print("=" * 50)
+    print_row("messages", "body KB", "legacy µs", "fast µs", "speedup")
+    for n in args.messages:
+        body = sample_chat_body(n, args.chars)
+        legacy_out, legacy_us = timed(legacy, body, repeat=args.repeat)
+        fast_out, fast_us = timed(fast, body, repeat=args.repeat)
+        assert legacy_out == fast_out, "decode paths disagree"
+        print_row(n, f"{len(body) / 1024:.1f}", f"{legacy_us:.1f}", f"{fast_us:.1f}", f"{legacy_us / fast_us:.2f}x")
+    return 0
+
+
+# ---------- compression ----------
+
+SAMPLE_REPLY = (
+    "Photosynthesis is how plants turn light into food. 🌱 Chlorophyll in the leaves absorbs sunlight, "
+    "and that energy splits water into oxygen, protons and electrons. The electrons power the Calvin cycle, "
+    "which fixes carbon dioxide from the air into glucose. So every leaf is basically a tiny solar-powered "
+    "sugar factory! The oxygen we breathe is the by-product. Want me to walk through the light and dark "
+    "reactions step by step, Priya? 💡"
+)
+
+
+def sse_frames(reply, coalesce):
+    """The reply as server SSE events (one word each), grouped `coalesce` events per frame."""
+    events = [
+        server.sse_event(i + 1, f"data: {json.dumps({'word': word + ' '})}\n\n")
+        for i, word in enumerate(reply.split(" "))
+    ]
+    events.append(server.sse_event(len(events) + 1, f"data: {json.dumps({'done': True})}\n\n"))
+    return [
+        "".join(events[i:i + coalesce]).encode("utf-8")
+        for i in range(0, len(events), coalesce)
+    ], len(events)
+
+
+def compress_stream(frames, encoding):
+    compressor = server.StreamCompressor(encoding)
+    sent = sum(len(compressor.compress(frame)) for frame in frames)
+    return sent + len(compressor.finish())
+
+
+def bench_compression(args):
+    encodings = ["gzip"] + (["br"] if server.brotli is not None else [])
+
+    print(f"📦 Request bodies ({args.chars} chars/message)")
+    print("=" * 50)
+    print_row("messages / encoding", "raw B", "sent B", "saved", "inflate µs")
+    for n in args.messages:
+        body = sample_chat_body(n, args.chars)
+        for encoding in encodings:
+            if encoding == "gzip":
+                compressed = zlib.compress(body, server.GZIP_LEVEL, wbits=31)
+            else:
+                compressed = server.brotli.compress(body, quality=server.BROTLI_QUALITY)
+            _, micros = timed(server.decompress_body, compressed, encoding, repeat=args.repeat)
+            saved = (1 - len(compressed) / len(body)) * 100
+            print_row(f"{n} / {encoding}", len(body), len(compressed), f"{saved:.1f}%", f"{micros:.1f}")
+
+    text_bytes = len(SAMPLE_REPLY.encode("utf-8"))
+    print(f"\n📡 SSE reply ({text_bytes} B of text)")
+    print("=" * 50)
+    print_row("events/frame / encoding", "frames", "sent B", "vs raw", "µs/event")
+    for coalesce in args.coalesce:
+        frames, n_events = sse_frames(SAMPLE_REPLY, coalesce)
+        raw = sum(len(f) for f in frames)
+        print_row(f"{coalesce} / identity", len(frames), raw, "", "")
+        for encoding in encodings:
+            sent, micros = timed(compress_stream, frames, encoding, repeat=args.repeat)
+            print_row(f"{coalesce} / {encoding}", len(frames), sent, f"{(1 - sent / raw) * 100:.1f}%", f"{micros / n_events:.2f}")
+    return 0
+
+
+# ---------- memory-selection ----------
+
+MEMORY_POOL = {
+    "interests": ["cricket", "python programming", "bollywood music", "cooking biryani", "chess", "photography",
+                  "travel vlogs", "anime", "stock market investing", "football", "astronomy", "guitar covers"],
+    "goals": ["crack NEET exam", "learn guitar", "get fit by running 5k", "start a youtube channel",
+              "save money for a bike", "improve spoken english", "get an internship in data science"],
+    "personal_facts": ["lives in Jaipur", "studies biology at DU", "has a younger brother", "allergic to peanuts",
+                       "works part time at a cafe", "wakes up at 6am", "father is a teacher", "moved to Delhi in 2023",
+                       "struggles with exam anxiety", "plays in the college cricket team"],
+    "favorite_things": ["movie 3 Idiots", "song Kesariya", "food pani puri", "game Valorant", "book Atomic Habits",
+                        "series Kota Factory", "singer Arijit Singh", "chai at night"],
+    "recent_topics": ["photosynthesis basics", "running shoes", "IPL auction", "resume tips", "guitar chords"],
+}
+
+MEMORY_QUERIES = [
+    "explain photosynthesis for my neet prep",
+    "which running shoes should I buy for 5k training?",
+    "hi",
+    "yaar exam ki tension ho rahi hai, kya karu?",
+    "how do I start investing in the stock market with little money",
+    "suggest a good chord progression for a guitar cover",
+]
+
+
+def sample_memory(n_items):
+    fields = list(MEMORY_POOL)
+    lists = {field: [] for field in fields}
+    for i in range(n_items):
+        field = fields[i % len(fields)]
+        pool = MEMORY_POOL[field]
+        item = pool[(i // len(fields)) % len(pool)]
+        lists[field].append(item if i < len(fields) * len(pool) else f"{item} ({i})")
+    return server.UserMemory(preferred_name="Priya", language_style="hinglish", skill_level="beginner",
+                             emotional_state="stressed", **lists)
+
+
+def bench_memory_selection(args):
+    print(f"🧠 Relevance-selected memory (top_k={server.MEMORY_TOP_K}, budget={server.MEMORY_TOKEN_BUDGET} tokens)")
+    print("=" * 50)
+    print_row("items", "full tok", "selected tok", "reduction", "select µs")
+    for n in args.items:
+        memory = sample_memory(n)
+        full_tokens = selected_tokens = 0
+        micros = []
+        for query in MEMORY_QUERIES:
+            full_tokens += server.estimate_tokens(server.get_default_prompt("Priya", memory, ""))
+            server.keyword_vector.cache_clear()
+            selected, us = timed(server.select_memory, memory, query, repeat=args.repeat)
+            micros.append(us)
+            selected_tokens += server.estimate_tokens(server.get_default_prompt("Priya", selected, ""))
+        full_tokens //= len(MEMORY_QUERIES)
+        selected_tokens //= len(MEMORY_QUERIES)
+        print_row(n, full_tokens, selected_tokens, f"{(1 - selected_tokens / full_tokens) * 100:.1f}%",
+                  f"{statistics.median(micros):.1f}")
+    return 0
+
+
+# ---------- turn-retrieval ----------
+
+FILLER_TURNS = [
+    ("tell me a joke", "Why did the scarecrow win an award? He was outstanding in his field! 😄"),
+    ("how do I cook rice properly", "Rinse it, use 1:2 water, simmer covered for 15 minutes, then rest it."),
+    ("recommend a movie for tonight", "Try Zindagi Na Milegi Dobara — fun, warm and great music."),
+    ("what is machine learning", "It's teaching computers to find patterns in data instead of hand-coding rules."),
+    ("how to stay motivated while studying", "Small goals, short sessions, and reward yourself after each one."),
+    ("explain gravity simply", "Mass pulls on mass — the bigger the object, the stronger the pull."),
+    ("best laptop under 50k", "Look for a Ryzen 5 or i5, 16GB RAM and an SSD in that range."),
+]
+
+PLANTED_TURNS = [
+    ("I'm reading Sapiens by Yuval Harari, it's about human history", "Great pick! The cognitive revolution chapter is wild.",
+     "what was that human history book I was reading called?"),
+    ("my dog Bruno is a golden retriever and he's been sick", "Poor Bruno! Keep him hydrated and watch his appetite.",
+     "any update ideas for my sick golden retriever?"),
+    ("my sister's wedding is in Udaipur in December", "Udaipur in December sounds magical! 💍",
+     "what should I gift at the Udaipur wedding?"),
+    ("I'm learning the guitar chords for Kesariya", "Kesariya is a lovely one to learn — G, D, Em, C mostly.",
+     "which chords did I need for that Kesariya song again?"),
+]
+
+
+def sample_conversation(n_messages):
+    """Filler exchanges with the planted facts spread through the first half."""
+    exchanges = [FILLER_TURNS[i % len(FILLER_TURNS)] for i in range(n_messages // 2)]
+    for i, (user, reply, _) in enumerate(PLANTED_TURNS):
+        exchanges[(i + 1) * len(exchanges) // (2 * len(PLANTED_TURNS) + 2)] = (user, reply)
+    messages = []
+    for user, reply in exchanges:
+        messages += [{"role": "user", "content": user}, {"role": "assistant", "content": reply}]
+    return messages
+
+
+def bench_turn_retrieval(args):
+    print(f"🔎 Older-turn retrieval (window={args.window}, top_k={server.RETRIEVAL_TOP_K}, "
+          f"budget={server.RETRIEVAL_TOKEN_BUDGET} tokens)")
+    print("=" * 50)
+    print_row("messages", "recall", "window tok", "+retrieval", "full tok", "update µs", "search µs")
+    for n in args.messages:
+        messages = sample_conversation(n)
+        hits, window_tokens, retrieval_tokens, full_tokens = 0, 0, 0, 0
+        search_micros = []
+        for i, (_, _, probe) in enumerate(PLANTED_TURNS):
+            turn = messages + [{"role": "user", "content": probe}]
+            cutoff = len(turn) - args.window
+            window_tokens += server.estimate_message_tokens(turn[cutoff:])
+            full_tokens += server.estimate_message_tokens(turn)
+            server.TURN_INDEXES.clear()
+            block = server.retrieve_older_turns(f"bench-{n}", turn, cutoff, probe)
+            retrieval_tokens += server.estimate_tokens(block)
+            hits += PLANTED_TURNS[i][0] in block
+            _, us = timed(server.TURN_INDEXES[f"bench-{n}"].search, probe, cutoff, repeat=args.repeat)
+            search_micros.append(us)
+        # One incremental update: the exchange that just left the window
+        update_micros = []
+        for _ in range(args.repeat):
+            server.TURN_INDEXES.clear()
+            index = server.turn_index("bench")
+            index.update(messages, len(messages) - args.window - 2)
+            started = time.perf_counter()
+            index.update(messages, len(messages) - args.window)
+            update_micros.append((time.perf_counter() - started) * 1_000_000)
+        probes = len(PLANTED_TURNS)
+        print_row(n, f"{hits}/{probes}", window_tokens // probes, (window_tokens + retrieval_tokens) // probes,
+                  full_tokens // probes, f"{statistics.median(update_micros):.1f}",
+                  f"{statistics.median(search_micros):.1f}")
+    return 0
+
+
+# ---------- cold-start ----------
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+IMPORT_PROBE = "import time; started = time.perf_counter(); import server; print(time.perf_counter() - started)"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, started, timeout, status=200):
+    """Polls url until it answers with `status`; returns ms since `started` (None on timeout) and the last body."""
+    while time.perf_counter() - started < timeout:
+        try:
+            response = requests.get(url, timeout=0.5)
+            if response.status_code == status:
+                return (time.perf_counter() - started) * 1000, response.json()
+        except requests.RequestException:
+            pass
+        time.sleep(0.01)
+    return None, None
+
+
+class StubUpstreamHandler(BaseHTTPRequestHandler):
+    """Answers every chat completion with a fixed reply, like a fast OpenAI-compatible endpoint."""
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({
+            "choices": [{"message": {"role": "assistant", "content": "Hello from the stub upstream!"},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 5},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_upstream() -> ThreadingHTTPServer:
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubUpstreamHandler)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    return stub
+
+
+def bench_cold_start(args):
+    print(f"🧊 Cold start ({args.runs} runs, fresh interpreter each)")
+    print("=" * 50)
+    imports = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=BACKEND_DIR,
+                             capture_output=True, text=True, check=True)
+        imports.append(float(out.stdout.strip().splitlines()[-1]) * 1000)
+
+    env = dict(os.environ)
+    stub = None
+    if args.mock_upstream:
+        # Readiness then depends only on startup and warm-up, not on reaching Sarvam
+        stub = start_stub_upstream()
+        env["LLM_PROVIDERS"] = json.dumps([{
+            "type": "openai", "name": "stub", "model": "stub-1", "api_key": "stub",
+            "url": f"http://127.0.0.1:{stub.server_address[1]}/v1/chat/completions",
+        }])
+    first_request, ready, module, startup = [], [], [], []
+    for _ in range(args.runs):
+        port = free_port()
+        base = f"http://127.0.0.1:{port}/api"
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            ms, _ = wait_for(f"{base}/health/live", started, args.timeout)
+            if ms is None:
+                print(f"❌ Server did not answer within {args.timeout}s")
+                return 1
+            first_request.append(ms)
+            ms, _ = wait_for(f"{base}/health/ready", started, args.timeout)
+            if ms is not None:
+                ready.append(ms)
+            state = requests.get(f"{base}/health", timeout=2).json()["startup"]
+            module.append(state["module_seconds"] * 1000)
+            startup.append(state["startup_seconds"] * 1000)
+        finally:
+            process.terminate()
+            process.wait()
+    if stub:
+        stub.shutdown()
+
+    print_row("stage", "p50 ms", "max ms")
+    for label, values in [("import server", imports), ("  module body", module), ("  lifespan startup", startup),
+                          ("process → first request", first_request), ("process → ready", ready)]:
+        if values:
+            print_row(label, f"{statistics.median(values):.1f}", f"{max(values):.1f}")
+        else:
+            print_row(label, "not ready", f"(>{args.timeout:.0f}s)")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nex.AI backend micro-benchmarks")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("search-packing", help="Prompt-size reduction from the live-search context packer")
+    p.add_argument("--results", help="JSON list of {query, results[]} recorded from Tavily")
+    p.add_argument("--budget", type=int, default=server.SEARCH_CONTEXT_TOKENS)
+    p.add_argument("--verbose", action="store_true", help="Print the packed context")
+    p.set_defaults(func=bench_search_packing)
+
+    p = sub.add_parser("request-decoding", help="Raw-body ChatRequest decoding vs the FastAPI model path")
+    p.add_argument("--messages", type=int, nargs="+", default=[10, 40, 100])
+    p.add_argument("--chars", type=int, default=300, help="Characters per message")
+    p.add_argument("--repeat", type=int, default=500)
+    p.set_defaults(func=bench_request_decoding)
+
+    p = sub.add_parser("compression", help="Bandwidth saved and CPU spent by request-body and SSE compression")
+    p.add_argument("--messages", type=int, nargs="+", default=[10, 40, 100])
+    p.add_argument("--chars", type=int, default=300, help="Characters per message")
+    p.add_argument("--coalesce", type=int, nargs="+", default=[1, 4, 8], help="SSE events per flushed frame")
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_compression)
+
+    p = sub.add_parser("memory-selection", help="Prompt tokens and latency of relevance-selected UserMemory")
+    p.add_argument("--items", type=int, nargs="+", default=[10, 40, 120], help="Memory list items per user")
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_memory_selection)
+
+    p = sub.add_parser("turn-retrieval", help="Recall and prompt tokens of older-turn retrieval vs a larger window")
+    p.add_argument("--messages", type=int, nargs="+", default=[60, 200, 1000], help="Messages per conversation")
+    p.add_argument("--window", type=int, default=server.DEFAULT_CONTEXT_LIMIT, help="Recent messages sent verbatim")
+    p.add_argument("--repeat", type=int, default=50)
+    p.set_defaults(func=bench_turn_retrieval)
+
+    p = sub.add_parser("cold-start", help="Import time and time from process start to first and ready requests")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--timeout", type=float, default=15.0, help="Seconds to wait for each server to answer/become ready")
+    p.add_argument("--mock-upstream", action="store_true", help="Serve against a local stub LLM endpoint (no network needed)")
+    p.set_defaults(func=bench_cold_start)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
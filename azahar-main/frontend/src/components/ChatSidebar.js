@@ -32,7 +32,9 @@ export const ChatSidebar = ({
   onLogout,
   user,
   userMemory,
-  loading
+  loading,
+  hasMore,
+  onLoadMore
 }) => {
   const formatDate = (date) => {
     if (!date) return '';
@@ -145,6 +147,15 @@ export const ChatSidebar = ({
                 </div>
               </motion.div>
             ))}
+            {hasMore && (
+              <button
+                onClick={onLoadMore}
+                className="w-full p-2 text-xs text-[#9CA3AF] hover:text-[#3D405B] rounded-xl hover:bg-white/50 transition-colors"
+                data-testid="load-more-conversations-btn"
+              >
+                Show older chats
+              </button>
+            )}
           </div>
         )}
       </ScrollArea>
@@ -1,6 +1,8 @@
 import { initializeApp, getApps } from 'firebase/app';
 import { getAuth, GoogleAuthProvider, signInWithPopup, createUserWithEmailAndPassword, signInWithEmailAndPassword, signOut, onAuthStateChanged, updateProfile } from 'firebase/auth';
-import { getFirestore, doc, setDoc, getDoc, collection, query, where, orderBy, limit, getDocs, addDoc, deleteDoc, updateDoc, serverTimestamp } from 'firebase/firestore';
+import { getFirestore, doc, setDoc, getDoc, serverTimestamp } from 'firebase/firestore';
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 
 const firebaseConfig = {
 apiKey: process.env.REACT_APP_FIREBASE_API_KEY,
@@ -92,6 +94,12 @@ export const logOut = async () => {
   await signOut(auth);
 };
 
+// Backend calls carry the ID token, so quotas and stored data follow the signed-in user
+export const authHeaders = async () => {
+  const token = await auth.currentUser?.getIdToken();
+  return token ? { Authorization: `Bearer ${token}` } : {};
+};
+
 // ============== User Memory Functions ==============
 
 export const getUserMemory = async (userId) => {
@@ -132,82 +140,34 @@ export const updateUserMemory = async (userId, memory) => {
 };
 
 // ============== Conversation Functions ==============
+// Conversations and messages are written by the backend: chat requests carry
+// persist: true and the backend saves each turn, so the browser makes no
+// per-message Firestore writes.
+
+const backendRequest = async (method, path, body) => {
+  const response = await fetch(`${BACKEND_URL}${path}`, {
+    method,
+    headers: { 'Content-Type': 'application/json', ...(await authHeaders()) },
+    ...(body ? { body: JSON.stringify(body) } : {})
+  });
+  if (!response.ok) throw new Error(`${method} ${path} failed: ${response.status}`);
+  return response.json();
+};
 
-export const createConversation = async (userId, title = 'New Chat') => {
+export const createConversation = async (title = 'New Chat') => {
   try {
-    const conversationRef = await addDoc(collection(db, 'conversations'), {
-      userId,
-      title,
-      createdAt: serverTimestamp(),
-      lastMessageAt: serverTimestamp()
-    });
-    console.log('Created conversation:', conversationRef.id);
-    return conversationRef.id;
+    const { id } = await backendRequest('POST', '/api/conversations', { title });
+    console.log('Created conversation:', id);
+    return id;
   } catch (error) {
     console.error('Error creating conversation:', error);
     throw error;
   }
 };
 
-export const getConversations = async (userId) => {
-  try {
-    // First try with orderBy (requires composite index)
-    const q = query(
-      collection(db, 'conversations'),
-      where('userId', '==', userId),
-      orderBy('lastMessageAt', 'desc'),
-      limit(50)
-    );
-    const snapshot = await getDocs(q);
-    const convos = snapshot.docs.map(docSnap => ({
-      id: docSnap.id,
-      ...docSnap.data(),
-      createdAt: docSnap.data().createdAt?.toDate?.() || new Date(),
-      lastMessageAt: docSnap.data().lastMessageAt?.toDate?.() || new Date()
-    }));
-    console.log('Loaded conversations:', convos.length);
-    return convos;
-  } catch (error) {
-    console.error('Error loading conversations (may need index):', error);
-    
-    // Fallback: query without orderBy and sort client-side
-    try {
-      const fallbackQuery = query(
-        collection(db, 'conversations'),
-        where('userId', '==', userId),
-        limit(50)
-      );
-      const snapshot = await getDocs(fallbackQuery);
-      const convos = snapshot.docs.map(docSnap => ({
-        id: docSnap.id,
-        ...docSnap.data(),
-        createdAt: docSnap.data().createdAt?.toDate?.() || new Date(),
-        lastMessageAt: docSnap.data().lastMessageAt?.toDate?.() || new Date()
-      }));
-      // Sort client-side
-      convos.sort((a, b) => b.lastMessageAt - a.lastMessageAt);
-      console.log('Loaded conversations (fallback):', convos.length);
-      return convos;
-    } catch (fallbackError) {
-      console.error('Fallback query also failed:', fallbackError);
-      return [];
-    }
-  }
-};
-
 export const deleteConversation = async (conversationId) => {
   try {
-    // Delete all messages in the conversation
-    const messagesQuery = query(
-      collection(db, 'messages'),
-      where('conversationId', '==', conversationId)
-    );
-    const messagesSnapshot = await getDocs(messagesQuery);
-    const deletePromises = messagesSnapshot.docs.map(docSnap => deleteDoc(docSnap.ref));
-    await Promise.all(deletePromises);
-    
-    // Delete the conversation
-    await deleteDoc(doc(db, 'conversations', conversationId));
+    await backendRequest('DELETE', `/api/conversations/${encodeURIComponent(conversationId)}`);
     console.log('Deleted conversation:', conversationId);
   } catch (error) {
     console.error('Error deleting conversation:', error);
@@ -217,10 +177,7 @@ export const deleteConversation = async (conversationId) => {
 
 export const updateConversationTitle = async (conversationId, title) => {
   try {
-    await updateDoc(doc(db, 'conversations', conversationId), {
-      title,
-      lastMessageAt: serverTimestamp()
-    });
+    await backendRequest('POST', '/api/conversations', { id: conversationId, title });
     console.log('Updated conversation title:', conversationId, title);
   } catch (error) {
     console.error('Error updating conversation title:', error);
@@ -228,77 +185,42 @@ export const updateConversationTitle = async (conversationId, title) => {
   }
 };
 
-// ============== Message Functions ==============
+// ============== History Functions ==============
+// History is read from the backend, which pages it with keyset cursors: each call
+// returns one page and the cursor for the next (older) one, or null at the end.
 
-export const saveMessage = async (conversationId, userId, role, content) => {
-  try {
-    const messageRef = await addDoc(collection(db, 'messages'), {
-      conversationId,
-      userId,
-      role,
-      content,
-      timestamp: serverTimestamp()
-    });
-    console.log('Saved message:', messageRef.id, 'to conversation:', conversationId);
-    
-    // Update conversation's lastMessageAt
-    try {
-      await updateDoc(doc(db, 'conversations', conversationId), {
-        lastMessageAt: serverTimestamp()
-      });
-    } catch (updateError) {
-      console.error('Error updating conversation lastMessageAt:', updateError);
-    }
-    
-    return messageRef.id;
-  } catch (error) {
-    console.error('Error saving message:', error);
-    throw error;
-  }
+const toDate = (seconds) => (seconds ? new Date(seconds * 1000) : new Date());
+
+const getHistoryPage = async (path, cursor, pageSize) => {
+  const params = new URLSearchParams({ limit: pageSize });
+  if (cursor) params.set('cursor', cursor);
+  return backendRequest('GET', `${path}?${params}`);
 };
 
-export const getMessages = async (conversationId, messageLimit = 50) => {
-  try {
-    // First try with orderBy (requires composite index)
-    const q = query(
-      collection(db, 'messages'),
-      where('conversationId', '==', conversationId),
-      orderBy('timestamp', 'asc'),
-      limit(messageLimit)
-    );
-    const snapshot = await getDocs(q);
-    const msgs = snapshot.docs.map(docSnap => ({
-      id: docSnap.id,
-      ...docSnap.data(),
-      timestamp: docSnap.data().timestamp?.toDate?.() || new Date()
-    }));
-    console.log('Loaded messages:', msgs.length, 'for conversation:', conversationId);
-    return msgs;
-  } catch (error) {
-    console.error('Error loading messages (may need index):', error);
-    
-    // Fallback: query without orderBy and sort client-side
-    try {
-      const fallbackQuery = query(
-        collection(db, 'messages'),
-        where('conversationId', '==', conversationId),
-        limit(messageLimit)
-      );
-      const snapshot = await getDocs(fallbackQuery);
-      const msgs = snapshot.docs.map(docSnap => ({
-        id: docSnap.id,
-        ...docSnap.data(),
-        timestamp: docSnap.data().timestamp?.toDate?.() || new Date()
-      }));
-      // Sort client-side
-      msgs.sort((a, b) => a.timestamp - b.timestamp);
-      console.log('Loaded messages (fallback):', msgs.length);
-      return msgs;
-    } catch (fallbackError) {
-      console.error('Fallback query also failed:', fallbackError);
-      return [];
-    }
-  }
+export const getConversations = async (cursor = null, pageSize = 50) => {
+  const page = await getHistoryPage('/api/conversations', cursor, pageSize);
+  const conversations = page.conversations.map(c => ({
+    id: c.id,
+    userId: c.user_id,
+    title: c.title,
+    createdAt: toDate(c.created_at),
+    lastMessageAt: toDate(c.last_message_at)
+  }));
+  console.log('Loaded conversations:', conversations.length);
+  return { conversations, nextCursor: page.next_cursor };
+};
+
+// Newest page first; messages within a page are oldest first
+export const getMessages = async (conversationId, cursor = null, pageSize = 50) => {
+  const page = await getHistoryPage(`/api/conversations/${encodeURIComponent(conversationId)}/messages`, cursor, pageSize);
+  const messages = page.messages.map(m => ({
+    id: m.id,
+    role: m.role,
+    content: m.content,
+    timestamp: toDate(m.timestamp)
+  }));
+  console.log('Loaded messages:', messages.length, 'for conversation:', conversationId);
+  return { messages, nextCursor: page.next_cursor };
 };
 
 export { auth, db, onAuthStateChanged };
@@ -11,14 +11,15 @@ import {
   createConversation, 
   deleteConversation,
   getMessages, 
-  saveMessage,
   updateConversationTitle,
   getUserMemory,
-  updateUserMemory
+  updateUserMemory,
+  authHeaders
 } from '../lib/firebase';
 import { toast } from 'sonner';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+const MAX_STREAM_RECONNECTS = 2;
 
 // Keywords to detect mode turn-off requests
 const TURN_OFF_KEYWORDS = [
@@ -38,12 +39,19 @@ export default function Chat() {
   const [sidebarOpen, setSidebarOpen] = useState(true);
   const [mobileMenuOpen, setMobileMenuOpen] = useState(false);
   const [loadingConversations, setLoadingConversations] = useState(true);
+  const [conversationsCursor, setConversationsCursor] = useState(null);
+  const [messagesCursor, setMessagesCursor] = useState(null);
+  const [loadingEarlier, setLoadingEarlier] = useState(false);
   const [userMemory, setUserMemory] = useState(null);
   const [memoryLoaded, setMemoryLoaded] = useState(false);
   const [activeMode, setActiveMode] = useState(null); // 'learn' | 'english' | null
   const [pendingModeOff, setPendingModeOff] = useState(false);
   const messagesEndRef = useRef(null);
   const abortControllerRef = useRef(null);
+  const streamKeyRef = useRef(null);
+  const prependedRef = useRef(false);
+  // A conversation created in this tab has nothing stored yet; loading it would wipe the local messages
+  const freshConversationRef = useRef(null);
 
   // Redirect if not authenticated
   useEffect(() => {
@@ -78,8 +86,9 @@ export default function Chat() {
     const loadConversations = async () => {
       if (!user) return;
       try {
-        const convos = await getConversations(user.uid);
+        const { conversations: convos, nextCursor } = await getConversations();
         setConversations(convos);
+        setConversationsCursor(nextCursor);
         if (convos.length > 0) {
           setCurrentConversationId(convos[0].id);
         }
@@ -101,11 +110,14 @@ export default function Chat() {
     const loadMessages = async () => {
       if (!currentConversationId) {
         setMessages([]);
+        setMessagesCursor(null);
         return;
       }
+      if (currentConversationId === freshConversationRef.current) return;
       try {
-        const msgs = await getMessages(currentConversationId);
+        const { messages: msgs, nextCursor } = await getMessages(currentConversationId);
         setMessages(msgs);
+        setMessagesCursor(nextCursor);
       } catch (error) {
         console.error('Error loading messages:', error);
       }
@@ -113,8 +125,42 @@ export default function Chat() {
     loadMessages();
   }, [currentConversationId]);
 
+  // Older pages are only fetched when asked for
+  const handleLoadOlderConversations = async () => {
+    if (!conversationsCursor) return;
+    try {
+      const { conversations: older, nextCursor } = await getConversations(conversationsCursor);
+      setConversations(prev => [...prev, ...older.filter(c => !prev.some(p => p.id === c.id))]);
+      setConversationsCursor(nextCursor);
+    } catch (error) {
+      console.error('Error loading older conversations:', error);
+      toast.error('Failed to load older chats');
+    }
+  };
+
+  const handleLoadEarlierMessages = async () => {
+    if (!currentConversationId || !messagesCursor || loadingEarlier) return;
+    setLoadingEarlier(true);
+    try {
+      const { messages: earlier, nextCursor } = await getMessages(currentConversationId, messagesCursor);
+      prependedRef.current = true;
+      setMessages(prev => [...earlier.filter(m => !prev.some(p => p.id === m.id)), ...prev]);
+      setMessagesCursor(nextCursor);
+    } catch (error) {
+      console.error('Error loading earlier messages:', error);
+      toast.error('Failed to load earlier messages');
+    } finally {
+      setLoadingEarlier(false);
+    }
+  };
+
   // Scroll to bottom
   useEffect(() => {
+    // Earlier messages go above what the user is reading; stay put
+    if (prependedRef.current) {
+      prependedRef.current = false;
+      return;
+    }
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, [messages, isTyping]);
 
@@ -125,16 +171,18 @@ export default function Chat() {
   };
 
   // Extract memory from conversation
-  const extractMemoryFromConversation = useCallback(async (conversationMessages) => {
+  const extractMemoryFromConversation = useCallback(async (conversationMessages, conversationId) => {
     if (!user || conversationMessages.length < 2) return;
 
     try {
       const response = await fetch(`${BACKEND_URL}/api/memory/extract`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', ...(await authHeaders()) },
         body: JSON.stringify({
-          messages: conversationMessages.slice(-10).map(m => ({ role: m.role, content: m.content })),
-          current_memory: userMemory
+          messages: conversationMessages.slice(-10).map(m => ({ id: m.id, role: m.role, content: m.content })),
+          current_memory: userMemory,
+          conversation_id: conversationId,
+          user_id: user.uid
         })
       });
 
@@ -159,7 +207,8 @@ export default function Chat() {
   const handleNewChat = async () => {
     if (!user) return;
     try {
-      const newConvoId = await createConversation(user.uid, 'New Chat');
+      const newConvoId = await createConversation('New Chat');
+      freshConversationRef.current = newConvoId;
       const newConvo = {
         id: newConvoId,
         userId: user.uid,
@@ -170,6 +219,7 @@ export default function Chat() {
       setConversations(prev => [newConvo, ...prev]);
       setCurrentConversationId(newConvoId);
       setMessages([]);
+      setMessagesCursor(null);
       setMobileMenuOpen(false);
     } catch (error) {
       console.error('Error creating conversation:', error);
@@ -203,6 +253,14 @@ export default function Chat() {
       abortControllerRef.current = null;
       setIsTyping(false);
     }
+    if (streamKeyRef.current) {
+      // The server keeps generating for reconnects unless told to stop; only the stream's owner may
+      const streamKey = streamKeyRef.current;
+      authHeaders()
+        .then(headers => fetch(`${BACKEND_URL}/api/chat/stream/${streamKey}`, { method: 'DELETE', headers }))
+        .catch(() => {});
+      streamKeyRef.current = null;
+    }
   }, []);
 
   const handleModeChange = (mode) => {
@@ -283,7 +341,8 @@ export default function Chat() {
     // Create new conversation if none exists
     if (!conversationId) {
       try {
-        conversationId = await createConversation(user.uid, content.slice(0, 30) + '...');
+        conversationId = await createConversation(content.slice(0, 30) + '...');
+        freshConversationRef.current = conversationId;
         const newConvo = {
           id: conversationId,
           userId: user.uid,
@@ -309,9 +368,8 @@ export default function Chat() {
     };
     setMessages(prev => [...prev, userMessage]);
 
-    // Save user message
+    // The backend saves the turn itself (persist: true below); only the title is set from here
     try {
-      await saveMessage(conversationId, user.uid, 'user', content);
       if (messages.length === 0) {
         await updateConversationTitle(conversationId, content.slice(0, 30) + (content.length > 30 ? '...' : ''));
         setConversations(prev => prev.map(c => 
@@ -321,32 +379,47 @@ export default function Chat() {
         ));
       }
     } catch (error) {
-      console.error('Error saving message:', error);
+      console.error('Error updating conversation title:', error);
     }
 
     // Start AI response
     setIsTyping(true);
     abortControllerRef.current = new AbortController();
+    const streamKey = window.crypto?.randomUUID ? window.crypto.randomUUID() : `${Date.now()}-${Math.random()}`;
+    streamKeyRef.current = streamKey;
 
     try {
       const displayName = userMemory?.preferred_name || user.name || 'friend';
-      
-      const response = await fetch(`${BACKEND_URL}/api/chat/stream`, {
+      const requestBody = JSON.stringify({
+        messages: [...messages, userMessage].map(m => ({ role: m.role, content: m.content })),
+        user_name: displayName,
+        conversation_id: conversationId,
+        user_memory: userMemory,
+        active_mode: activeMode, // Pass active mode to backend
+        user_id: user.uid,
+        persist: true
+      });
+
+      // Same Idempotency-Key on every attempt, so a reconnect resumes the running answer instead of starting a new one
+      let lastEventId = null;
+      const openStream = async () => fetch(`${BACKEND_URL}/api/chat/stream`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          messages: [...messages, userMessage].map(m => ({ role: m.role, content: m.content })),
-          user_name: displayName,
-          conversation_id: conversationId,
-          user_memory: userMemory,
-          active_mode: activeMode // Pass active mode to backend
-        }),
+        headers: {
+          'Content-Type': 'application/json',
+          ...(await authHeaders()),
+          'Idempotency-Key': streamKey,
+          ...(lastEventId ? { 'Last-Event-ID': lastEventId } : {})
+        },
+        body: requestBody,
         signal: abortControllerRef.current.signal
       });
 
+      const response = await openStream();
+
       if (!response.ok) throw new Error('Failed to get AI response');
 
-      const reader = response.body.getReader();
+      let reader = response.body.getReader();
+      let reconnects = 0;
       const decoder = new TextDecoder();
       let aiContent = '';
       
@@ -360,13 +433,28 @@ export default function Chat() {
       }]);
 
       while (true) {
-        const { done, value } = await reader.read();
+        let done, value;
+        try {
+          ({ done, value } = await reader.read());
+        } catch (readError) {
+          // Connection dropped mid-answer: pick up after the last event we received
+          if (readError.name === 'AbortError' || reconnects >= MAX_STREAM_RECONNECTS) throw readError;
+          reconnects += 1;
+          const resumed = await openStream();
+          if (!resumed.ok) throw new Error('Failed to resume AI response');
+          reader = resumed.body.getReader();
+          continue;
+        }
         if (done) break;
 
         const chunk = decoder.decode(value);
         const lines = chunk.split('\n');
         
         for (const line of lines) {
+          if (line.startsWith('id: ')) {
+            lastEventId = line.slice(4).trim();
+            continue;
+          }
           if (line.startsWith('data: ')) {
             try {
               const data = JSON.parse(line.slice(6));
@@ -383,14 +471,18 @@ export default function Chat() {
                   m.id === aiMessageId ? { ...m, isTyping: false } : m
                 ));
                 
+                // Adopt the stored ids, so pages loaded later don't show these messages twice
+                const ids = data.message_ids;
+                if (ids) {
+                  setMessages(prev => prev.map(m =>
+                    m.id === userMessage.id ? { ...m, id: ids.user_message_id } :
+                    m.id === aiMessageId && ids.assistant_message_id ? { ...m, id: ids.assistant_message_id } : m
+                  ));
+                }
+
                 if (aiContent) {
-                  try {
-                    await saveMessage(conversationId, user.uid, 'assistant', aiContent);
-                    const updatedMessages = [...messages, userMessage, { role: 'assistant', content: aiContent }];
-                    extractMemoryFromConversation(updatedMessages);
-                  } catch (saveError) {
-                    console.error('Failed to save AI message:', saveError);
-                  }
+                  const updatedMessages = [...messages, userMessage, { id: aiMessageId, role: 'assistant', content: aiContent }];
+                  extractMemoryFromConversation(updatedMessages, conversationId);
                 }
               }
               
@@ -406,8 +498,8 @@ export default function Chat() {
         setMessages(prev => {
           const lastMsg = prev[prev.length - 1];
           if (lastMsg?.role === 'assistant' && lastMsg?.isTyping) {
+            // The backend stores the partial answer when the stream is cancelled
             if (lastMsg.content) {
-              saveMessage(conversationId, user.uid, 'assistant', lastMsg.content + ' [stopped]');
               return prev.map(m => 
                 m.id === lastMsg.id ? { ...m, isTyping: false, content: m.content + ' [stopped]' } : m
               );
@@ -424,6 +516,7 @@ export default function Chat() {
     } finally {
       setIsTyping(false);
       abortControllerRef.current = null;
+      if (streamKeyRef.current === streamKey) streamKeyRef.current = null;
     }
   };
 
@@ -481,6 +574,8 @@ export default function Chat() {
               user={user}
               userMemory={userMemory}
               loading={loadingConversations}
+              hasMore={Boolean(conversationsCursor)}
+              onLoadMore={handleLoadOlderConversations}
             />
           </motion.div>
         )}
@@ -549,6 +644,19 @@ export default function Chat() {
         {/* Messages */}
         <div className="flex-1 overflow-y-auto p-4 lg:p-8">
           <div className="max-w-3xl mx-auto space-y-6">
+            {messagesCursor && (
+              <div className="text-center">
+                <button
+                  onClick={handleLoadEarlierMessages}
+                  disabled={loadingEarlier}
+                  className="text-xs text-[#6D6F7C] hover:text-[#E07A5F] px-3 py-1.5 rounded-full border border-[#EAE7DC] bg-white disabled:opacity-50"
+                  data-testid="load-earlier-btn"
+                >
+                  {loadingEarlier ? 'Loading...' : 'Load earlier messages'}
+                </button>
+              </div>
+            )}
+
             {messages.length === 0 && !isTyping && (
               <motion.div
                 initial={{ opacity: 0, y: 20 }}
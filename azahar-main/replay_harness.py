@@ -0,0 +1,241 @@
+"""
+Conversation replay harness for Nex.AI.
+
+Replays recorded conversations (JSONL, one conversation per line) through the
+backend's own prompt pipeline, rebuilding the exact upstream payload for every
+user turn, and reports prompt/completion tokens, latency and cost. Results can
+be saved as a baseline and diffed on later runs.
+
+Conversation line format:
+    {"id": "c1", "active_mode": "learn", "user_name": "Priya",
+     "user_memory": {...}, "messages": [{"role": "user", "content": "..."}, ...]}
+
+Usage:
+    python replay_harness.py conversations.jsonl --save-baseline baseline.json
+    python replay_harness.py conversations.jsonl --baseline baseline.json
+    python replay_harness.py conversations.jsonl --upstream real --dump-payloads payloads.jsonl
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server  # noqa: E402
+
+
+class MockUpstream:
+    """Stands in for Sarvam: replies with the recorded assistant turn when there is one."""
+
+    def __init__(self, base_latency_ms=150.0, ms_per_token=8.0):
+        self.base_latency_ms = base_latency_ms
+        self.ms_per_token = ms_per_token
+
+    def complete(self, payload, recorded_reply):
+        content = recorded_reply or "Mock reply from the replay harness. 😊"
+        completion_tokens = min(server.estimate_tokens(content), payload["max_tokens"])
+        latency_ms = self.base_latency_ms + completion_tokens * self.ms_per_token
+        return {
+            "content": content,
+            "prompt_tokens": server.estimate_message_tokens(payload["messages"]),
+            "completion_tokens": completion_tokens,
+            "latency_ms": latency_ms,
+            "usage_source": "estimate",
+        }
+
+
+class RealUpstream:
+    """Sends the rebuilt payload to the selected provider and reads token usage from the response."""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def complete(self, payload, recorded_reply):
+        started = time.perf_counter()
+        response = self.provider.send(payload, stream=False, timeout=120)
+        latency_ms = (time.perf_counter() - started) * 1000
+        if response.status_code != 200:
+            raise RuntimeError(f"API Error {response.status_code}: {response.text[:200]}")
+        data = response.json()
+        content = data["choices"][0]["message"]["content"]
+        usage = data.get("usage") or {}
+        return {
+            "content": content,
+            "prompt_tokens": usage.get("prompt_tokens") or server.estimate_message_tokens(payload["messages"]),
+            "completion_tokens": usage.get("completion_tokens") or server.estimate_tokens(content),
+            "latency_ms": latency_ms,
+            "usage_source": "upstream" if usage else "estimate",
+        }
+
+
+def load_conversations(path):
+    conversations = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                conversations.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                print(f"⚠️  Skipping line {line_no}: {e}")
+    return conversations
+
+
+def iter_turns(conversation, last_turn_only=False):
+    """Yields (ChatRequest, recorded assistant reply) for every user turn in the conversation."""
+    messages = conversation.get("messages", [])
+    user_indexes = [i for i, m in enumerate(messages) if m.get("role") == "user"]
+    if last_turn_only:
+        user_indexes = user_indexes[-1:]
+    for i in user_indexes:
+        request = server.ChatRequest(
+            messages=[server.ChatMessage(role=m["role"], content=m["content"]) for m in messages[:i + 1]],
+            user_name=conversation.get("user_name", "friend"),
+            conversation_id=conversation.get("id"),
+            user_memory=conversation.get("user_memory"),
+            active_mode=conversation.get("active_mode"),
+        )
+        reply = None
+        if i + 1 < len(messages) and messages[i + 1].get("role") == "assistant":
+            reply = messages[i + 1]["content"]
+        yield request, reply
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(records, price_prompt, price_completion):
+    def block(rows):
+        prompt = [r["prompt_tokens"] for r in rows]
+        completion = [r["completion_tokens"] for r in rows]
+        latency = [r["latency_ms"] for r in rows]
+        return {
+            "turns": len(rows),
+            "prompt_tokens_mean": round(statistics.mean(prompt), 1) if prompt else 0,
+            "prompt_tokens_p95": percentile(prompt, 95),
+            "completion_tokens_mean": round(statistics.mean(completion), 1) if completion else 0,
+            "latency_ms_p50": round(percentile(latency, 50), 1),
+            "latency_ms_p95": round(percentile(latency, 95), 1),
+            "latency_ms_p99": round(percentile(latency, 99), 1),
+            "cost": round(sum(prompt) / 1000 * price_prompt + sum(completion) / 1000 * price_completion, 4),
+        }
+
+    by_mode = {}
+    for r in records:
+        by_mode.setdefault(r["mode"] or "default", []).append(r)
+    return {
+        "overall": block(records),
+        "modes": {mode: block(rows) for mode, rows in sorted(by_mode.items())},
+    }
+
+
+def print_summary(summary, baseline=None):
+    def fmt_delta(key, value, base):
+        if base is None or key not in base or not base[key]:
+            return ""
+        change = (value - base[key]) / base[key] * 100
+        marker = "🔺" if change > 0 else "🔻" if change < 0 else "  "
+        return f"  {marker} {change:+.1f}%"
+
+    sections = [("overall", summary["overall"])] + list(summary["modes"].items())
+    for name, stats in sections:
+        base = None
+        if baseline:
+            base = baseline["overall"] if name == "overall" else baseline.get("modes", {}).get(name)
+        print(f"\n📊 {name}")
+        for key, value in stats.items():
+            print(f"   {key:<24} {value:>10}{fmt_delta(key, value, base)}")
+
+
+async def replay(args):
+    if not args.live_search:
+        server.TAVILY_API_KEY = None
+    provider = server.llm_router().primary
+    if args.provider:
+        provider = next(p for p in server.llm_router().providers if p.name == args.provider)
+    upstream = RealUpstream(provider) if args.upstream == "real" else MockUpstream(args.mock_latency_ms, args.mock_ms_per_token)
+
+    records = []
+    dump = open(args.dump_payloads, "w", encoding="utf-8") if args.dump_payloads else None
+    try:
+        for conversation in load_conversations(args.conversations):
+            for request, recorded_reply in iter_turns(conversation, args.last_turn_only):
+                chat = await server.prepare_chat(request, allow_spin=False)
+                settings = chat["settings"]
+                payload = provider.build_payload(
+                    chat["messages"],
+                    stream=False,
+                    max_tokens=settings["max_tokens"],
+                    temperature=settings["temperature"],
+                    model=settings["model"],
+                    primary=provider is server.llm_router().primary
+                )
+                if dump:
+                    dump.write(json.dumps({"conversation_id": request.conversation_id, "payload": payload}, ensure_ascii=False) + "\n")
+                try:
+                    result = upstream.complete(payload, recorded_reply)
+                except Exception as e:
+                    print(f"❌ {request.conversation_id}: {e}")
+                    continue
+                records.append({
+                    "conversation_id": request.conversation_id,
+                    "mode": chat["mode"],
+                    "prompt_tokens": result["prompt_tokens"],
+                    "completion_tokens": result["completion_tokens"],
+                    "latency_ms": result["latency_ms"],
+                    "payload_bytes": len(json.dumps(payload, ensure_ascii=False).encode("utf-8")),
+                })
+    finally:
+        if dump:
+            dump.close()
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded conversations and report token/latency regressions.")
+    parser.add_argument("conversations", help="JSONL file, one conversation per line")
+    parser.add_argument("--upstream", choices=["mock", "real"], default="mock")
+    parser.add_argument("--provider", help="Provider name from LLM_PROVIDERS whose payload format to replay (default: primary)")
+    parser.add_argument("--baseline", help="Baseline JSON to diff against")
+    parser.add_argument("--save-baseline", help="Write this run's summary as a new baseline")
+    parser.add_argument("--dump-payloads", help="Write every rebuilt upstream payload to this JSONL file")
+    parser.add_argument("--last-turn-only", action="store_true", help="Replay only the final user turn per conversation")
+    parser.add_argument("--live-search", action="store_true", help="Allow Tavily lookups while rebuilding default-mode prompts")
+    parser.add_argument("--mock-latency-ms", type=float, default=150.0)
+    parser.add_argument("--mock-ms-per-token", type=float, default=8.0)
+    parser.add_argument("--price-prompt", type=float, default=0.0, help="Cost per 1K prompt tokens")
+    parser.add_argument("--price-completion", type=float, default=0.0, help="Cost per 1K completion tokens")
+    args = parser.parse_args()
+
+    print("🔁 Replaying conversations")
+    print("=" * 50)
+    records = asyncio.run(replay(args))
+    if not records:
+        print("⚠️  No turns replayed")
+        return 1
+
+    summary = summarize(records, args.price_prompt, args.price_completion)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"\n💾 Baseline saved to {args.save_baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Keep test writes away from backend/data and never reach a real upstream
+os.environ.setdefault("STORAGE_PATH", str(Path(tempfile.mkdtemp()) / "nex-test.sqlite3"))
+os.environ.setdefault("SARVAM_API_KEY", "")
+# No Firebase here: quotas stay off unless a test installs a ledger and a verifier
+os.environ.setdefault("TOKEN_QUOTA_PER_USER", "0")
+os.environ.setdefault("TOKEN_QUOTA_BY_MODE", "{}")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
@@ -0,0 +1,61 @@
+"""Test doubles for the upstream LLM providers."""
+import json
+import time
+from typing import List, Optional
+
+import server
+
+
+class MockResponse:
+    """Just enough of requests.Response for the streaming and non-streaming parsers."""
+
+    def __init__(self, status_code: int, body: Optional[dict] = None, lines: Optional[List[bytes]] = None):
+        self.status_code = status_code
+        self._body = body or {}
+        self._lines = lines or []
+        self.text = json.dumps(self._body)
+        self.headers = {}
+
+    def json(self):
+        return self._body
+
+    def iter_lines(self):
+        return iter(self._lines)
+
+    def close(self):
+        pass
+
+
+class MockProvider(server.LLMProvider):
+    """Local stand-in for an upstream LLM. Never touches the network."""
+
+    def __init__(self, name: str = "mock", url: str = "mock://llm", model: str = "mock-1",
+                 api_key: Optional[str] = "mock", reply: str = "Hello from the mock provider! 😊",
+                 latency_ms: float = 0, status_code: int = 200):
+        super().__init__(name, url, model, api_key)
+        self.reply = reply
+        self.latency_ms = latency_ms
+        self.status_code = status_code
+
+    def send(self, payload: dict, stream: bool, timeout=server.UPSTREAM_TIMEOUT):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        if self.status_code != 200:
+            return MockResponse(self.status_code, {"error": f"mock status {self.status_code}"})
+        usage = {
+            "prompt_tokens": server.estimate_message_tokens(payload["messages"]),
+            "completion_tokens": server.estimate_tokens(self.reply),
+        }
+        if not stream:
+            return MockResponse(200, {
+                "choices": [{"message": {"role": "assistant", "content": self.reply}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+        words = self.reply.split(" ")
+        lines = [
+            ("data: " + json.dumps({"choices": [{"delta": {"content": w + (" " if i < len(words) - 1 else "")}}]})).encode("utf-8")
+            for i, w in enumerate(words)
+        ]
+        lines.append(("data: " + json.dumps({"choices": [{"delta": {}, "finish_reason": "stop"}], "usage": usage})).encode("utf-8"))
+        lines.append(b"data: [DONE]")
+        return MockResponse(200, lines=lines)
@@ -0,0 +1,124 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from tests.fakes import MockProvider, MockResponse
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    stats = server.CompletionStats(window=100)
+    monkeypatch.setattr(server, "COMPLETION_STATS", stats)
+    monkeypatch.setattr(server, "ADAPTIVE_MIN_SAMPLES", 10)
+    return stats
+
+
+def test_classify_message():
+    assert server.classify_message("lol ok") == "casual"
+    assert server.classify_message("is it raining?") == "question"
+    assert server.classify_message("Explain how photosynthesis works") == "explain"
+    assert server.classify_message("word " * 41) == "explain"
+
+
+def test_percentile_needs_enough_samples(stats):
+    for tokens in range(1, 10):
+        stats.record("learn", "casual", tokens)
+    assert stats.percentile("learn", "casual", 99) is None
+    stats.record("learn", "casual", 10)
+    assert stats.percentile("learn", "casual", 99) == 10
+    assert stats.percentile("learn", "casual", 50) == 5
+    assert stats.percentile("english", "casual", 99) is None
+
+
+def test_max_tokens_follows_observed_lengths(stats):
+    assert server.adaptive_settings("learn", "hi")["max_tokens"] == 4096
+
+    for _ in range(10):
+        stats.record("learn", "casual", 400)
+    settings = server.adaptive_settings("learn", "hi")
+    assert settings["max_tokens"] == int(400 * server.ADAPTIVE_HEADROOM)
+    assert settings["ceiling"] == 4096 and settings["message_class"] == "casual"
+
+    for _ in range(10):
+        stats.record("learn", "question", 10)
+    assert server.adaptive_settings("learn", "is it raining?")["max_tokens"] == server.ADAPTIVE_FLOOR
+
+    for _ in range(10):
+        stats.record("english", "casual", 5000)
+    assert server.adaptive_settings("english", "hi")["max_tokens"] == 3072
+
+
+def test_profile_caps_and_overrides(stats):
+    profile = {"name": "fast", "model": "small-1", "max_tokens": 512, "temperature": 0.3}
+    settings = server.adaptive_settings(None, "hi", profile)
+    assert (settings["max_tokens"], settings["model"], settings["temperature"]) == (512, "small-1", 0.3)
+    assert settings["ceiling"] == 4096 and settings["profile"] == "fast"
+
+
+def test_continuation_only_below_the_ceiling():
+    assert server.needs_continuation({"max_tokens": 500, "ceiling": 4096}, "length")
+    assert not server.needs_continuation({"max_tokens": 500, "ceiling": 4096}, "stop")
+    assert not server.needs_continuation({"max_tokens": 4096, "ceiling": 4096}, "length")
+
+    messages = server.continuation_messages([{"role": "user", "content": "q"}], "partial answer")
+    assert messages[1] == {"role": "assistant", "content": "partial answer"}
+    assert messages[-1]["role"] == "user"
+
+
+class ClosingResponse(MockResponse):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def cut_off_reply(text):
+    lines = [("data: " + json.dumps({"choices": [{"delta": {"content": text}}]})).encode(),
+             ("data: " + json.dumps({"choices": [{"delta": {}, "finish_reason": "length"}]})).encode(),
+             b"data: [DONE]"]
+    return ClosingResponse(200, lines=lines)
+
+
+@pytest.fixture
+def continuing(stats, monkeypatch):
+    """The first call stops at max_tokens, so the stream asks for a continuation."""
+    for _ in range(10):
+        stats.record(None, "casual", 100)
+    monkeypatch.setattr(server, "LLM_ROUTER", server.ProviderRouter([MockProvider()]))
+    saved = []
+    monkeypatch.setattr(server, "persist_turn", lambda request, reply: saved.append(reply))
+    return saved
+
+
+def stream_events(second_call):
+    calls = iter([lambda: cut_off_reply("First part"), second_call])
+
+    def fake_call_llm(messages, stream, max_tokens, temperature, model=None, deadline=None):
+        return next(calls)()
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(server, "call_llm", fake_call_llm)
+        response = TestClient(server.create_app()).post("/api/chat/stream",
+                                                        json={"messages": [{"role": "user", "content": "hi"}]})
+    return [json.loads(line[6:]) for line in response.text.splitlines() if line.startswith("data: ")]
+
+
+def test_continuation_past_the_deadline_keeps_the_first_part(continuing):
+    def expired():
+        raise server.DeadlineExceeded("upstream call")
+
+    events = stream_events(expired)
+    assert events[-1] == {"done": True, "partial": True}
+    assert "".join(e.get("word", "") for e in events) == "First part"
+    assert continuing == ["First part"]
+
+
+def test_failed_continuation_is_closed(continuing):
+    failed = ClosingResponse(500, {"error": "boom"})
+    events = stream_events(lambda: failed)
+    assert events[-1] == {"done": True} and failed.closed
+    assert continuing == ["First part"]
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from tests.fakes import MockProvider
+
+
+@pytest.fixture
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(server, "LLM_ROUTER", server.ProviderRouter([MockProvider()]))
+    monkeypatch.setattr(server, "UPSTREAMS", {})
+    monkeypatch.setattr(server, "UPSTREAM_HEALTH", {})
+    monkeypatch.setattr(server, "WARMUP_STATE", {"done": False, "started_at": None, "finished_at": None, "modules": {}})
+    monkeypatch.setattr(server, "STARTUP_STATE", {"module_seconds": 0.5, "startup_seconds": None, "ready_seconds": None})
+
+
+def test_import_opens_nothing():
+    assert server._upstream_session is None
+    assert server._health_task is None or server._health_task.done()
+
+
+def test_lifespan_opens_and_closes_subsystems(fresh_state):
+    config = server.AppConfig(upstream_pool_size=7, upstream_io_threads=3, warmup_modules=["json"])
+    with TestClient(server.create_app(config)):
+        adapter = server._upstream_session.get_adapter("https://example.com")
+        assert adapter._pool_maxsize == 7
+        executor = server.UPSTREAM_EXECUTOR
+        assert executor._max_workers == 3
+        assert server.LLM_ROUTER is not None
+        assert server.STARTUP_STATE["startup_seconds"] is not None
+        assert server.BROWNOUT._task is not None
+    assert server._upstream_session is None
+    assert server.UPSTREAM_EXECUTOR is None and executor._shutdown
+    assert server.LLM_ROUTER is None
+    assert server.BROWNOUT._task is None
+    assert server.WARMUP_STATE["modules"] == {"json": True}
+
+
+def test_readiness_waits_for_warm_up(fresh_state, monkeypatch):
+    async def slow_warm_up(modules):
+        await asyncio.sleep(0.05)
+        server.WARMUP_STATE["done"] = True
+
+    monkeypatch.setattr(server, "warm_up", slow_warm_up)
+    with TestClient(server.create_app()) as client:
+        for _ in range(50):
+            response = client.get("/api/health/ready")
+            if response.status_code == 200:
+                break
+            time.sleep(0.01)
+        assert response.status_code == 200 and response.json()["checks"]["warmed_up"]
+        assert server.STARTUP_STATE["ready_seconds"] is not None
+        assert client.get("/api/health").json()["startup"] == server.STARTUP_STATE
+
+
+def test_config_drives_cors(fresh_state):
+    client = TestClient(server.create_app(server.AppConfig(cors_origins=["https://nex.example"])))
+    preflight = {"Origin": "https://nex.example", "Access-Control-Request-Method": "POST"}
+    response = client.options("/api/chat/simple", headers=preflight)
+    assert response.headers["access-control-allow-origin"] == "https://nex.example"
+
+    response = client.options("/api/chat/simple", headers={**preflight, "Origin": "https://evil.example"})
+    assert "access-control-allow-origin" not in response.headers
+
+
+def test_upstreams_come_from_the_router(monkeypatch):
+    monkeypatch.setattr(server, "UPSTREAMS", {"tavily": server.TAVILY_API_URL})
+    monkeypatch.setattr(server, "UPSTREAM_HEALTH", {})
+    router = server.ProviderRouter([MockProvider(), MockProvider(name="remote", url="https://llm.example/v1")])
+    server.register_upstreams(router)
+    assert server.UPSTREAMS == {"tavily": server.TAVILY_API_URL, "remote": "https://llm.example/v1"}
+    assert server.UPSTREAM_HEALTH["remote"]["reachable"] is None
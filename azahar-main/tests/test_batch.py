@@ -0,0 +1,39 @@
+import asyncio
+import json
+import time
+
+from starlette.requests import Request
+
+import server
+
+
+def batch_request(body: dict) -> Request:
+    raw = json.dumps(body).encode("utf-8")
+    scope = {"type": "http", "method": "POST", "path": "/api/chat/batch", "query_string": b"",
+             "headers": [(b"content-type", b"application/json")]}
+
+    async def receive():
+        return {"type": "http.request", "body": raw, "more_body": False}
+
+    return Request(scope, receive)
+
+
+def test_json_batch_responds_before_items_finish(monkeypatch):
+    async def slow_chat(item, deadline=None):
+        await asyncio.sleep(0.2)
+        return {"response": item.messages[-1]["content"], "success": True}
+
+    monkeypatch.setattr(server, "run_simple_chat", slow_chat)
+    items = [{"messages": [{"role": "user", "content": f"q{i}"}], "user_id": "batch-user"} for i in range(4)]
+
+    async def run():
+        started = time.perf_counter()
+        response = await server.chat_batch(batch_request({"items": items, "concurrency": 1}))
+        returned_after = time.perf_counter() - started
+        lines = [json.loads(line) async for line in response.body_iterator]
+        return returned_after, lines
+
+    returned_after, lines = asyncio.run(run())
+    assert returned_after < 0.1
+    assert sorted(line["index"] for line in lines) == [0, 1, 2, 3]
+    assert all(line["success"] for line in lines)
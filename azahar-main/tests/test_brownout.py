@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import httpx
+
+import server
+from tests.fakes import MockProvider, MockResponse
+
+
+class SlowStreamResponse(MockResponse):
+    """A 200 stream whose every line takes `delay` seconds to arrive, like a slow upstream."""
+
+    def __init__(self, lines, delay):
+        super().__init__(200, lines=lines)
+        self.delay = delay
+
+    def iter_lines(self):
+        for line in self._lines:
+            time.sleep(self.delay)
+            yield line
+
+
+class SlowProvider(MockProvider):
+    def send(self, payload, stream, timeout=server.UPSTREAM_TIMEOUT):
+        time.sleep(0.2)
+        response = super().send(payload, stream, timeout)
+        return SlowStreamResponse(response._lines, 0.05) if stream else response
+
+
+def test_slow_upstream_does_not_block_the_event_loop(monkeypatch):
+    monkeypatch.setattr(server, "LLM_ROUTER", server.ProviderRouter([SlowProvider(reply="one two three four five")]))
+    app = server.create_app()
+
+    async def run():
+        gaps = []
+
+        async def ticker():
+            last = time.perf_counter()
+            while True:
+                await asyncio.sleep(0.01)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        ticking = asyncio.create_task(ticker())
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post("/api/chat/stream", json={"messages": [{"role": "user", "content": "hi"}]})
+        ticking.cancel()
+        return response, max(gaps)
+
+    response, worst_gap = asyncio.run(run())
+    assert '"done": true' in response.text
+    # The upstream spends ~0.5s blocked in send() and iter_lines(); none of it may land on the loop
+    assert worst_gap < 0.1
+
+
+def test_level_steps_up_at_once_and_recovers_one_level_at_a_time(monkeypatch):
+    monkeypatch.setattr(server, "BROWNOUT_MAX_IN_FLIGHT", 10)
+    monkeypatch.setattr(server, "BROWNOUT_RECOVERY_SECONDS", 0.05)
+    brownout = server.BrownoutController()
+
+    brownout.in_flight = 5
+    assert brownout.update() == 0
+    brownout.in_flight = 10
+    assert brownout.update() == server.LEVEL_SHED
+
+    brownout.in_flight = 0
+    assert brownout.update() == server.LEVEL_SHED  # calm period starts
+    time.sleep(0.06)
+    assert brownout.update() == server.LEVEL_REDUCED
+    assert brownout.update() == server.LEVEL_REDUCED
+    time.sleep(0.06)
+    assert brownout.update() == server.LEVEL_NO_SEARCH
+
+    # Pressure coming back mid-recovery jumps straight to the new target
+    brownout.in_flight = 9
+    assert brownout.update() == server.LEVEL_REDUCED
+
+
+def test_error_rate_needs_enough_samples():
+    brownout = server.BrownoutController()
+    for _ in range(server.BROWNOUT_MIN_ERROR_SAMPLES - 1):
+        brownout.record_upstream(False)
+    assert brownout.error_rate() == 0.0
+    brownout.record_upstream(True)
+    assert brownout.error_rate() == 0.9
+    assert brownout.update() == server.LEVEL_SHED
+
+
+def test_loop_lag_counts_as_pressure():
+    brownout = server.BrownoutController()
+    brownout.loop_lag_ms = server.BROWNOUT_MAX_LAG_MS * 0.8
+    assert brownout.update() == server.LEVEL_NO_SEARCH
+    assert brownout.active(server.LEVEL_SKIP_EXTRACTION, "extraction")
+    assert not brownout.active(server.LEVEL_REDUCED, "context")
+
+
+def test_shed_level_rejects_requests():
+    brownout = server.BrownoutController()
+    assert brownout.shed_response() is None
+    brownout.level = server.LEVEL_SHED
+    response = brownout.shed_response()
+    assert response.status_code == 503 and int(response.headers["Retry-After"]) >= 1
+
+
+def test_disabled_brownout_stays_normal(monkeypatch):
+    monkeypatch.setattr(server, "BROWNOUT_ENABLED", False)
+    brownout = server.BrownoutController()
+    brownout.in_flight = 10 ** 6
+    assert brownout.update() == 0
@@ -0,0 +1,91 @@
+import asyncio
+import gzip
+import json
+import zlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from tests.fakes import MockProvider
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "LLM_ROUTER", server.ProviderRouter([MockProvider(reply="one two three")]))
+    return TestClient(server.create_app())
+
+
+def test_negotiate_encoding(monkeypatch):
+    monkeypatch.setattr(server, "SSE_COMPRESSION", ["br", "gzip"])
+    monkeypatch.setattr(server, "brotli", None)
+    assert server.negotiate_encoding("gzip, deflate, br") == "gzip"
+    assert server.negotiate_encoding("br;q=1.0, gzip;q=0") is None
+    assert server.negotiate_encoding("*") == "gzip"
+    assert server.negotiate_encoding("identity") is None
+    assert server.negotiate_encoding("gzip;q=bogus") is None
+    assert server.negotiate_encoding(None) is None
+
+    monkeypatch.setattr(server, "brotli", object())
+    assert server.negotiate_encoding("gzip, br") == "br"
+
+
+def test_every_gzip_frame_decodes_on_its_own():
+    compressor = server.StreamCompressor("gzip")
+    inflater = zlib.decompressobj(31)
+    events = [f"id: {i}\ndata: {json.dumps({'word': f'w{i} '})}\n\n".encode() for i in range(5)]
+    for event in events:
+        assert inflater.decompress(compressor.compress(event)) == event
+    inflater.decompress(compressor.finish())
+    assert inflater.eof
+
+
+def test_compress_events_coalesces_and_finishes():
+    async def events():
+        for i in range(50):
+            yield f"data: {i}\n\n"
+
+    async def collect():
+        return [frame async for frame in server.compress_events(events(), "gzip")]
+
+    frames = asyncio.run(collect())
+    assert len(frames) < 50
+    assert gzip.decompress(b"".join(frames)).decode() == "".join(f"data: {i}\n\n" for i in range(50))
+
+
+def test_decompress_body_limits():
+    body = json.dumps({"messages": []}).encode()
+    assert server.decompress_body(gzip.compress(body), "gzip") == body
+    assert server.decompress_body(zlib.compress(body), "deflate") == body
+
+    with pytest.raises(server.BodyDecodeError) as e:
+        server.decompress_body(gzip.compress(b"0" * 10_000), "gzip", limit=1000)
+    assert e.value.status_code == 413
+    with pytest.raises(server.BodyDecodeError) as e:
+        server.decompress_body(gzip.compress(body)[:-8], "gzip")
+    assert e.value.status_code == 400
+    with pytest.raises(server.BodyDecodeError) as e:
+        server.decompress_body(body, "zstd")
+    assert e.value.status_code == 415
+
+
+def test_compressed_request_body(client):
+    body = gzip.compress(json.dumps({"messages": [{"role": "user", "content": "hi"}]}).encode())
+    response = client.post("/api/chat/simple", content=body,
+                           headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+    assert response.status_code == 200 and response.json()["success"]
+
+    response = client.post("/api/chat/simple", content=b"not gzip",
+                           headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+    assert response.status_code == 400
+
+
+def test_stream_is_compressed_when_accepted(client, monkeypatch):
+    monkeypatch.setattr(server, "brotli", None)
+    body = {"messages": [{"role": "user", "content": "hi"}]}
+    response = client.post("/api/chat/stream", json=body, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert '"done": true' in response.text
+
+    response = client.post("/api/chat/stream", json=body, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
@@ -0,0 +1,206 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from tests.fakes import MockProvider
+
+TOKENS = {"token-alice": "alice", "token-bob": "bob"}
+
+
+def fake_verifier(token):
+    if token not in TOKENS:
+        raise ValueError("invalid token")
+    return {"uid": TOKENS[token], "exp": time.time() + 3600}
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "_storage", server.SQLiteStorage(str(tmp_path / "nex.sqlite3")))
+    monkeypatch.setattr(server, "STORAGE_BUFFER", server.WriteBehindBuffer())
+    monkeypatch.setattr(server, "VERIFIED_TOKENS", server.LRUCache())
+    monkeypatch.setattr(server, "CONVERSATION_OWNERS", server.LRUCache())
+    monkeypatch.setattr(server, "HISTORY_CACHE", server.LRUCache())
+    monkeypatch.setattr(server, "_token_verifier", fake_verifier)
+    return TestClient(server.create_app())
+
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def create_conversation(client, token, conversation_id="c1"):
+    response = client.post("/api/conversations", json={"id": conversation_id, "title": "t"}, headers=auth(token))
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def test_writes_need_a_valid_token(client):
+    assert client.post("/api/conversations", json={"title": "t"}).status_code == 401
+    assert client.post("/api/conversations", json={"title": "t"}, headers=auth("forged")).status_code == 401
+    response = client.post("/api/conversations/c1/messages", json={"messages": [{"role": "user", "content": "hi"}]})
+    assert response.status_code == 401
+
+
+def test_owner_comes_from_the_token(client):
+    response = client.post("/api/conversations", json={"title": "t", "user_id": "bob"}, headers=auth("token-alice"))
+    assert response.status_code == 403
+
+    conversation_id = create_conversation(client, "token-alice")
+    assert server.STORAGE_BUFFER.pending_conversation(conversation_id)["user_id"] == "alice"
+
+
+def test_cannot_write_into_another_users_conversation(client):
+    conversation_id = create_conversation(client, "token-alice")
+    messages = {"messages": [{"role": "user", "content": "hijack"}]}
+
+    response = client.post(f"/api/conversations/{conversation_id}/messages", json=messages, headers=auth("token-bob"))
+    assert response.status_code == 403
+    response = client.post("/api/conversations", json={"id": conversation_id, "title": "mine"}, headers=auth("token-bob"))
+    assert response.status_code == 403
+
+    response = client.post(f"/api/conversations/{conversation_id}/messages", json=messages, headers=auth("token-alice"))
+    assert response.status_code == 200 and len(response.json()["message_ids"]) == 1
+
+
+def test_ownership_is_checked_against_storage_after_flush(client):
+    conversation_id = create_conversation(client, "token-alice")
+    asyncio.run(server.STORAGE_BUFFER.flush())
+    server.CONVERSATION_OWNERS.delete(conversation_id)
+
+    messages = {"messages": [{"role": "user", "content": "hi"}]}
+    response = client.post(f"/api/conversations/{conversation_id}/messages", json=messages, headers=auth("token-bob"))
+    assert response.status_code == 403
+
+
+def test_persisted_chat_needs_the_owner(client):
+    conversation_id = create_conversation(client, "token-alice")
+    body = {"messages": [{"role": "user", "content": "hi"}], "conversation_id": conversation_id, "persist": True}
+
+    assert client.post("/api/chat/simple", json=body).status_code == 401
+    assert client.post("/api/chat/simple", json=body, headers=auth("token-bob")).status_code == 403
+
+
+def test_user_message_keeps_its_arrival_time(monkeypatch):
+    buffer = server.WriteBehindBuffer()
+    monkeypatch.setattr(server, "STORAGE_BUFFER", buffer)
+    request = server.ChatRequest(messages=[{"role": "user", "content": "hi"}], conversation_id="c", persist=True)
+    arrived = request._received_at
+
+    time.sleep(0.05)
+    server.persist_turn(request, "hello")
+
+    user_row, reply_row = buffer._messages
+    assert user_row["timestamp"] == arrived
+    assert reply_row["timestamp"] >= arrived + 0.05
+
+
+def save_messages(client, token, conversation_id, contents, timestamp=None):
+    messages = [{"role": "user", "content": c, "timestamp": timestamp} for c in contents]
+    response = client.post(f"/api/conversations/{conversation_id}/messages", json={"messages": messages},
+                           headers=auth(token))
+    assert response.status_code == 200
+
+
+def test_reads_are_scoped_to_the_caller(client):
+    conversation_id = create_conversation(client, "token-alice")
+    save_messages(client, "token-alice", conversation_id, ["hi"])
+
+    assert client.get("/api/conversations").status_code == 401
+    assert client.get("/api/conversations?user_id=alice", headers=auth("token-bob")).status_code == 403
+    assert client.get("/api/conversations", headers=auth("token-bob")).json()["conversations"] == []
+    listed = client.get("/api/conversations", headers=auth("token-alice")).json()["conversations"]
+    assert [c["id"] for c in listed] == [conversation_id]
+
+    assert client.get(f"/api/conversations/{conversation_id}/messages").status_code == 401
+    assert client.get(f"/api/conversations/{conversation_id}/messages", headers=auth("token-bob")).status_code == 403
+    assert client.get("/api/conversations/missing/messages", headers=auth("token-alice")).status_code == 404
+    page = client.get(f"/api/conversations/{conversation_id}/messages", headers=auth("token-alice")).json()
+    assert [m["content"] for m in page["messages"]] == ["hi"]
+
+
+def test_paging_does_not_skip_messages_with_equal_timestamps(client):
+    conversation_id = create_conversation(client, "token-alice")
+    save_messages(client, "token-alice", conversation_id, [f"m{i}" for i in range(5)], timestamp=1000.0)
+
+    seen, cursor = [], None
+    while True:
+        url = f"/api/conversations/{conversation_id}/messages?limit=2" + (f"&cursor={cursor}" if cursor else "")
+        page = client.get(url, headers=auth("token-alice")).json()
+        seen += [m["content"] for m in page["messages"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert sorted(seen) == [f"m{i}" for i in range(5)]
+
+
+def test_cached_history_window_expires(client, monkeypatch):
+    monkeypatch.setattr(server, "HISTORY_CACHE_TTL", 0.05)
+    conversation_id = create_conversation(client, "token-alice")
+    save_messages(client, "token-alice", conversation_id, ["first"])
+    url = f"/api/conversations/{conversation_id}/messages"
+    assert len(client.get(url, headers=auth("token-alice")).json()["messages"]) == 1
+
+    # Another worker writes straight to the shared store; this worker's window doesn't see it
+    server.get_storage().write_batch([], [{"id": "other", "conversation_id": conversation_id, "user_id": "alice",
+                                           "role": "assistant", "content": "second", "timestamp": time.time()}])
+    assert len(client.get(url, headers=auth("token-alice")).json()["messages"]) == 1
+    time.sleep(0.06)
+    assert len(client.get(url, headers=auth("token-alice")).json()["messages"]) == 2
+
+
+def test_delete_removes_buffered_and_stored_messages(client):
+    conversation_id = create_conversation(client, "token-alice")
+    save_messages(client, "token-alice", conversation_id, ["stored"])
+    asyncio.run(server.STORAGE_BUFFER.flush())
+    save_messages(client, "token-alice", conversation_id, ["still buffered"])
+
+    assert client.delete(f"/api/conversations/{conversation_id}").status_code == 401
+    assert client.delete(f"/api/conversations/{conversation_id}", headers=auth("token-bob")).status_code == 403
+    assert client.delete(f"/api/conversations/{conversation_id}", headers=auth("token-alice")).json()["deleted"]
+
+    asyncio.run(server.STORAGE_BUFFER.flush())
+    assert server.get_storage().get_conversation(conversation_id) is None
+    assert server.get_storage().list_messages(conversation_id, 10) == []
+    assert client.get(f"/api/conversations/{conversation_id}/messages", headers=auth("token-alice")).status_code == 404
+
+
+def test_storage_backends_must_implement_every_method():
+    class Partial(server.StorageBackend):
+        def write_batch(self, conversations, messages):
+            pass
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_stopped_stream_keeps_the_turn(monkeypatch):
+    buffer = server.WriteBehindBuffer()
+    monkeypatch.setattr(server, "STORAGE_BUFFER", buffer)
+    monkeypatch.setattr(server, "LLM_ROUTER", server.ProviderRouter([MockProvider(reply="one two three four")]))
+    body = {"messages": [{"role": "user", "content": "hi"}], "conversation_id": "c1", "persist": True}
+
+    async def stop_after_two_words():
+        async def no_auth(http_request, request):
+            request.user_id = "alice"
+
+        monkeypatch.setattr(server, "authorize_persistence", no_auth)
+        scope = {"type": "http", "method": "POST", "headers": [], "client": ("127.0.0.1", 1)}
+
+        async def receive():
+            return {"type": "http.request", "body": server.json.dumps(body).encode(), "more_body": False}
+
+        response = await server.chat_stream(server.Request(scope, receive))
+        words = 0
+        async for event in response.body_iterator:
+            words += '"word"' in event
+            if words == 2:
+                break
+        await response.body_iterator.aclose()
+
+    asyncio.run(stop_after_two_words())
+    user_row, reply_row = buffer._messages
+    assert user_row["content"] == "hi"
+    assert reply_row["content"] == "one two [stopped]"
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import server
+from tests.fakes import MockProvider, MockResponse
+
+
+def test_mode_default_and_header_clamping():
+    assert server.request_deadline("learn").budget_ms == server.MODE_SETTINGS["learn"]["deadline_ms"]
+    assert server.request_deadline(None, default_ms=8000).budget_ms == 8000
+    assert server.request_deadline(None, "5000").budget_ms == 5000
+    assert server.request_deadline(None, "10").budget_ms == server.DEADLINE_MIN_MS
+    assert server.request_deadline(None, str(10 ** 9)).budget_ms == server.DEADLINE_MAX_MS
+    assert server.request_deadline("english", "soon").budget_ms == server.MODE_SETTINGS["english"]["deadline_ms"]
+
+
+def test_stage_shares_and_upstream_timeouts():
+    deadline = server.Deadline(10_000)
+    assert deadline.share(0.5, cap=2.0) == 2.0
+    assert 4.9 < deadline.share(0.5, cap=60.0) <= 5.0
+
+    connect, read = deadline.upstream_timeout(stream=True)
+    assert connect == server.UPSTREAM_CONNECT_TIMEOUT and read == pytest.approx(min(server.FIRST_TOKEN_TIMEOUT, 10), abs=0.1)
+    assert deadline.upstream_timeout(stream=False)[1] == pytest.approx(10, abs=0.1)
+
+    short = server.Deadline(1_000)
+    assert short.upstream_timeout(stream=True)[0] <= 1.0
+
+
+def test_expired_deadline():
+    deadline = server.Deadline(0)
+    assert deadline.expired() and deadline.remaining() == 0.0
+
+
+class TimingOutProvider(MockProvider):
+    def send(self, payload, stream, timeout=server.UPSTREAM_TIMEOUT):
+        self.timeouts = getattr(self, "timeouts", []) + [timeout]
+        time.sleep(0.06)
+        raise server.requests.exceptions.ReadTimeout("read timed out")
+
+
+def test_router_stops_when_the_budget_runs_out():
+    provider = TimingOutProvider()
+    router = server.ProviderRouter([provider, MockProvider(name="backup")])
+    deadline = server.Deadline(50)
+
+    with pytest.raises(server.DeadlineExceeded):
+        router.call([{"role": "user", "content": "hi"}], stream=False, max_tokens=10, temperature=0.5, deadline=deadline)
+    assert provider.timeouts[0][1] <= 0.05
+    # Our own budget ran out, so the provider is not put on cooldown
+    assert router.stats["mock"]["consecutive_failures"] == 0
+
+    with pytest.raises(server.DeadlineExceeded):
+        router.call([{"role": "user", "content": "hi"}], stream=False, max_tokens=10, temperature=0.5,
+                    deadline=server.Deadline(0))
+    assert len(provider.timeouts) == 1
+
+
+def test_simple_chat_reports_the_missed_deadline(monkeypatch):
+    monkeypatch.setattr(server, "LLM_ROUTER", server.ProviderRouter([TimingOutProvider()]))
+    request = server.ChatRequest(messages=[{"role": "user", "content": "hi"}])
+    result = asyncio.run(server.run_simple_chat(request, server.Deadline(50)))
+    assert result["deadline_exceeded"] and not result["success"]
+
+
+class SlowStream(MockResponse):
+    """Streams `words`, sleeping `gaps[i]` seconds before word i."""
+
+    def __init__(self, words, gaps):
+        super().__init__(200)
+        self.words, self.gaps = words, gaps
+
+    def iter_lines(self):
+        for word, gap in zip(self.words, self.gaps):
+            time.sleep(gap)
+            yield ("data: " + json.dumps({"choices": [{"delta": {"content": word}}]})).encode()
+        yield b"data: [DONE]"
+
+
+def relay(response, deadline):
+    async def collect():
+        result = {}
+        chunks = [chunk async for chunk in server._stream_response(response, result, deadline)]
+        return chunks, result
+
+    return asyncio.run(collect())
+
+
+def test_flowing_stream_outlives_the_deadline():
+    chunks, result = relay(SlowStream(["a ", "b ", "c"], [0, 0.05, 0.05]), server.Deadline(30))
+    assert result["text"] == "a b c" and len(chunks) == 3
+    assert "finish_reason" not in result
+
+
+def test_stream_bounds_first_token_and_idle_gaps(monkeypatch):
+    _, result = relay(SlowStream(["a "], [0.2]), server.Deadline(30))
+    assert result == {"text": "", "finish_reason": "deadline"}
+
+    monkeypatch.setattr(server, "STREAM_IDLE_TIMEOUT", 0.03)
+    _, result = relay(SlowStream(["a ", "b ", "c"], [0, 0.01, 0.2]), server.Deadline(5000))
+    assert result == {"text": "a b ", "finish_reason": "timeout"}
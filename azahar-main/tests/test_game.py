@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+import server
+from tests.fakes import MockProvider
+
+SCORED = "Innovation: 8/10\nRevenue Potential: 7/10\nScalability: 6/10\nMarket Fit: 9/10\nFUNDED"
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = server.LRUCache()
+    monkeypatch.setattr(server, "_cache", cache)
+    return cache
+
+
+def play(monkeypatch, text, reply="Your cards are dealt!", status_code=200):
+    provider = MockProvider(reply=reply, status_code=status_code)
+    monkeypatch.setattr(server, "LLM_ROUTER", server.ProviderRouter([provider]))
+    request = server.ChatRequest(messages=[{"role": "user", "content": text}], active_mode="startup",
+                                 conversation_id="g1")
+    return asyncio.run(server.run_simple_chat(request))
+
+
+def test_failed_turn_does_not_advance_the_round(cache, monkeypatch):
+    assert play(monkeypatch, "spin")["success"]
+    assert server.load_game_session("g1")["round"] == 1
+
+    assert not play(monkeypatch, "spin again", status_code=400)["success"]
+    session = server.load_game_session("g1")
+    assert session["round"] == 1 and session["phase"] == "awaiting_pitch"
+
+
+def test_loaded_session_is_a_copy(cache):
+    server.save_game_session("g1", {"round": 1, "cards": None, "phase": "awaiting_pitch", "rounds": []})
+    server.load_game_session("g1")["round"] += 1
+    assert server.load_game_session("g1")["round"] == 1
+
+
+def test_scored_pitch_closes_the_round(cache, monkeypatch):
+    play(monkeypatch, "spin")
+    play(monkeypatch, "A marketplace for used lab equipment", reply=SCORED)
+    session = server.load_game_session("g1")
+    assert session["phase"] == "scored"
+    assert session["rounds"] == [{"round": 1, "scores": {"innovation": 8, "revenue potential": 7,
+                                                          "scalability": 6, "market fit": 9}, "verdict": "FUNDED"}]
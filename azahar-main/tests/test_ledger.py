@@ -0,0 +1,147 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from tests.fakes import MockProvider
+
+
+def fake_verifier(token):
+    if token != "token-alice":
+        raise ValueError("invalid token")
+    return {"uid": "alice", "exp": time.time() + 3600}
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    ledger = server.TokenLedger(window=3600, quota=100, mode_quotas={"learn": 40})
+    monkeypatch.setattr(server, "TOKEN_LEDGER", ledger)
+    return ledger
+
+
+@pytest.fixture
+def client(ledger, monkeypatch):
+    monkeypatch.setattr(server, "LLM_ROUTER", server.ProviderRouter([MockProvider(reply="hi")]))
+    monkeypatch.setattr(server, "VERIFIED_TOKENS", server.LRUCache())
+    monkeypatch.setattr(server, "_token_verifier", fake_verifier)
+    return TestClient(server.create_app())
+
+
+def test_user_and_mode_quotas(ledger):
+    ledger.record("u1", None, "learn", 30, 10)
+    with pytest.raises(server.QuotaExceeded) as e:
+        ledger.check("u1", "learn")
+    assert e.value.scope == "learn" and e.value.used == 40
+    ledger.check("u1", "english")
+    ledger.check("u2", "learn")
+
+    ledger.record("u1", None, "english", 50, 10)
+    with pytest.raises(server.QuotaExceeded) as e:
+        ledger.check("u1", "english")
+    assert e.value.scope == "user" and e.value.used == 100
+
+
+def test_retry_after_waits_for_the_oldest_bucket(ledger, monkeypatch):
+    now = 1_000_000.0
+    monkeypatch.setattr(server.time, "time", lambda: now)
+    ledger.record("u1", None, None, 90, 10)
+    now += 600
+    with pytest.raises(server.QuotaExceeded) as e:
+        ledger.check("u1", None)
+    assert e.value.retry_after == 3600 - 600 + 60 - (1_000_000 % 60)
+
+    now += e.value.retry_after
+    ledger.check("u1", None)
+
+
+def test_missing_user_is_still_limited(ledger):
+    ledger.record(None, None, None, 90, 10)
+    with pytest.raises(server.QuotaExceeded):
+        ledger.check(None, None)
+
+
+def test_signed_out_callers_are_charged_by_address(client, ledger):
+    body = {"messages": [{"role": "user", "content": "hello"}], "user_id": "someone-else"}
+    assert client.post("/api/chat/simple", json=body).status_code == 200
+    assert ledger.user_snapshot("ip:testclient")["window_tokens"] > 0
+    assert ledger.user_snapshot("someone-else")["window_tokens"] == 0
+
+    ledger.record("ip:testclient", None, None, 100, 0)
+    body["user_id"] = "yet-another-id"
+    assert client.post("/api/chat/simple", json=body).status_code == 429
+
+
+def test_signed_in_callers_are_charged_by_uid(client, ledger):
+    body = {"messages": [{"role": "user", "content": "hello"}]}
+    headers = {"Authorization": "Bearer token-alice"}
+    assert client.post("/api/chat/simple", json=body, headers=headers).status_code == 200
+    assert ledger.user_snapshot("alice")["window_tokens"] > 0
+
+    body["user_id"] = "bob"
+    assert client.post("/api/chat/simple", json=body, headers=headers).status_code == 403
+
+
+def test_usage_needs_the_owner_or_admin(client, ledger, monkeypatch):
+    ledger.record("alice", "c1", None, 10, 5)
+    assert client.get("/api/usage").status_code == 401
+    assert client.get("/api/usage?user_id=bob", headers={"Authorization": "Bearer token-alice"}).status_code == 403
+    own = client.get("/api/usage", headers={"Authorization": "Bearer token-alice"}).json()
+    assert own["user_id"] == "alice" and own["window_tokens"] == 15
+
+    assert client.get("/api/usage", headers={server.ADMIN_HEADER: "guess"}).status_code == 404
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "secret")
+    assert client.get("/api/usage", headers={server.ADMIN_HEADER: "guess"}).status_code == 403
+    assert client.get("/api/usage", headers={server.ADMIN_HEADER: "secret"}).json()["active_users"] == 1
+
+
+def test_rejected_tokens_are_not_reverified(client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(server, "REJECTED_TOKENS", server.LRUCache())
+    monkeypatch.setattr(server, "_token_verifier", lambda token: calls.append(token) or fake_verifier(token))
+    body = {"messages": [{"role": "user", "content": "hello"}]}
+    for _ in range(3):
+        client.post("/api/chat/simple", json=body, headers={"Authorization": "Bearer forged"})
+    assert calls == ["forged"]
+
+
+def test_forwarded_address_is_only_trusted_from_proxies(client, ledger, monkeypatch):
+    body = {"messages": [{"role": "user", "content": "hello"}]}
+    forwarded = {"X-Forwarded-For": "203.0.113.9, 198.51.100.7"}
+    client.post("/api/chat/simple", json=body, headers=forwarded)
+    assert ledger.user_snapshot("ip:testclient")["window_tokens"] > 0
+    assert ledger.user_snapshot("ip:198.51.100.7")["window_tokens"] == 0
+
+    # TestClient's peer is "testclient", not an address; check the resolution on a bare request
+    request = server.Request({"type": "http", "client": ("10.0.0.2", 1234),
+                              "headers": [(b"x-forwarded-for", b"203.0.113.9, 198.51.100.7, 10.0.0.1")]})
+    assert server.client_address(request) == "10.0.0.2"
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", server.parse_trusted_proxies("10.0.0.0/8, not-an-ip"))
+    assert server.client_address(request) == "198.51.100.7"
+
+
+def test_quotas_need_token_verification(monkeypatch):
+    monkeypatch.setattr(server, "TOKEN_LEDGER", server.TokenLedger(quota=100, mode_quotas={}))
+    monkeypatch.setattr(server, "FIREBASE_CREDENTIALS", None)
+    monkeypatch.delenv("GOOGLE_APPLICATION_CREDENTIALS", raising=False)
+    with pytest.raises(RuntimeError, match="Token quotas are enabled"):
+        server.check_auth_config()
+
+    monkeypatch.setattr(server, "_token_verifier", fake_verifier)
+    server.check_auth_config()
+    monkeypatch.setattr(server, "TOKEN_LEDGER", server.TokenLedger(quota=0, mode_quotas={"learn": 0}))
+    monkeypatch.setattr(server, "_token_verifier", server.verify_firebase_token)
+    server.check_auth_config()
+
+
+@pytest.mark.parametrize("value, quotas", [
+    (None, {"learn": 120000}),
+    ("{}", {}),
+    ('{"learn": 500, "english": "700"}', {"learn": 500, "english": 700}),
+    ("{learn: 500}", {"learn": 120000}),
+    ("[500]", {"learn": 120000}),
+    ('{"learn": "lots"}', {"learn": 120000}),
+    ('{"learn": null}', {"learn": 120000}),
+])
+def test_mode_quotas_fall_back_on_bad_config(value, quotas):
+    assert server.parse_mode_quotas(value) == quotas
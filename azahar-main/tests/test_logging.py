@@ -0,0 +1,26 @@
+import logging
+
+from fastapi.testclient import TestClient
+
+import server
+
+
+def test_import_leaves_logging_alone():
+    root = logging.getLogger()
+    assert not any(isinstance(h, server.NonBlockingQueueHandler) for h in root.handlers)
+
+
+def test_lifespan_installs_and_restores_the_queue(monkeypatch):
+    monkeypatch.setattr(server, "start_upstream_health", lambda modules: _noop())
+    root = logging.getLogger()
+    before = list(root.handlers)
+
+    with TestClient(server.create_app()):
+        assert [type(h) for h in root.handlers] == [server.NonBlockingQueueHandler]
+        assert logging.getLogger("uvicorn.access").propagate is False
+
+    assert root.handlers == before
+
+
+async def _noop():
+    pass
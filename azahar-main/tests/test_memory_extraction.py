@@ -0,0 +1,63 @@
+import pytest
+
+import server
+
+
+def msg(role, content, id=None):
+    message = {"role": role, "content": content}
+    if id:
+        message["id"] = id
+    return message
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setattr(server, "_cache", server.LRUCache())
+
+
+def test_fingerprint_prefers_the_client_id():
+    assert server.message_fingerprint(msg("user", "hi", id="m1")) == "id:m1"
+    assert server.message_fingerprint(msg("user", "hi")) == server.message_fingerprint(msg("user", "hi"))
+    assert server.message_fingerprint(msg("user", "hi")) != server.message_fingerprint(msg("assistant", "hi"))
+
+
+def test_high_water_mark_is_matched_as_a_sequence():
+    history = [msg("user", "ok"), msg("assistant", "a1"), msg("user", "ok"), msg("assistant", "a2")]
+    tail = [server.message_fingerprint(m) for m in history[-3:]]
+    grown = history + [msg("user", "ok"), msg("assistant", "a3")]
+    assert server.unseen_messages(grown, tail) == 4
+
+    # The client trimmed its history: the mark is still found at its new position
+    assert server.unseen_messages(grown[2:], tail) == 2
+    assert server.unseen_messages(grown, None) == 0
+    assert server.unseen_messages([msg("user", "new chat")], tail) == 0
+
+
+def test_only_turns_since_the_last_run_are_sent():
+    first = [msg("user", "I love chess"), msg("assistant", "Nice!")]
+    server.save_high_water_mark("u1", "c1", first)
+    assert server.format_extraction_window(first, "c1", "u1") is None
+
+    later = first + [msg("user", "I started learning Rust"), msg("assistant", "Cool")]
+    window = server.format_extraction_window(later, "c1", "u1")
+    assert window.endswith("(new)\nUSER: I started learning Rust\nASSISTANT: Cool")
+    assert window.startswith("(earlier, already processed — context only)\nUSER: I love chess")
+
+
+def test_marks_are_kept_per_user():
+    messages = [msg("user", "I love chess"), msg("assistant", "Nice!")]
+    server.save_high_water_mark("u1", "c1", messages)
+    assert server.format_extraction_window(messages, "c1", "u1") is None
+    assert server.format_extraction_window(messages, "c1", "u2") == "USER: I love chess\nASSISTANT: Nice!"
+
+
+def test_assistant_only_turns_are_skipped():
+    server.save_high_water_mark("u1", "c1", [msg("user", "hi")])
+    assert server.format_extraction_window([msg("user", "hi"), msg("assistant", "hello")], "c1", "u1") is None
+
+
+def test_without_a_conversation_the_whole_window_is_read():
+    messages = [msg("user", f"m{i}") for i in range(server.MEMORY_EXTRACT_WINDOW + 5)]
+    window = server.format_extraction_window(messages, None, "u1")
+    assert window.splitlines()[0] == "USER: m5"
+    assert len(window.splitlines()) == server.MEMORY_EXTRACT_WINDOW
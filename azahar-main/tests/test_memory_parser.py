@@ -0,0 +1,83 @@
+import json
+
+import server
+from tests.fakes import MockResponse
+
+
+def parse(*deltas):
+    parser = server.MemoryJSONParser()
+    for delta in deltas:
+        if parser.feed(delta):
+            break
+    return parser
+
+
+def test_object_is_parsed_across_arbitrary_deltas():
+    text = json.dumps({"preferred_name": "Asha", "new_interests": ["chess", "jazz, mostly {bebop}"],
+                       "emotional_state": "Happy"})
+    parser = parse(*[text[i:i + 3] for i in range(0, len(text), 3)])
+    assert parser.complete
+    assert parser.fields == {"preferred_name": "Asha", "new_interests": ["chess", "jazz, mostly {bebop}"],
+                             "emotional_state": "happy"}
+
+
+def test_fences_preamble_and_trailing_chatter_are_ignored():
+    parser = parse('Here is the JSON:\n```json\n{"current_topic": "exams", "new_goals": []}\n```\nHope that helps!')
+    assert parser.complete and parser.fields == {"current_topic": "exams", "new_goals": []}
+
+
+def test_fields_are_checked_against_the_schema():
+    parser = parse('{"skill_level": "expert", "language_style": "null", "new_facts": "not a list", '
+                   '"new_goals": ["", "null", "run a marathon"], "mood": "great", "preferred_name": "%s"}' % ("x" * 500))
+    assert parser.fields["skill_level"] is None and "skill_level" in parser.rejected
+    assert parser.fields["language_style"] is None and "language_style" not in parser.rejected
+    assert parser.fields["new_facts"] is None and "new_facts" in parser.rejected
+    assert parser.fields["new_goals"] == ["run a marathon"]
+    assert "mood" not in parser.fields
+    assert len(parser.fields["preferred_name"]) == server.MEMORY_EXTRACT_TEXT_CHARS
+
+
+def test_truncated_object_keeps_completed_members():
+    parser = parse('{"preferred_name": "Asha", "new_interests": ["chess", "ja')
+    assert not parser.complete
+    assert parser.fields == {"preferred_name": "Asha"}
+
+
+def test_malformed_member_is_rejected_without_losing_the_rest():
+    parser = parse('{"preferred_name": Asha, "current_topic": "exams"}')
+    assert parser.fields == {"current_topic": "exams"}
+    assert parser.rejected == ['"preferred_name": Asha']
+
+
+class CountingResponse(MockResponse):
+    def __init__(self, lines):
+        super().__init__(200, lines=lines)
+        self.read = 0
+        self.closed = False
+
+    def iter_lines(self):
+        for line in self._lines:
+            self.read += 1
+            yield line
+
+    def close(self):
+        self.closed = True
+
+
+def sse(content):
+    return ("data: " + json.dumps({"choices": [{"delta": {"content": content}}]})).encode()
+
+
+def test_stream_is_closed_once_the_object_is_complete():
+    lines = [sse('{"current_topic": '), sse('"exams"}'), sse(" Anything else?"), b"data: [DONE]"]
+    response = CountingResponse(lines)
+    fields, result = server.read_memory_extraction(response)
+    assert fields == {"current_topic": "exams"}
+    assert result["finish_reason"] == "parsed"
+    assert response.read == 2 and response.closed
+
+
+def test_stream_without_an_object_yields_nothing():
+    response = CountingResponse([sse("I could not find anything."), b"data: [DONE]"])
+    fields, _ = server.read_memory_extraction(response)
+    assert fields is None and response.closed
@@ -0,0 +1,38 @@
+import server
+
+
+def test_one_tokenizer_for_search_memory_and_retrieval():
+    assert server.content_words("Tell me about the latest Cricket news, yaar!") == ["cricket"]
+    assert server.keyword_terms("I was playing guitars") == ["play", "guitar"]
+    assert server.keyword_terms("mujhe painting pasand hai") == ["paint", "pasand"]
+
+
+def test_relevant_items_are_kept():
+    memory = server.UserMemory(
+        preferred_name="Asha",
+        interests=["playing guitar", "cricket", "baking sourdough bread", "chess openings"],
+        goals=["run a marathon", "learn Rust"],
+        personal_facts=["has a dog named Bruno", "works as a nurse"],
+        recent_topics=["exam stress", "weekend plans"],
+    )
+    selected = server.select_memory(memory, "Any tips for my guitar practice?", top_k=2)
+
+    assert selected.preferred_name == "Asha"
+    # One match, so the newest interest fills the second slot
+    assert selected.interests == ["playing guitar", "chess openings"]
+    assert selected.goals == [] and selected.personal_facts == []
+    assert selected.recent_topics == ["weekend plans"]
+    assert memory.interests[1] == "cricket"
+
+
+def test_small_talk_falls_back_to_recent_items():
+    memory = server.UserMemory(interests=["cricket", "chess", "baking"], goals=["run a marathon"])
+    selected = server.select_memory(memory, "hi", top_k=3)
+    assert selected.interests == ["baking"] and selected.goals == ["run a marathon"]
+
+
+def test_budget_caps_the_selection():
+    memory = server.UserMemory(interests=[f"guitar lesson number {i} with a long description" for i in range(10)])
+    selected = server.select_memory(memory, "guitar lesson", top_k=10, budget=30)
+    assert 0 < len(selected.interests) < 10
+    assert sum(server.estimate_tokens(i) for i in selected.interests) <= 30
@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+
+def busy_worker(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sample_stacks_collapses_root_first():
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_worker, args=(stop,), name="busy")
+    worker.start()
+    try:
+        stacks, rounds = server.sample_stacks(0.1, 0.005)
+    finally:
+        stop.set()
+        worker.join()
+
+    assert rounds >= 5
+    busy = [stack for stack in stacks if stack.startswith("busy;")]
+    assert busy and all("busy_worker (test_profiler.py:" in stack for stack in busy)
+    assert busy[0].split(";")[1].startswith("_bootstrap (threading.py")
+
+
+def test_idle_threads_are_skipped_unless_asked():
+    stop = threading.Event()
+    waiter = threading.Thread(target=stop.wait, name="idle-waiter")
+    waiter.start()
+    try:
+        quiet, _ = server.sample_stacks(0.03, 0.005)
+        everything, _ = server.sample_stacks(0.03, 0.005, include_idle=True)
+    finally:
+        stop.set()
+        waiter.join()
+    assert not any(stack.startswith("idle-waiter;") for stack in quiet)
+    assert any(stack.startswith("idle-waiter;") for stack in everything)
+
+
+def test_collapsed_stacks_format():
+    text = server.collapsed_stacks({"main;a;b": 2, "main;a;c": 5})
+    assert text == "main;a;c 5\nmain;a;b 2\n"
+
+
+@pytest.fixture
+def client():
+    return TestClient(server.create_app())
+
+
+def test_profile_endpoints_need_the_admin_token(client, monkeypatch):
+    assert client.get("/api/admin/profile?seconds=0.1").status_code == 404
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "secret")
+    assert client.get("/api/admin/profile?seconds=0.1", headers={server.ADMIN_HEADER: "nope"}).status_code == 403
+    assert client.get("/api/admin/profile/memory?seconds=0.1").status_code == 403
+
+
+def test_cpu_and_memory_profiles(client, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "secret")
+    headers = {server.ADMIN_HEADER: "secret"}
+
+    response = client.get("/api/admin/profile?seconds=0.1&interval_ms=5&idle=true", headers=headers)
+    assert response.status_code == 200 and response.headers["content-type"].startswith("text/plain")
+    assert int(response.headers["X-Profile-Rounds"]) > 0
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in response.text.strip().splitlines())
+
+    report = client.get("/api/admin/profile/memory?seconds=0.1&top=5", headers=headers).json()
+    assert report["seconds"] == 0.1 and len(report["hot_spots"]) <= 5
@@ -0,0 +1,145 @@
+import asyncio
+
+import server
+from server import ProviderRouter
+from tests.fakes import MockProvider, MockResponse
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+class TrackedResponse(MockResponse):
+    def __init__(self, status_code, body=None):
+        super().__init__(status_code, body)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TrackingProvider(MockProvider):
+    """A MockProvider that keeps every response it hands out."""
+
+    def __init__(self, name, status_code=200, **kwargs):
+        super().__init__(name=name, status_code=status_code, **kwargs)
+        self.responses = []
+
+    def send(self, payload, stream, timeout=server.UPSTREAM_TIMEOUT):
+        if self.status_code == 200:
+            response = TrackedResponse(200, super().send(payload, False, timeout).json())
+        else:
+            response = TrackedResponse(self.status_code, {"error": f"mock status {self.status_code}"})
+        self.responses.append(response)
+        return response
+
+
+def call(router):
+    return router.call(MESSAGES, stream=False, max_tokens=16, temperature=0.5)
+
+
+def test_fails_over_in_configured_order_on_retryable_status():
+    first, second, third = TrackingProvider("a", 503), TrackingProvider("b", 429), TrackingProvider("c")
+    router = ProviderRouter([first, second, third])
+
+    response = call(router)
+
+    assert response.provider == "c"
+    assert [len(p.responses) for p in (first, second, third)] == [1, 1, 1]
+    assert router.stats["a"]["errors"] == 1 and router.stats["b"]["errors"] == 1
+    assert router.stats["c"]["errors"] == 0
+
+
+def test_discarded_responses_are_closed():
+    first, second = TrackingProvider("a", 502), TrackingProvider("b", 503)
+    router = ProviderRouter([first, second])
+
+    response = call(router)
+
+    # Every provider failed: the last response is returned open, the others are closed
+    assert response is second.responses[0] and not response.closed
+    assert first.responses[0].closed
+
+    first.status_code, second.status_code = 503, 200
+    router.stats["a"]["cooldown_until"] = router.stats["b"]["cooldown_until"] = 0.0
+    response = call(router)
+    assert response.provider == "b"
+    assert first.responses[-1].closed
+
+
+def test_non_retryable_status_is_returned_and_counted_as_failure():
+    first, second = TrackingProvider("a", 401), TrackingProvider("b")
+    router = ProviderRouter([first, second])
+
+    response = call(router)
+
+    assert response.status_code == 401 and response.provider == "a"
+    assert second.responses == []
+    assert router.stats["a"]["errors"] == 1
+    assert router.stats["a"]["ewma_latency_ms"] is None
+    assert router.stats["a"]["cooldown_until"] > 0
+
+
+def test_ranks_by_latency_then_unmeasured_then_cooling():
+    fast, slow, fresh, cooling = (MockProvider(name=n) for n in ("fast", "slow", "fresh", "cooling"))
+    router = ProviderRouter([fresh, slow, cooling, fast])
+    router.record_success(slow, 900)
+    router.record_success(fast, 100)
+    router.record_success(cooling, 10)
+    router.record_failure(cooling, "HTTP 503")
+
+    assert [p.name for p in router.ordered()] == ["fast", "slow", "fresh", "cooling"]
+
+
+def test_priority_strategy_keeps_configured_order():
+    first, second = MockProvider(name="a"), MockProvider(name="b")
+    router = ProviderRouter([first, second], strategy="priority")
+    router.record_success(first, 900)
+    router.record_success(second, 10)
+
+    assert [p.name for p in router.ordered()] == ["a", "b"]
+
+
+def test_unconfigured_providers_are_skipped():
+    missing = MockProvider(name="missing", api_key="")
+    router = ProviderRouter([missing, MockProvider(name="ok")])
+
+    assert [p.name for p in router.ordered()] == ["ok"]
+    assert call(router).provider == "ok"
+
+
+class ClosableResponse(MockResponse):
+    def __init__(self, status_code, lines=None):
+        super().__init__(status_code, lines=lines)
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+
+
+def test_streaming_key_stays_in_flight_until_closed(monkeypatch):
+    provider = server.OpenAICompatibleProvider("upstream", "https://llm.invalid/v1/chat/completions", "m", "k1")
+    lines = [b'data: {"choices": [{"delta": {"content": "hi"}}]}', b"data: [DONE]"]
+    session = type("Session", (), {"post": lambda self, url, **kwargs: ClosableResponse(200, lines)})()
+    monkeypatch.setattr(server, "upstream_session", lambda: session)
+    key = provider.key_pool.keys[0]
+
+    response = provider.send({}, stream=True)
+    assert key.in_flight == 1
+    response.close()
+    response.close()
+    assert key.in_flight == 0 and response.closed == 2
+
+    provider.send({}, stream=False)
+    assert key.in_flight == 0
+
+
+def test_stream_relay_closes_response():
+    provider = MockProvider()
+    response = provider.send({"messages": MESSAGES}, stream=True)
+    closed = []
+    response.close = lambda: closed.append(True)
+
+    async def relay():
+        return [chunk async for chunk in server._stream_response(response, {})]
+
+    chunks = asyncio.run(relay())
+    assert chunks and closed == [True]
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+from fastapi.exceptions import RequestValidationError
+from fastapi.testclient import TestClient
+
+import server
+
+
+def test_messages_decode_to_plain_dicts():
+    body = json.dumps({"messages": [{"role": "user", "content": "hi", "id": "m1"},
+                                    {"role": "assistant", "content": "hello"}],
+                       "active_mode": "learn"}).encode()
+    request = server.decode_body(server.ChatRequest, body)
+    assert request.messages == [{"role": "user", "content": "hi", "id": "m1"}, {"role": "assistant", "content": "hello"}]
+    assert type(request.messages[0]) is dict
+    assert request.active_mode == "learn" and request.user_name == "friend"
+
+
+@pytest.mark.parametrize("body, error_type, loc", [
+    (b"", "missing", ("body",)),
+    (b"{not json", "json_invalid", ("body", 1)),
+    (b'{"messages": "hi"}', "list_type", ("body", "messages")),
+    (b'{"messages": [{"role": "user"}]}', "missing", ("body", "messages", 0, "content")),
+    (b'{"messages": ["hi"]}', "model_attributes_type", ("body", "messages", 0)),
+    (b"[]", "model_attributes_type", ("body",)),
+    (b'{"messages": [], "user_memory": "bad"}', "model_attributes_type", ("body", "user_memory")),
+])
+def test_errors_match_fastapi_body_errors(body, error_type, loc):
+    with pytest.raises(RequestValidationError) as e:
+        server.decode_body(server.ChatRequest, body)
+    error = e.value.errors()[0]
+    assert error["type"] == error_type and tuple(error["loc"]) == loc
+    if error_type == "model_attributes_type":
+        assert error["msg"] == "Input should be a valid dictionary or object to extract fields from"
+
+
+def test_invalid_body_is_a_422():
+    client = TestClient(server.create_app())
+    response = client.post("/api/chat/simple", content=b'{"messages": [{"role": "user"}]}',
+                           headers={"Content-Type": "application/json"})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", "messages", 0, "content"]
@@ -0,0 +1,55 @@
+import server
+
+
+def test_complexity_features():
+    assert server.score_complexity("hi 👋", None)["score"] == 0
+
+    scored = server.score_complexity("Can you explain step by step why the sky is blue?", "learn")
+    assert scored["features"]["depth"] == 2 and scored["features"]["mode"] == 2
+    assert scored["features"]["questions"] >= 1
+
+    assert server.score_complexity("```python\nprint(1)\n```", None)["features"]["code"] == 3
+    assert server.score_complexity("word " * 100, None)["features"]["length"] == 3
+
+
+def test_first_profile_that_covers_the_score_wins():
+    assert server.route_message("hi", None)["name"] == "fast"
+    assert server.route_message("what time is it in Tokyo right now?", None)["name"] == "standard"
+    assert server.route_message("Explain step by step how TCP handshakes work, with code: def f(x):", "learn")["name"] == "full"
+
+
+def test_follow_ups_never_take_the_fast_path():
+    for text in ["tell me more", "why?", "continue", "explain that", "Aur batao", "and then?"]:
+        assert server.score_complexity(text, None)["features"]["follow_up"] == 2, text
+        assert server.route_message(text, None)["name"] == "standard", text
+    assert not server.is_follow_up("why is the sky blue")
+    assert server.route_message("thanks!", None)["name"] == "fast"
+
+
+def test_follow_ups_skip_every_profile_that_trims_history(monkeypatch):
+    monkeypatch.setattr(server, "ROUTING_TABLE", [{"name": "tiny", "max_score": 10, "context_limit": 4},
+                                                  {"name": "rest", "max_score": None}])
+    assert server.route_message("hi", None)["name"] == "tiny"
+    assert server.route_message("go on", None)["name"] == "rest"
+
+
+def test_routing_table_override(monkeypatch):
+    monkeypatch.setattr(server, "ROUTING_TABLE", [{"name": "only", "max_score": 0}, {"name": "rest", "max_score": None}])
+    assert server.route_message("hi", None)["name"] == "only"
+    assert server.route_message("why?", None)["name"] == "rest"
+
+    monkeypatch.setattr(server, "ROUTING_ENABLED", False)
+    assert server.route_message("hi", None) is None
+
+
+def test_invalid_routing_table_falls_back(monkeypatch):
+    monkeypatch.setenv("ROUTING_TABLE", "{not json")
+    assert server.load_routing_table() == server.DEFAULT_ROUTING_TABLE
+    monkeypatch.setenv("ROUTING_TABLE", '[{"name": "custom", "max_score": null}]')
+    assert server.load_routing_table() == [{"name": "custom", "max_score": None}]
+
+
+def test_trim_to_token_budget_keeps_the_latest_message():
+    history = [{"role": "user", "content": "x" * 400} for _ in range(5)]
+    assert len(server.trim_to_token_budget(history, 250)) == 2
+    assert server.trim_to_token_budget(history, 1) == history[-1:]
@@ -0,0 +1,38 @@
+import server
+
+RESULTS = [
+    {"title": "Chandrayaan-3 lands", "url": "https://www.isro.gov.in/ch3",
+     "content": "Chandrayaan-3 landed near the lunar south pole on 23 August 2023. "
+                "Subscribe to our newsletter for more updates every week. "
+                "The Vikram lander carried the Pragyan rover to the lunar surface."},
+    {"title": "Mirror", "url": "https://news.example.com/moon",
+     "content": "Chandrayaan-3 landed near the lunar south pole on 23 August 2023!"},
+    {"title": "Unrelated", "url": "https://example.org/cricket",
+     "content": "India won the cricket series against Australia by two wickets."},
+]
+
+
+def test_relevant_sentences_are_packed_with_sources():
+    packed = server.pack_search_context("when did Chandrayaan-3 land on the lunar south pole", RESULTS)
+    assert packed.startswith("[1] Chandrayaan-3 lands: Chandrayaan-3 landed near the lunar south pole")
+    assert "newsletter" not in packed and "cricket" not in packed
+    assert packed.endswith("Sources: [1] isro.gov.in")
+
+
+def test_near_duplicates_are_dropped():
+    packed = server.pack_search_context("Chandrayaan-3 lunar south pole", RESULTS)
+    assert packed.count("landed near the lunar south pole") == 1
+    assert "news.example.com" not in packed
+
+
+def test_budget_is_respected():
+    results = [{"title": f"r{i}", "url": f"https://s{i}.com", "content": f"Rust compiler release notes part {i}. " * 5}
+               for i in range(20)]
+    packed = server.pack_search_context("rust compiler release", results, token_budget=60)
+    assert 0 < server.estimate_tokens(packed) <= 75
+
+
+def test_nothing_matching_falls_back_to_top_sentences():
+    packed = server.pack_search_context("zzz qqq", RESULTS[2:])
+    assert "cricket series" in packed
+    assert server.pack_search_context("anything", []) == ""
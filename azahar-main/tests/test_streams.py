@@ -0,0 +1,82 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from tests.fakes import MockProvider
+
+BODY = {"messages": [{"role": "user", "content": "hi"}]}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "LLM_ROUTER", server.ProviderRouter([MockProvider(reply="one two three")]))
+    monkeypatch.setattr(server, "STREAMS", server.StreamRegistry())
+    return TestClient(server.create_app())
+
+
+def events(response):
+    ids, data = [], []
+    for line in response.text.splitlines():
+        if line.startswith("id: "):
+            ids.append(int(line[4:]))
+        elif line.startswith("data: "):
+            data.append(json.loads(line[6:]))
+    return ids, data
+
+
+def test_resume_picks_up_after_the_last_event(client):
+    headers = {"Idempotency-Key": "k1"}
+    ids, data = events(client.post("/api/chat/stream", json=BODY, headers=headers))
+    assert data[-1].get("done")
+
+    resumed = client.post("/api/chat/stream", json=BODY, headers={**headers, "Last-Event-ID": "2"})
+    assert events(resumed) == (ids[2:], data[2:])
+
+
+def test_resume_without_a_buffer_is_refused(client):
+    response = client.post("/api/chat/stream", json=BODY, headers={"Idempotency-Key": "elsewhere", "Last-Event-ID": "3"})
+    assert response.status_code == 409 and response.json()["stream_missing"]
+    assert server.STREAMS.get("elsewhere") is None
+
+    # Starting over without Last-Event-ID is still allowed
+    response = client.post("/api/chat/stream", json=BODY, headers={"Idempotency-Key": "elsewhere"})
+    assert response.status_code == 200 and events(response)[1][-1].get("done")
+
+
+def test_key_reused_for_another_request(client):
+    client.post("/api/chat/stream", json=BODY, headers={"Idempotency-Key": "k1"})
+    other = {"messages": [{"role": "user", "content": "something else"}]}
+    assert client.post("/api/chat/stream", json=other, headers={"Idempotency-Key": "k1"}).status_code == 422
+
+
+def test_only_the_owner_can_resume_or_cancel(client, monkeypatch):
+    monkeypatch.setattr(server, "VERIFIED_TOKENS", server.LRUCache())
+    monkeypatch.setattr(server, "_token_verifier", lambda token: {"uid": token, "exp": 9e9})
+    alice, bob = {"Authorization": "Bearer alice"}, {"Authorization": "Bearer bob"}
+    client.post("/api/chat/stream", json=BODY, headers={**alice, "Idempotency-Key": "k1"})
+    assert server.STREAMS.get("k1").owner == "alice"
+
+    resumed = client.post("/api/chat/stream", json=BODY, headers={**bob, "Idempotency-Key": "k1", "Last-Event-ID": "1"})
+    assert resumed.status_code == 422
+    anonymous = client.post("/api/chat/stream", json=BODY, headers={"Idempotency-Key": "k1", "Last-Event-ID": "1"})
+    assert anonymous.status_code == 422
+    assert client.post("/api/chat/stream", json=BODY, headers={**alice, "Idempotency-Key": "k1"}).status_code == 200
+
+
+def test_cancel_checks_the_owner():
+    async def run():
+        registry = server.StreamRegistry()
+
+        async def forever():
+            while True:
+                await asyncio.sleep(1)
+                yield "data: {}\n\n"
+
+        registry.start("k1", "f", "alice", forever())
+        assert not registry.cancel("k1", "ip:testclient")
+        assert registry.cancel("k1", "alice")
+
+    asyncio.run(run())
@@ -0,0 +1,107 @@
+import pytest
+
+import server
+
+FILLER = ["what's up", "how was your day", "tell me a joke", "ok cool", "nice", "thanks", "haha", "any plans",
+          "sounds good", "see you", "good morning", "lol"]
+
+
+def history(n_pairs, planted=None):
+    """n_pairs user/assistant exchanges; `planted` maps an exchange number to its user message."""
+    planted = planted or {}
+    messages = []
+    for i in range(n_pairs):
+        messages.append({"role": "user", "content": planted.get(i, f"{FILLER[i % len(FILLER)]} #{i}")})
+        messages.append({"role": "assistant", "content": f"reply {i}"})
+    return messages
+
+
+@pytest.fixture(autouse=True)
+def indexes(monkeypatch):
+    monkeypatch.setattr(server, "TURN_INDEXES", server.OrderedDict())
+
+
+def test_group_exchanges():
+    messages = [{"role": "assistant", "content": "welcome"}, {"role": "user", "content": "hi"},
+                {"role": "assistant", "content": "hello"}, {"role": "assistant", "content": "anything else?"}]
+    assert server.group_exchanges(messages, offset=10) == [
+        ("NEX: welcome", 11), ("USER: hi\nNEX: hello\nNEX: anything else?", 14)
+    ]
+
+
+def test_the_planted_exchange_ranks_first():
+    messages = history(40, {5: "I am reading The Left Hand of Darkness by Ursula Le Guin"})
+    index = server.TurnIndex()
+    assert index.update(messages, 60) == 30
+
+    results = index.search("what was that Ursula Le Guin book again?", 60)
+    assert "Left Hand of Darkness" in max(results)[1]
+    assert all(score >= server.RETRIEVAL_MIN_SCORE for score, _ in results)
+    # Returned in conversation order, not score order
+    positions = [index.exchanges.index(exchange) for _, exchange in results]
+    assert positions == sorted(positions)
+    assert index.search("what is this", 60) == []
+
+
+def test_exchanges_back_inside_the_window_are_skipped():
+    messages = history(40, {25: "my sister Meera lives in Pune"})
+    index = server.TurnIndex()
+    index.update(messages, 60)
+    assert "Meera" in max(index.search("where does Meera live", 60))[1]
+    assert not any("Meera" in exchange for _, exchange in index.search("where does Meera live", 50))
+
+
+def test_update_is_incremental_and_reanchors():
+    messages = history(40)
+    index = server.TurnIndex()
+    assert index.update(messages, 40) == 20
+    assert index.update(messages, 40) == 0
+    assert index.update(messages, 44) == 2
+
+    # The client now sends only the latest 60 messages: rows shift instead of being rebuilt
+    trimmed = messages[20:]
+    assert index.update(trimmed, 24) == 0 and index.indexed_until == 24
+    assert len(index) == 22
+
+    # An unrecognisable history starts over
+    assert index.update(history(10), 10) == 5 and len(index) == 5
+
+
+def test_reply_still_in_the_window_waits():
+    messages = history(10)
+    index = server.TurnIndex()
+    index.update(messages, 5)  # message 4 is a user turn whose reply is message 5
+    assert index.indexed_until == 4
+
+
+def test_retrieve_older_turns_fits_the_budget():
+    planted = {i: f"my favourite guitar chord progression number {i} is quite long to explain" for i in range(5)}
+    messages = history(40, planted)
+    block = server.retrieve_older_turns("c1", messages, 60, "guitar chord progression", budget=40)
+    assert block.startswith("\n\nEARLIER IN THIS CONVERSATION")
+    assert server.estimate_tokens(block.split("):\n", 1)[1]) <= 40
+    assert "c1" in server.TURN_INDEXES
+
+    assert server.retrieve_older_turns("c1", messages, 0, "guitar") == ""
+    assert server.retrieve_older_turns(None, messages, 60, "what is this") == ""
+
+
+def test_rebuild_resets_in_place():
+    index = server.TurnIndex()
+    lock = index.lock
+    index.update(history(40), 60)
+    assert index.update(history(10, {0: "something else entirely"}), 10) == 5
+    assert len(index) == 5 and index.lock is lock
+
+
+def test_indexes_share_a_row_budget():
+    for name in ("a", "b", "c"):
+        server.turn_index(name).update(history(40), 60)  # 30 exchanges -> 32 rows each
+    assert server.trim_turn_indexes(limit=70) == 1
+    assert list(server.TURN_INDEXES) == ["b", "c"]
+
+    server.turn_index("b")  # touching an index makes it the most recent
+    assert server.trim_turn_indexes(limit=40) == 1
+    assert list(server.TURN_INDEXES) == ["b"]
+    # The most recent index is kept even on its own over the budget
+    assert server.trim_turn_indexes(limit=1) == 0 and list(server.TURN_INDEXES) == ["b"]